@@ -94,13 +94,16 @@ df = df.drop_duplicates(subset=['_mjd','_sol','_ID1','_ra_o','_dc_o','_amag','_r
 df = df.rename(columns={'_m_ut':'_mi_ut'})
 df.to_parquet('${DATADIR}/searchidx/matches-full-${yr}-new.parquet.snap', index=False, compression='snappy')
 EOD3
+# add tonight's matches to the yearly parquet file rather than converting the whole year again
+python -m converters.appendParquet append $DATADIR/matched/matches-full-${yr}.csv ${DATADIR}/searchidx/matches-full-${yr}-new.csv
 rm -f ${DATADIR}/searchidx/matches-full-${yr}-new.csv
 
-python -m converters.toParquet $DATADIR/matched/matches-full-${yr}.csv
+python -m converters.createMatchIndex $DATADIR/matched/matches-full-${yr}.csv
+python -m converters.createStationIndex $DATADIR/matched/matches-full-${yr}.parquet.snap
 
-aws s3 sync $DATADIR/matched/ $UKMONSHAREDBUCKET/matches/matched/ --include "*" --exclude "*.snap" --exclude "*.bkp" --exclude "*.gzip" --quiet 
-aws s3 sync $DATADIR/matched/ $UKMONSHAREDBUCKET/matches/matchedpq/ --quiet --exclude "*" --include "*.snap" --exclude "*.bkp" --exclude "*.gzip"
-aws s3 sync $DATADIR/matched/ $WEBSITEBUCKET/browse/parquet/  --exclude "*" --include "*.snap" --exclude "*.bkp" --exclude "*.gzip" --quiet
-aws s3 sync $DATADIR/single/ $WEBSITEBUCKET/browse/parquet/  --exclude "*" --include "*.snap" --exclude "*.bkp" --exclude "*.gzip" --quiet
+aws s3 sync $DATADIR/matched/ $UKMONSHAREDBUCKET/matches/matched/ --include "*" --exclude "*.parts/*" --exclude "*.npz" --exclude "*.snap" --exclude "*.bkp" --exclude "*.gzip" --quiet 
+aws s3 sync $DATADIR/matched/ $UKMONSHAREDBUCKET/matches/matchedpq/ --quiet --exclude "*" --include "*.snap" --exclude "*.bkp" --exclude "*.gzip" --exclude "*.parts/*"
+aws s3 sync $DATADIR/matched/ $WEBSITEBUCKET/browse/parquet/  --exclude "*" --include "*.snap" --exclude "*.bkp" --exclude "*.gzip" --exclude "*.parts/*" --quiet
+aws s3 sync $DATADIR/single/ $WEBSITEBUCKET/browse/parquet/  --exclude "*" --include "*.snap" --exclude "*.bkp" --exclude "*.gzip" --exclude "*.parts/*" --quiet
 
 logger -s -t consolidateOutput "finished"
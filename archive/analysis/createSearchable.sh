@@ -11,6 +11,7 @@
 #
 # Produces:
 #   searchidx/yyyy-allevents.txt - a searchable file 
+#   searchidx/yyyy/yyyymmdd.csv.gz and index.json - the same data split by day
 #   camlist.txt - a list of cameras that provided data 
 
 here="$( cd "$(dirname "$0")" >/dev/null 2>&1 ; pwd -P )"
@@ -36,6 +37,9 @@ if [ -f $DATADIR/searchidx/${yr}-${whichpass}-new.csv ] ; then
     cat $DATADIR/searchidx/${yr}-${whichpass}-new.csv >> $DATADIR/searchidx/${yr}-allevents.csv
 fi 
 
+python -m reports.createSearchableFormat $yr index
+
 aws s3 sync  $DATADIR/searchidx/ $WEBSITEBUCKET/search/indexes/ --exclude "*" --include "*allevents.csv" --quiet 
+aws s3 sync  $DATADIR/searchidx/${yr}/ $WEBSITEBUCKET/search/indexes/${yr}/ --quiet 
 
 logger -s -t createSearchable "finished"
@@ -46,10 +46,9 @@ do
 done 
 
 logger -s -t getRMSSingleData "convert to parquet"
-if [ -f $mrgfile ] ; then 
-    python -m converters.toParquet $mrgfile
-fi 
 if [ -f $newsngl ] ; then 
+    # add tonight's rows to the yearly parquet file rather than converting the whole year again
+    python -m converters.appendParquet append $mrgfile $newsngl
     python -m converters.toParquet $newsngl
     \rm -f $newsngl
 fi 
@@ -57,6 +56,6 @@ fi
 # push to S3 bucket for future use by AWS tools
 logger -s -t getRMSSingleData "copy to S3 bucket"
 aws s3 sync $SRC/data/single/ $UKMONSHAREDBUCKET/matches/single/ --exclude "*" --include "*.csv" --exclude "new/*" --quiet
-aws s3 sync $SRC/data/single/ $UKMONSHAREDBUCKET/matches/singlepq/ --exclude "*" --include "*.parquet.snap" --exclude "*new.parquet.snap" --quiet
+aws s3 sync $SRC/data/single/ $UKMONSHAREDBUCKET/matches/singlepq/ --exclude "*" --include "*.parquet.snap" --exclude "*new.parquet.snap" --exclude "*.parts/*" --quiet
 
 logger -s -t getRMSSingleData "finished"
\ No newline at end of file
@@ -92,6 +92,9 @@ rsync -avz  -e "ssh -i $SERVERSSHKEY" $PYLIB/traj/distributeCandidates.py ec2-us
 # now run the script
 log2cw $NJLOGGRP $NJLOGSTREAM "start distributed processing" runDistrib
 ssh -i $SERVERSSHKEY ec2-user@$privip "data/distrib/$execdist"
+if [ $? -ne 0 ] ; then
+    log2cw $NJLOGGRP $NJLOGSTREAM "some candidates were not distributed, check syslog on the calcserver" runDistrib
+fi
 
 log2cw $NJLOGGRP $NJLOGSTREAM "job run, stop the server again" runDistrib
 aws ec2 stop-instances --instance-ids $SERVERINSTANCEID
@@ -42,6 +42,8 @@ EOD
         mv $evt/$orb $evt/$truncpn
         aws s3 sync $evt/jpgs s3://ukmda-website/img/single/${yr}/${ym}/
         aws s3 sync $evt/mp4s s3://ukmda-website/img/mp4/${yr}/${ym}/
+        python -m reports.imageManifest $evt/jpgs img/single/${yr}/${ym}
+        python -m reports.imageManifest $evt/mp4s img/mp4/${yr}/${ym}
         orb=$truncpn
         pick=$(ls -1 $evt/$orb/*.pickle)
         python -m maintenance.recreateOrbitPages $pick force
@@ -10,6 +10,7 @@ import configparser as crp
 
 from MeteorObservation import MeteorObservation
 from Math import angleBetweenSphericalCoords, date2JD
+from ftpDetectReader import readFTPdetectinfoColumnar
 
 
 def loadFTPDetectInfo(ftpdetectinfo_file_name, time_offsets=None,
@@ -52,148 +53,76 @@ def loadFTPDetectInfo(ftpdetectinfo_file_name, time_offsets=None,
     stations[statid] = [np.radians(lat), np.radians(lon), height*1000]
     meteor_list = []
 
-    with open(ftpdetectinfo_file_name) as f:
-        # Skip the header
-        for i in range(11):
-            next(f)
+    ftp = readFTPdetectinfoColumnar(*os.path.split(ftpdetectinfo_file_name), skip_nan=False)
 
-        current_meteor = None
+    for i, ff_name in enumerate(ftp.ff_names):
 
-        bin_name = False
-        cal_name = False
-        meteor_header = False
+        # Extract the reference time from the FF bin file name
+        line = ff_name.split('_')
 
-        for line in f:
-            # Skip comments
-            if line.startswith("#"):
-                continue
-
-            line = line.replace('\n', '').replace('\r', '')
-
-            # Skip the line if it is empty
-            if not line:
-                continue
-
-            if '-----' in line:
-                # Mark that the next line is the bin name
-                bin_name = True
+        # Count the number of string segments, and determine if it the old or new CAMS format
+        if len(line) == 6:
+            sc = 1
+        else:
+            sc = 0
 
-                # If the separator is read in, save the current meteor
-                if current_meteor is not None:
-                    current_meteor.finish()
-                    meteor_list.append(current_meteor)
-                continue
+        ff_date = line[1 + sc]
+        ff_time = line[2 + sc]
+        milliseconds = line[3 + sc]
 
-            if bin_name:
-                bin_name = False
+        year = ff_date[:4]
+        month = ff_date[4:6]
+        day = ff_date[6:8]
 
-                # Mark that the next line is the calibration file name
-                cal_name = True
+        hour = ff_time[:2]
+        minute = ff_time[2:4]
+        seconds = ff_time[4:6]
 
-                # Save the name of the FF file
-                ff_name = line
+        year, month, day, hour, minute, seconds, milliseconds = map(int, [year, month, day, hour, 
+            minute, seconds, milliseconds])
 
-                # Extract the reference time from the FF bin file name
-                line = line.split('_')
+        # Calculate the reference JD time
+        jdt_ref = date2JD(year, month, day, hour, minute, seconds, milliseconds)
 
-                # Count the number of string segments, and determine if it the old or new CAMS format
-                if len(line) == 6:
-                    sc = 1
-                else:
-                    sc = 0
+        # Get the station ID and the FPS from the meteor header
+        station_id = ftp.cam_code.strip()
+        fps = float(ftp.header[i][2])
 
-                ff_date = line[1 + sc]
-                ff_time = line[2 + sc]
-                milliseconds = line[3 + sc]
+        # Try converting station ID to integer
+        try:
+            station_id = int(station_id)
+        except:
+            pass
 
-                year = ff_date[:4]
-                month = ff_date[4:6]
-                day = ff_date[6:8]
+        # If the time offsets were given, apply the correction to the JD
+        if time_offsets is not None:
+            if station_id in time_offsets:
+                print('Applying time offset for station {:s} of {:.2f} s'.format(str(station_id),
+                    time_offsets[station_id]))
 
-                hour = ff_time[:2]
-                minute = ff_time[2:4]
-                seconds = ff_time[4:6]
+                jdt_ref += time_offsets[station_id]/86400.0
+            else:
+                print('Time offset for given station not found!')
 
-                year, month, day, hour, minute, seconds, milliseconds = map(int, [year, month, day, hour, 
-                    minute, seconds, milliseconds])
+        # Get the station data
+        if station_id in stations:
+            lat, lon, height = stations[station_id]
+        else:
+            print('ERROR! No info for station ', station_id, ' found in CameraSites.txt file!')
+            print('Exiting...')
+            break
 
-                # Calculate the reference JD time
-                jdt_ref = date2JD(year, month, day, hour, minute, seconds, milliseconds)
-                continue
+        # Init a new meteor observation
+        current_meteor = MeteorObservation(jdt_ref, station_id, lat, lon, height, fps, ff_name=ff_name)
 
-            if cal_name:
-                cal_name = False
-                # Mark that the next line is the meteor header
-                meteor_header = True
-                continue
-
-            if meteor_header:
-                meteor_header = False
-                line = line.split()
-
-                # Get the station ID and the FPS from the meteor header
-                station_id = line[0].strip()
-                fps = float(line[3])
-
-                # Try converting station ID to integer
-                try:
-                    station_id = int(station_id)
-                except:
-                    pass
-
-                # If the time offsets were given, apply the correction to the JD
-                if time_offsets is not None:
-                    if station_id in time_offsets:
-                        print('Applying time offset for station {:s} of {:.2f} s'.format(str(station_id),
-                            time_offsets[station_id]))
-
-                        jdt_ref += time_offsets[station_id]/86400.0
-                    else:
-                        print('Time offset for given station not found!')
-
-                # Get the station data
-                if station_id in stations:
-                    lat, lon, height = stations[station_id]
-                else:
-                    print('ERROR! No info for station ', station_id, ' found in CameraSites.txt file!')
-                    print('Exiting...')
-                    break
-                # Init a new meteor observation
-                current_meteor = MeteorObservation(jdt_ref, station_id, lat, lon, height, fps,
-                    ff_name=ff_name)
-                continue
+        # Add the measurement points to the meteor. Missing or infinite magnitudes are stored as None
+        for frame_n, x, y, ra, dec, azim, elev, _, mag in ftp.meteor(i).tolist():
+            if not np.isfinite(mag):
+                mag = None
+            current_meteor.addPoint(frame_n, x, y, azim, elev, ra, dec, mag)
 
-            # Read in the meteor observation point
-            if (current_meteor is not None) and (not bin_name) and (not cal_name) and (not meteor_header):
-
-                line = line.replace('\n', '').split()
-
-                # Read in the meteor frame, RA and Dec
-                frame_n = float(line[0])
-                x = float(line[1])
-                y = float(line[2])
-                ra = float(line[3])
-                dec = float(line[4])
-                azim = float(line[5])
-                elev = float(line[6])
-
-                # Read the visual magnitude, if present
-                if len(line) > 8:
-                    mag = line[8]
-                    if mag == 'inf':
-                        mag = None
-                    else:
-                        mag = float(mag)
-                else:
-                    mag = None
-
-                # Add the measurement point to the current meteor 
-                current_meteor.addPoint(frame_n, x, y, azim, elev, ra, dec, mag)
-
-        # Add the last meteor the the meteor list
-        if current_meteor is not None:
-            current_meteor.finish()
-            meteor_list.append(current_meteor)
+        current_meteor.finish()
+        meteor_list.append(current_meteor)
 
     # Concatenate observations across different FF files ###
     if join_broken_meteors:
@@ -3,20 +3,21 @@
 from __future__ import absolute_import, division, print_function
 
 import copy
-import datetime
 import os
+from collections import OrderedDict
 import numpy as np
 
 
 from supportFuncs import datetime2JD, cartesianToPolar, jd2SolLonSteyaert
 from supportFuncs import greatCircle, fitGreatCircle, greatCirclePhase
-from supportFuncs import filenameToDatetime, readFTPdetectinfo, vectNorm
+from supportFuncs import filenameToDatetime, vectNorm
 
 from supportFuncs import raDec2AltAz, vector2RaDec, raDec2Vector
-from supportFuncs import angularSeparation, angularSeparationVect, isAngleBetween
+from supportFuncs import angularSeparation, angularSeparationVect
 from supportFuncs import EARTH_CONSTANTS
 
-from Showers import loadShowers, Shower
+from Showers import loadShowers, Shower, showerActivityIndex
+from ftpDetectReader import readFTPdetectinfoColumnar
 
 
 EARTH = EARTH_CONSTANTS()
@@ -78,7 +79,10 @@ class MeteorSingleStation(object):
 
 
     def fitGC(self):
-        """ Fits great circle to observations. """
+        """ Fits great circle to observations. The fit is only done once per meteor, later calls reuse it. """
+
+        if self.normal is not None:
+            return
 
         self.cartesian_points = []
 
@@ -215,13 +219,13 @@ def heightModel(v_init, ht_type='beg'):
         data.
 
     Arguments:
-        v_init: [float] Meteor initial velocity (m/s).
+        v_init: [float or ndarray] Meteor initial velocity (m/s).
 
     Keyword arguments:
         ht_type: [str] 'beg' or 'end'
 
     Return:
-        ht: [float] Height (m).
+        ht: [float or ndarray] Height (m).
 
     """
 
@@ -229,8 +233,8 @@ def heightModel(v_init, ht_type='beg'):
         return c + a*v_init + b/(v_init**3)
 
 
-    # Convert velocity to km/s
-    v_init /= 1000
+    # Convert velocity to km/s (without changing the caller's value, which may be an array)
+    v_init = v_init/1000
 
     if ht_type.lower() == 'beg':
 
@@ -331,175 +335,368 @@ def estimateMeteorHeight(config, meteor_obj, shower):
 
 
 
-def showerAssociation(config, ftpdetectinfo_path):
-    """ Do single station shower association based on radiant direction and height. 
-    
+def prepareMeteors(config, ftp):
+    """ Build a fitted MeteorSingleStation object for every meteor in a parsed FTPdetectinfo file. 
+
     Arguments:
         config: [Config instance]
-        ftpdetectinfo_list: [list] A list of paths to FTPdetectinfo files.
+        ftp: [FTPdetectinfoColumns] The FTPdetectinfo file as returned by readFTPdetectinfoColumnar.
 
     Return:
-        - associations: [dict] A dictionary where the FF name and the meteor ordinal number on the FF
-            file are keys, and the associated Shower object are values.
+        meteor_objs: [list] A list of (ff_name, meteor_No, meteor_obj) tuples, one per usable meteor. The
+            great circle is fitted once here and reused by every shower tested against the meteor.
     """
 
-    shower_table = loadShowers(config.shower_path, config.shower_file_name)
-    shower_list = [Shower(shower_entry) for shower_entry in shower_table]
-
-    # Load FTPdetectinfos
-    meteor_data = readFTPdetectinfo(*os.path.split(ftpdetectinfo_path))
-
-    if not len(meteor_data):
-        return {}, []
-
-
-    # Dictionary which holds FF names as keys and meteor measurements + associated showers as values
-    associations = {}
+    meteor_objs = []
 
-    for meteor in meteor_data:
+    for i, ff_name in enumerate(ftp.ff_names):
 
-        ff_name, cam_code, meteor_No, _, fps, _, _, _, _, _, _, meteor_meas = meteor
+        meteor_No, _, fps = ftp.header[i].tolist()[:3]
+        meteor_meas = ftp.meteor(i)
 
         # Skip very short meteors
         if len(meteor_meas) < 4:
             continue
 
         # Check if the data is calibrated
-        if not meteor_meas[0][0]:
+        if not ftp.calib_status[i]:
             print('Data is not calibrated! Meteors cannot be associated to showers!')
             break
 
 
         # Init container for meteor observation
-        meteor_obj = MeteorSingleStation(cam_code, config.latitude, config.longitude, ff_name)
-
-        # Infill the meteor structure
-        for entry in meteor_meas:
-            
-            _, frame_n, _, _, ra, dec, _, _, _, mag = entry
+        meteor_obj = MeteorSingleStation(ftp.cam_code, config.latitude, config.longitude, ff_name)
 
-            # Compute the Julian data of every point
-            jd = datetime2JD(filenameToDatetime(ff_name) + datetime.timedelta(seconds=float(frame_n)/fps))
+        # Infill the meteor structure, computing the Julian date of every point from the FF file time
+        jd_ff = datetime2JD(filenameToDatetime(ff_name))
+        meteor_obj.jd_array = jd_ff + meteor_meas[:, 0]/fps/86400.0
+        meteor_obj.ra_array = meteor_meas[:, 3]
+        meteor_obj.dec_array = meteor_meas[:, 4]
+        meteor_obj.mag_array = meteor_meas[:, 8]
 
-            meteor_obj.addPoint(jd, ra, dec, mag)
-
-            
         # Fit the great circle and compute the geometrical parameters
         meteor_obj.fitGC()
 
+        meteor_objs.append((ff_name, meteor_No, meteor_obj))
+
+    return meteor_objs
 
-        # Skip all meteors with beginning heights below 15 deg
-        if meteor_obj.beg_alt < 15:
-            continue
 
-        
-        # Go through all showers in the list and find the best match
-        best_match_shower = None
-        best_match_dist = np.inf
-        #print(f'meteor {meteor_obj.ff_name} {meteor_obj.jdt_ref} {meteor_obj.lasun} {meteor_obj.radiant_ra} {meteor_obj.radiant_dec}')
-        #print('==============')
-        for shower in shower_list:
-            #print(f'{shower.name}')
-            ### Solar longitude filter
-            # If the shower doesn't have a stated beginning or end, check if the meteor is within a preset
-            # threshold solar longitude difference
-            if np.any(np.isnan([shower.lasun_beg, shower.lasun_end])):
 
-                shower.lasun_beg = (shower.lasun_max - config.shower_lasun_threshold) % 360
-                shower.lasun_end = (shower.lasun_max + config.shower_lasun_threshold) % 360
 
-            # Filter out all showers which are not active    
-            if not isAngleBetween(np.radians(shower.lasun_beg), np.radians(meteor_obj.lasun), np.radians(shower.lasun_end)):
-                continue
+def _raDec2UnitVectors(ra, dec):
+    """ Vectorised raDec2Vector. Takes arrays of angles in degrees and returns an array of unit vectors 
+        with the X, Y, Z components along the last axis. 
+    """
 
-            ### ###
+    ra = np.radians(ra)
+    dec = np.radians(dec)
 
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)], axis=-1)
 
-            ### Radiant filter ###
 
-            # Assume a fixed meteor height for an approximate apparent radiant
-            meteor_fixed_ht = 100000 # 100 km
-            shower.computeApparentRadiant(config.latitude, config.longitude, meteor_obj.jdt_ref, 
-                meteor_fixed_ht=meteor_fixed_ht)
-            #print(f'shower ra/dec {shower.ra} {shower.dec}')
-            # Compute the angle between the meteor radiant and the great circle normal
-            radiant_separation = meteor_obj.angularSeparationFromGC(shower.ra, shower.dec)
-            #print(f'radiant separation {radiant_separation}')
 
-            # Make sure the meteor is within the radiant distance threshold
-            if radiant_separation > config.shower_max_radiant_separation:
-                continue
+def _wrapPositive(ang):
+    """ Move angles in the (-2pi, 0) range into (0, 2pi), as isAngleBetween does. """
 
+    return np.where(ang < 0, ang + 2*np.pi, ang)
 
-            # Compute angle between the meteor's beginning and end, and the shower radiant
-            shower.radiant_vector = vectNorm(raDec2Vector(shower.ra, shower.dec))
-            begin_separation = np.degrees(angularSeparationVect(shower.radiant_vector,
-                meteor_obj.meteor_begin_cartesian))
-            end_separation = np.degrees(angularSeparationVect(shower.radiant_vector,
-                meteor_obj.meteor_end_cartesian))
 
-            #print(f'separations {begin_separation} {end_separation}')
-            # Make sure the beginning of the meteor is closer to the radiant than it's end
-            if begin_separation > end_separation:
-                continue
 
-            ### ###
+class ApparentRadiantCache(object):
+    def __init__(self, time_step=300, max_size=20000, meteor_fixed_ht=100000):
+        """ Memoises the apparent radiants of showers for a station and time bucket. 
 
+        Apparent radiants change slowly and the station doesn't move, so for all the meteors in one 
+        FTPdetectinfo file the radiant of each active shower only needs computing once per time bucket.
 
-            ### Height filter ###
+        Keyword arguments:
+            time_step: [float] Width of a time bucket in seconds. Radiants are computed at the centre of the
+                bucket. Zero disables the bucketing and computes the radiant at the exact time. 
+            max_size: [int] Maximum number of entries kept. The least recently used are dropped first.
+            meteor_fixed_ht: [float] Assumed height of the meteor (m). 100 km by default.
+        """
 
-            # Estimate the limiting meteor height from the velocity (meters)
-            filter_beg_ht = heightModel(shower.v_init, ht_type='beg')
-            filter_end_ht = heightModel(shower.v_init, ht_type='end')
+        self.time_step = time_step
+        self.max_size = max_size
+        self.meteor_fixed_ht = meteor_fixed_ht
 
+        self.hits = 0
+        self.misses = 0
 
-            ### Estimate the meteor beginning height with +/- 1 frame, otherwise some short meteor may get
-            ###   rejected
+        self._cache = OrderedDict()
 
-            meteor_obj_orig = copy.deepcopy(meteor_obj)
 
-            # Shorter
-            meteor_obj_m1 = copy.deepcopy(meteor_obj_orig)
-            meteor_obj_m1.duration -= 1.0/config.fps
-            meteor_ht_m1 = np.mean(estimateMeteorHeight(config, meteor_obj_m1, shower))
 
-            # Nominal
-            meteor_ht = np.mean(estimateMeteorHeight(config, meteor_obj_orig, shower))
+    def bucketJD(self, jd):
+        """ Return the bucket key and the Julian date at which radiants in that bucket are computed. """
 
-            # Longer
-            meteor_obj_p1 = copy.deepcopy(meteor_obj_orig)
-            meteor_obj_p1.duration += 1.0/config.fps
-            meteor_ht_p1 = np.mean(estimateMeteorHeight(config, meteor_obj_p1, shower))
+        if not self.time_step:
+            return jd, jd
+
+        bucket = int(np.floor(jd*86400.0/self.time_step))
+
+        return bucket, (bucket + 0.5)*self.time_step/86400.0
+
+
+
+    def get(self, shower, latitude, longitude, jd):
+        """ Get the apparent radiant of a shower.
+
+        Arguments:
+            shower: [Shower instance]
+            latitude: [float] Latitude of the observer (deg).
+            longitude: [float] Longitude of the observer (deg).
+            jd: [float] Julian date.
+
+        Return:
+            (ra, dec, v_init, radiant_vector, filter_beg_ht, filter_end_ht): [tuple] Apparent radiant (deg),
+                velocity (m/s), radiant unit vector and the limiting begin and end heights from heightModel (m).
+        """
+
+        bucket, jd_bucket = self.bucketJD(jd)
+        key = (shower.iau_code, latitude, longitude, bucket)
+
+        entry = self._cache.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        ra, dec, v_init = shower.computeApparentRadiant(latitude, longitude, jd_bucket, 
+            meteor_fixed_ht=self.meteor_fixed_ht)
+        entry = (ra, dec, v_init, vectNorm(np.array(raDec2Vector(ra, dec))), 
+            heightModel(v_init, ht_type='beg'), heightModel(v_init, ht_type='end'))
+
+        self._cache[key] = entry
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+        return entry
+
+
+
+# Kept at module level so warm Lambda containers reuse it
+RADIANT_CACHE = None
+
+
+def getRadiantCache(config):
+    """ Return the module's radiant cache, creating it if the config asks for different settings. """
+
+    global RADIANT_CACHE
+
+    if RADIANT_CACHE is None or RADIANT_CACHE.time_step != config.shower_radiant_time_step \
+            or RADIANT_CACHE.max_size != config.shower_radiant_cache_size:
+        RADIANT_CACHE = ApparentRadiantCache(config.shower_radiant_time_step, 
+            config.shower_radiant_cache_size)
+
+    return RADIANT_CACHE
+
+
+
+
+def associateBatch(config, meteor_objs, shower_list, radiant_cache=None):
+    """ Find the best matching shower for many meteors from one station at once. 
+
+    The filters are the same as those originally applied one meteor and one shower at a time, but are
+    evaluated over a (meteors x showers) matrix, so only the apparent radiant is computed per pair.
+
+    Arguments:
+        config: [Config instance]
+        meteor_objs: [list] Fitted MeteorSingleStation objects.
+        shower_list: [list] Shower objects.
+
+    Keyword arguments:
+        radiant_cache: [ApparentRadiantCache] Cache of apparent radiants. The module's cache is used if
+            not given.
+
+    Return:
+        best_showers: [list] For each meteor, a copy of the best matching Shower with its apparent radiant
+            filled in, or None if there is no match.
+    """
 
+    n_met = len(meteor_objs)
+    if n_met == 0 or len(shower_list) == 0:
+        return [None]*n_met
 
-            meteor_obj = meteor_obj_orig
 
+    ### Meteor geometry, one row per meteor ###
 
-            ### ###
-            #print(f'meteor heights {meteor_ht_m1} {meteor_ht} {meteor_ht_p1}')
+    jdt_ref = np.array([met.jdt_ref for met in meteor_objs])
+    lasun = np.array([met.lasun for met in meteor_objs])
+    duration = np.array([met.duration for met in meteor_objs])
+    beg_alt = np.array([met.beg_alt for met in meteor_objs])
+    end_alt = np.array([met.end_alt for met in meteor_objs])
+    normal_ra = np.array([met.normal_ra for met in meteor_objs])
+    normal_dec = np.array([met.normal_dec for met in meteor_objs])
+    beg_cart = np.array([met.meteor_begin_cartesian for met in meteor_objs])
+    end_cart = np.array([met.meteor_end_cartesian for met in meteor_objs])
 
-            # If all heights (even those with +/- 1 frame) are outside the height range, reject the meteor
-            if ((meteor_ht_p1 < filter_end_ht) or (meteor_ht_p1 > filter_beg_ht)) and \
-                    ((meteor_ht < filter_end_ht) or (meteor_ht > filter_beg_ht)) and \
-                    ((meteor_ht_m1 < filter_end_ht) or (meteor_ht_m1 > filter_beg_ht)):
+    # Beginning and end points in alt/az, at the reference time, as used by the height estimate
+    beg_horiz = []
+    end_horiz = []
+    for met in meteor_objs:
+        beg_ra, beg_dec = vector2RaDec(met.beg_vect)
+        end_ra, end_dec = vector2RaDec(met.end_vect)
+        beg_horiz.append(raDec2Vector(*raDec2AltAz(beg_ra, beg_dec, met.jdt_ref, met.lat, met.lon)))
+        end_horiz.append(raDec2Vector(*raDec2AltAz(end_ra, end_dec, met.jdt_ref, met.lat, met.lon)))
+    beg_horiz = np.array(beg_horiz)/np.linalg.norm(beg_horiz, axis=1)[:, None]
+    end_horiz = np.array(end_horiz)/np.linalg.norm(end_horiz, axis=1)[:, None]
 
-                continue
 
-            ### ###
+    ### Solar longitude filter ###
 
+    # Only keep the showers which the index says may be active for at least one of the meteors
+    shower_index = showerActivityIndex(shower_list, config.shower_lasun_threshold)
+    shower_ids = np.unique(np.concatenate([shower_index.candidates(ls) for ls in lasun]))
+    if len(shower_ids) == 0:
+        return [None]*n_met
 
-            # Compute the radiant elevation above the horizon
-            shower.azim, shower.elev = raDec2AltAz(shower.ra, shower.dec, meteor_obj.jdt_ref,
-                config.latitude, config.longitude)
+    shower_list = [shower_list[s] for s in shower_ids]
+    lasun_beg = shower_index.lasun_beg[shower_ids]
+    lasun_end = shower_index.lasun_end[shower_ids]
 
+    # Filter out all showers which are not active
+    window = _wrapPositive(np.radians(lasun_end) - np.radians(lasun_beg))
+    offset = _wrapPositive(np.radians(lasun)[:, None] - np.radians(lasun_beg)[None, :])
+    active = offset < window
 
-            # Take the shower that's closest to the great circle if there are multiple candidates
-            if radiant_separation < best_match_dist:
-                #print('selecting new shower')
-                best_match_dist = radiant_separation
-                best_match_shower = copy.deepcopy(shower)
 
-        # Store the associated shower
+    ### Apparent radiants, only for the active pairs ###
+
+    if radiant_cache is None:
+        radiant_cache = getRadiantCache(config)
+
+    rad_ra = np.full(active.shape, np.nan)
+    rad_dec = np.full(active.shape, np.nan)
+    v_init = np.full(active.shape, np.nan)
+    radiant_vector = np.full(active.shape + (3,), np.nan)
+    filter_beg_ht = np.full(active.shape, np.nan)
+    filter_end_ht = np.full(active.shape, np.nan)
+    for m, s in zip(*np.nonzero(active)):
+        rad_ra[m, s], rad_dec[m, s], v_init[m, s], radiant_vector[m, s], filter_beg_ht[m, s], \
+            filter_end_ht[m, s] = radiant_cache.get(shower_list[s], config.latitude, config.longitude, 
+                jdt_ref[m])
+
+
+    ### Radiant filter ###
+
+    # Compute the angle between the meteor radiant and the great circle normal
+    with np.errstate(invalid='ignore'):
+        radiant_separation = np.degrees(np.abs(np.pi/2 - angularSeparation(np.radians(rad_ra), 
+            np.radians(rad_dec), np.radians(normal_ra)[:, None], np.radians(normal_dec)[:, None])))
+
+        # Compute angle between the meteor's beginning and end, and the shower radiant
+        begin_separation = np.arccos(np.einsum('msk,mk->ms', radiant_vector, beg_cart))
+        end_separation = np.arccos(np.einsum('msk,mk->ms', radiant_vector, end_cart))
+
+    # Make sure the meteor is within the radiant distance threshold, and that the beginning of the meteor 
+    # is closer to the radiant than its end
+    candidate = active & (radiant_separation <= config.shower_max_radiant_separation) \
+        & (begin_separation <= end_separation)
+
+
+    ### Height filter, see estimateMeteorHeight ###
+
+    radiant_azim, radiant_alt = raDec2AltAz(rad_ra, rad_dec, jdt_ref[:, None], config.latitude, 
+        config.longitude)
+    radiant_horiz = _raDec2UnitVectors(radiant_azim, radiant_alt)
+
+    # Get distance from Earth's centre to the position given by geographical coordinates for the 
+    #   observer's latitude, and from there to the station
+    earth_radius = EARTH.EQUATORIAL_RADIUS/np.sqrt(1.0 - (EARTH.E**2)*np.sin(np.radians(config.latitude))**2)
+    re_dist = earth_radius + config.elevation
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        theta_met = np.arccos(np.einsum('mk,mk->m', beg_horiz, end_horiz))[:, None]
+        theta_beg = np.arccos(np.einsum('msk,mk->ms', radiant_horiz, -end_horiz))
+        theta_end = np.arccos(np.einsum('msk,mk->ms', -radiant_horiz, -beg_horiz))
+
+        # Estimate the meteor height with +/- 1 frame, otherwise some short meteor may get rejected
+        height_ok = np.zeros(active.shape, dtype=bool)
+        for frame_diff in (-1.0/config.fps, 0, 1.0/config.fps):
+
+            dist = v_init*(duration + frame_diff)[:, None]
+            dist_beg = dist*np.sin(theta_beg)/np.sin(theta_met)
+            dist_end = dist*np.sin(theta_end)/np.sin(theta_met)
+
+            # Compute the heights of the begin and end points using the law of cosines
+            ht_b = np.abs(np.sqrt(dist_beg**2 + re_dist**2 - 2*dist_beg*re_dist*np.cos(np.radians(90 
+                + beg_alt))[:, None]) - earth_radius)
+            ht_e = np.abs(np.sqrt(dist_end**2 + re_dist**2 - 2*dist_end*re_dist*np.cos(np.radians(90 
+                + end_alt))[:, None]) - earth_radius)
+            meteor_ht = (ht_b + ht_e)/2
+
+            # Reject the pairing if the radiant is below the horizon
+            meteor_ht = np.where(radiant_alt < 0, -1, meteor_ht)
+
+            height_ok |= ~((meteor_ht < filter_end_ht) | (meteor_ht > filter_beg_ht))
+
+    candidate &= height_ok
+
+
+    ### Take the shower that's closest to the great circle if there are multiple candidates ###
+
+    best_showers = []
+    best_idx = np.argmin(np.where(candidate, radiant_separation, np.inf), axis=1)
+    for m, s in enumerate(best_idx):
+
+        if not candidate[m, s]:
+            best_showers.append(None)
+            continue
+
+        shower = copy.copy(shower_list[s])
+        shower.ra, shower.dec, shower.v_init = rad_ra[m, s], rad_dec[m, s], v_init[m, s]
+        shower.radiant_vector = radiant_vector[m, s]
+
+        # Compute the radiant elevation above the horizon
+        shower.azim, shower.elev = raDec2AltAz(shower.ra, shower.dec, jdt_ref[m], config.latitude, 
+            config.longitude)
+
+        best_showers.append(shower)
+
+    return best_showers
+
+
+
+
+def showerAssociation(config, ftpdetectinfo_path=None, meteor_data=None):
+    """ Do single station shower association based on radiant direction and height. 
+    
+    Arguments:
+        config: [Config instance]
+        ftpdetectinfo_path: [str] Path to the FTPdetectinfo file.
+
+    Keyword arguments:
+        meteor_data: [FTPdetectinfoColumns] The FTPdetectinfo file already read with 
+            readFTPdetectinfoColumnar. If given, the file is not read again.
+
+    Return:
+        - associations: [dict] A dictionary where the FF name and the meteor ordinal number on the FF
+            file are keys, and the associated Shower object are values.
+    """
+
+    shower_table = loadShowers(config.shower_path, config.shower_file_name)
+    shower_list = [Shower(shower_entry) for shower_entry in shower_table]
+
+    # Load FTPdetectinfos, unless the caller has already done so
+    if meteor_data is None:
+        meteor_data = readFTPdetectinfoColumnar(*os.path.split(ftpdetectinfo_path))
+
+    if not len(meteor_data):
+        return {}, []
+
+
+    # Skip all meteors with beginning heights below 15 deg
+    meteor_objs = [(ff_name, meteor_No, meteor_obj) for ff_name, meteor_No, meteor_obj 
+        in prepareMeteors(config, meteor_data) if meteor_obj.beg_alt >= 15]
+
+    best_showers = associateBatch(config, [meteor_obj for _, _, meteor_obj in meteor_objs], shower_list)
+
+    # Dictionary which holds FF names as keys and meteor measurements + associated showers as values
+    associations = {}
+    for (ff_name, meteor_No, meteor_obj), best_match_shower in zip(meteor_objs, best_showers):
         associations[(ff_name, meteor_No)] = [meteor_obj, best_match_shower]
 
 
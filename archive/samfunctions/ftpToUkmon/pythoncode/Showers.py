@@ -164,6 +164,81 @@ class Shower(object):
         return zhr
 
 
+class SolarLongitudeIndex(object):
+    def __init__(self, lasun_beg, lasun_end=None, bucket_width=1.0):
+        """ Index of table rows by solar longitude, so that only the rows which may be active at a given
+            solar longitude need to be looked at. Windows which wrap through 0/360 are handled.
+
+        NB: the same index is used by ukmon_pylib/traj/ShowerAssociation.py. Keep them in step.
+
+        Arguments:
+            lasun_beg: [ndarray] Start of each row's solar longitude window (deg).
+
+        Keyword arguments:
+            lasun_end: [ndarray] End of each row's window (deg). If None, each row is a single solar
+                longitude.
+            bucket_width: [float] Width of the index buckets (deg).
+        """
+
+        self.lasun_beg = np.asarray(lasun_beg, dtype=np.float64) % 360
+        if lasun_end is None:
+            self.lasun_end = self.lasun_beg
+        else:
+            self.lasun_end = np.asarray(lasun_end, dtype=np.float64) % 360
+
+        self.bucket_width = bucket_width
+        self.n_buckets = int(np.ceil(360.0/bucket_width))
+
+        # Put each row into every bucket its window touches
+        buckets = [[] for _ in range(self.n_buckets)]
+        first = np.floor(self.lasun_beg/bucket_width).astype(int)
+        span = np.floor(((self.lasun_beg % bucket_width) 
+            + (self.lasun_end - self.lasun_beg) % 360)/bucket_width).astype(int) + 1
+        for row, (b, n) in enumerate(zip(first, np.minimum(span, self.n_buckets))):
+            for i in range(b, b + n):
+                buckets[i % self.n_buckets].append(row)
+
+        self._buckets = [np.array(rows, dtype=np.int64) for rows in buckets]
+
+
+    def candidates(self, la_sun, margin=0.0):
+        """ Return the rows whose windows may include la_sun +/- margin (deg). The caller must still
+            check the rows exactly, since whole buckets are returned.
+        """
+
+        b_lo = int(np.floor((la_sun - margin)/self.bucket_width))
+        b_hi = int(np.floor((la_sun + margin)/self.bucket_width))
+
+        if b_hi - b_lo + 1 >= self.n_buckets:
+            return np.arange(len(self.lasun_beg))
+
+        return np.unique(np.concatenate([self._buckets[b % self.n_buckets] for b in range(b_lo, b_hi + 1)]))
+
+
+
+def showerActivityIndex(shower_list, lasun_threshold):
+    """ Build a SolarLongitudeIndex of the activity windows of the given showers. 
+
+    Arguments:
+        shower_list: [list] Shower objects.
+        lasun_threshold: [float] Showers without a stated beginning or end are taken as active within this
+            many degrees of their peak.
+
+    Return:
+        [SolarLongitudeIndex]
+    """
+
+    lasun_max = np.array([shower.lasun_max for shower in shower_list])
+    lasun_beg = np.array([shower.lasun_beg for shower in shower_list])
+    lasun_end = np.array([shower.lasun_end for shower in shower_list])
+
+    no_window = np.isnan(lasun_beg) | np.isnan(lasun_end)
+    lasun_beg = np.where(no_window, (lasun_max - lasun_threshold) % 360, lasun_beg)
+    lasun_end = np.where(no_window, (lasun_max + lasun_threshold) % 360, lasun_end)
+
+    return SolarLongitudeIndex(lasun_beg, lasun_end)
+
+
 def loadShowers(dir_path, file_name):
     """ Loads the given shower CSV file. """
 
@@ -0,0 +1,111 @@
+#
+# Columnar reader for CAMS format FTPdetectinfo files
+# Copyright (C) 2018-2023 Mark McIntyre
+#
+# NB: an identical copy of this file lives in samfunctions/fetchECSV. Keep them in step.
+#
+
+import os
+import numpy as np
+
+
+# column order of the per-meteor header and of the measurement array
+HEADER_COLUMNS = ['meteor_No', 'n_segments', 'fps', 'hnr', 'mle', 'binn', 'px_fm', 'rho', 'phi']
+MEAS_COLUMNS = ['frame_n', 'x', 'y', 'ra', 'dec', 'azim', 'elev', 'inten', 'mag']
+
+METEOR_SEPARATOR = '-------------------------------------------------------'
+
+
+class FTPdetectinfoColumns(object):
+    """ The contents of an FTPdetectinfo file held as numpy arrays.
+
+    Attributes:
+        cam_code: [str] Camera code, taken from the last meteor header.
+        ff_names: [list] Name of the FF file for each meteor.
+        calib_status: [ndarray] 1 if the meteor is calibrated, 0 if not, one entry per meteor.
+        header: [ndarray] (meteors x 9) float64 array of HEADER_COLUMNS.
+        meas: [ndarray] (points x 9) float64 array of MEAS_COLUMNS for every meteor in the file.
+        offsets: [ndarray] Meteor i's measurements are meas[offsets[i]:offsets[i+1]].
+    """
+    def __init__(self, cam_code, ff_names, calib_status, header, meas, offsets):
+        self.cam_code = cam_code
+        self.ff_names = ff_names
+        self.calib_status = calib_status
+        self.header = header
+        self.meas = meas
+        self.offsets = offsets
+
+
+    def __len__(self):
+        return len(self.ff_names)
+
+
+    def meteor(self, i):
+        """ Return a view of the measurements of the i-th meteor. """
+        return self.meas[self.offsets[i]:self.offsets[i + 1]]
+
+
+def _parseMeasurements(meas_lines):
+    """ Convert measurement lines into an (n x 9) float64 array. Files written without magnitudes only
+        have eight columns, in which case the magnitude is set to NaN.
+    """
+    if len(meas_lines) == 0:
+        return np.empty((0, len(MEAS_COLUMNS)), dtype=np.float64)
+
+    try:
+        # numpy's C parser is much quicker than splitting and converting each line in python
+        return np.loadtxt(meas_lines, dtype=np.float64, usecols=range(len(MEAS_COLUMNS)), ndmin=2)
+    except (ValueError, IndexError):
+        rows = [li.split() for li in meas_lines]
+        rows = [row[:9] if len(row) > 8 else row[:8] + ['nan'] for row in rows]
+        return np.array(rows, dtype=np.float64)
+
+
+def readFTPdetectinfoColumnar(ff_directory, file_name, skip_nan=True):
+    """ Read a CAMS format FTPdetectinfo file into a FTPdetectinfoColumns object.
+
+    Arguments:
+        ff_directory: [str] Directory where the FTPdetectinfo file is.
+        file_name: [str] Name of the FTPdetectinfo file.
+
+    Keyword arguments:
+        skip_nan: [bool] Drop measurements whose centroids are NaN. True by default.
+
+    Return:
+        [FTPdetectinfoColumns]
+    """
+    with open(os.path.join(ff_directory, file_name)) as f:
+        # Skip the header, comments and blank lines
+        lines = [li for li in f.read().splitlines()[11:] if li.strip() and not li.startswith('#')]
+
+    starts = [i for i, li in enumerate(lines) if METEOR_SEPARATOR in li]
+    starts.append(len(lines))
+
+    cam_code = None
+    ff_names = []
+    calib_status = []
+    header = []
+    meas_lines = []
+    offsets = [0]
+
+    for beg, end in zip(starts[:-1], starts[1:]):
+        if end - beg < 4:
+            continue
+        block = lines[beg + 4:end]
+        if skip_nan:
+            block = [li for li in block if '00nan' not in li]
+        hdr = lines[beg + 3].split()
+        cam_code = hdr[0]
+        if not block:
+            continue
+
+        ff_names.append(lines[beg + 1])
+        # as in RMS's reader, the status is taken from the line that opens the block
+        calib_status.append(0 if 'Uncalibrated' in lines[beg] else 1)
+        header.append(hdr[1:10])
+        meas_lines.extend(block)
+        offsets.append(len(meas_lines))
+
+    return FTPdetectinfoColumns(cam_code, ff_names, np.array(calib_status, dtype=np.int64),
+        np.array(header, dtype=np.float64).reshape(-1, len(HEADER_COLUMNS)),
+        _parseMeasurements(meas_lines), np.array(offsets, dtype=np.int64))
@@ -14,7 +14,9 @@ import numpy as np
 
 from supportFuncs import datetime2JD, altAz2RADec, polarToCartesian, cartesianToPolar
 from supportFuncs import angularSeparation, greatCircle, fitGreatCircle, greatCirclePhase
-from supportFuncs import filenameToDatetime, readFTPdetectinfo, loadConfigFromDirectory
+from supportFuncs import filenameToDatetime, loadConfigFromDirectory
+from ftpDetectReader import readFTPdetectinfoColumnar
+from imageManifest import getManifestStore, addToManifests
 
 
 from ShowerAssociation import showerAssociation
@@ -84,6 +86,8 @@ def FTPdetectinfo2UkmdaCsv(dir_path):
         dir_path: [str] Path of the directory which contains the FTPdetectinfo file.
         out_path: [str] Path of the directory to save the results into
 
+    Return:
+        ftp: [FTPdetectinfoColumns] the meteors read from the FTPdetectinfo file, or None if it couldn't be read.
     """
     # Load the FTPdetectinfo file
 
@@ -113,11 +117,11 @@ def FTPdetectinfo2UkmdaCsv(dir_path):
 
     # Load the FTPdetectinfo file
     try:
-        meteor_list = readFTPdetectinfo(dir_path, ftpdetectinfo_name)
+        ftp = readFTPdetectinfoColumnar(dir_path, ftpdetectinfo_name)
     except Exception:
         print(f'Malformed FTPdetect file {ftpdetectinfo_name}') 
         return 
-    if len(meteor_list) == 0:
+    if len(ftp) == 0:
         print(f'Ignoring {ftpdetectinfo_name} as no meteors')
         return
     
@@ -131,19 +135,19 @@ def FTPdetectinfo2UkmdaCsv(dir_path):
         config.latitude = pp1['lat']
         config.longitude = pp1['lon']
         config.elevation = pp1['elev']
-        # get the shower associations
-        shwrs = showerAssociation(config, os.path.join(dir_path,ftpdetectinfo_name))
+        # get the shower associations, reusing the meteors already read from the FTPdetectinfo
+        shwrs = showerAssociation(config, os.path.join(dir_path,ftpdetectinfo_name), meteor_data=ftp)
     else:
         print(f'Ignoring {ftpdetectinfo_name} as platepar file empty')
-        return 
+        return ftp
     # Init the UFO format list
     ufo_meteor_list = []
 
     # Go through every meteor in the list
-    for meteor in meteor_list:
+    for i, ff_name in enumerate(ftp.ff_names):
 
-        ff_name, cam_code, meteor_No, n_segments, fps, hnr, mle, binn, px_fm, rho, phi, \
-            meteor_meas = meteor
+        cam_code = ftp.cam_code
+        meteor_No, _, fps = ftp.header[i].tolist()[:3]
 
         # Load the platepar from the platepar dictionary
         if ff_name in platepars_recalibrated_dict:
@@ -166,11 +170,11 @@ def FTPdetectinfo2UkmdaCsv(dir_path):
             shwr='spo'
 
         # Extract measurements
-        calib_status, frame_n, x, y, ra, dec, azim, elev, inten, mag = np.array(meteor_meas).T
+        frame_n, x, y, ra, dec, azim, elev, inten, mag = ftp.meteor(i).T
 
         # If the meteor wasn't calibrated, skip it
-        if not np.all(calib_status):
-            print('Meteor {:d} was not calibrated, skipping it...'.format(meteor_No))
+        if not ftp.calib_status[i]:
+            print('Meteor {:d} was not calibrated, skipping it...'.format(int(meteor_No)))
             continue
 
         # Compute the peak magnitude
@@ -230,6 +234,7 @@ def FTPdetectinfo2UkmdaCsv(dir_path):
 
     # Write the ukmda-specific output file
     writeUkmdaCsv(dir_path, ufo_file_name, ufo_meteor_list)
+    return ftp
 
 
 def addRowCamTimings(s3bucket, s3object):
@@ -318,7 +323,15 @@ def ftpToUkmda(s3bucket, s3object):
 
     #print('got files')
 
-    FTPdetectinfo2UkmdaCsv(tmpdir)
+    ftp = FTPdetectinfo2UkmdaCsv(tmpdir)
+
+    # record the detections in the nightly image manifest used by getExtraFiles
+    if ftp is not None:
+        try:
+            store = getManifestStore(s3c, s3bucket)
+            addToManifests(store, os.path.split(pth)[1], ftp.ff_names)
+        except Exception as e:
+            print(f'unable to update image manifest for {pth}: {e}')
     rmtree(tmpdir)
     return 0
 
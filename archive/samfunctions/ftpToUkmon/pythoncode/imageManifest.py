@@ -0,0 +1,259 @@
+#
+# Per-night manifest of each station's detections and which of their images have been published
+# Copyright (C) 2018-2023 Mark McIntyre
+#
+# NB: identical copies of this file live in samfunctions/ftpToUkmon and ukmon_pylib/reports. 
+# Keep them in step.
+#
+# A station's manifest for a night is made of parts under
+#   matches/manifests/YYYY/YYYYMM/YYYYMMDD/<station>/
+# ftpToUkmon writes one part per upload folder listing its detections, and the steps that copy
+# jpgs and mp4s to the website write a part listing the keys they published. Parts are never
+# rewritten, so concurrent writers can't lose each other's entries, and they're merged when read.
+#
+# Only published keys are recorded. Callers must still check the website for any image the
+# manifest doesn't list as published, as not every detection gets an mp4 and not every
+# publishing step updates the manifest.
+#
+
+import os
+import sys
+import json
+import uuid
+import datetime
+
+MANIFEST_ROOT = 'matches/manifests'
+
+
+def captureNight(dtstr, tmstr):
+    """ Return the night a detection belongs to, as YYYYMMDD. Detections before 1pm belong to the previous night. """
+    evtdt = datetime.datetime.strptime(f'{dtstr}_{tmstr[:6]}', '%Y%m%d_%H%M%S')
+    if evtdt.hour < 13:
+        evtdt = evtdt + datetime.timedelta(days=-1)
+    return evtdt.strftime('%Y%m%d')
+
+
+def manifestPrefix(stationid, night):
+    return f'{MANIFEST_ROOT}/{night[:4]}/{night[:6]}/{night}/{stationid}/'
+
+
+def normaliseFFName(ffname):
+    ffname = ffname.replace('FR_', 'FF_').replace('.bin', '.fits').replace('.jpg', '.fits').replace('.mp4', '.fits')
+    if 'FF_' not in ffname:
+        ffname = 'FF_' + ffname
+    if '.fits' not in ffname:
+        ffname = ffname + '.fits'
+    return ffname
+
+
+def imageKeys(ffname):
+    """ Return the website keys the jpg and mp4 for an FF file would be published under.
+        Nothing checks that they exist.
+    """
+    ffname = normaliseFFName(ffname)
+    dtstr = ffname.split('_')[2]
+    return {'jpg': f'img/single/{dtstr[:4]}/{dtstr[:6]}/{ffname}'.replace('fits','jpg'),
+        'mp4': f'img/mp4/{dtstr[:4]}/{dtstr[:6]}/{ffname}'.replace('fits','mp4')}
+
+
+def mergeParts(stationid, night, parts):
+    """ Combine the parts of a manifest into one dict. """
+    manifest = {'station': stationid, 'night': night, 'folders': [], 'meteors': {}}
+    for part in parts:
+        if 'folder' in part and part['folder'] not in manifest['folders']:
+            manifest['folders'].append(part['folder'])
+        for ff in part.get('meteors', []):
+            manifest['meteors'].setdefault(ff, {})
+        for ff, keys in part.get('published', {}).items():
+            manifest['meteors'].setdefault(ff, {}).update(keys)
+    return manifest
+
+
+class S3ManifestStore(object):
+    """ Manifests held in an S3 bucket.
+
+    Arguments:
+        s3client: [boto3 client] S3 client.
+        bucket: [str] Bucket name, without the s3:// prefix.
+    """
+    def __init__(self, s3client, bucket):
+        self.s3 = s3client
+        self.bucket = bucket
+        self.cache = {}
+
+    def read(self, stationid, night):
+        """ Return the merged manifest, or None if there are no parts for the station and night. """
+        prefix = manifestPrefix(stationid, night)
+        if prefix not in self.cache:
+            parts = []
+            try:
+                paginator = self.s3.get_paginator('list_objects_v2')
+                for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                    for obj in page.get('Contents', []):
+                        body = self.s3.get_object(Bucket=self.bucket, Key=obj['Key'])['Body'].read()
+                        parts.append(json.loads(body))
+            except Exception as e:
+                print(f'unable to read manifest {prefix}: {e}')
+            self.cache[prefix] = mergeParts(stationid, night, parts) if len(parts) > 0 else None
+        return self.cache[prefix]
+
+    def writePart(self, stationid, night, partname, part):
+        key = manifestPrefix(stationid, night) + partname + '.json'
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=json.dumps(part).encode(),
+            ContentType='application/json')
+        self.cache.pop(manifestPrefix(stationid, night), None)
+
+
+class LocalManifestStore(object):
+    """ Manifests held in a local folder, laid out as in S3. Used for testing.
+
+    Arguments:
+        rootdir: [str] Folder to hold the manifests.
+    """
+    def __init__(self, rootdir):
+        self.rootdir = rootdir
+
+    def read(self, stationid, night):
+        dirname = os.path.join(self.rootdir, manifestPrefix(stationid, night))
+        if not os.path.isdir(dirname):
+            return None
+        parts = []
+        for fname in sorted(os.listdir(dirname)):
+            if fname.endswith('.json'):
+                with open(os.path.join(dirname, fname)) as inf:
+                    parts.append(json.load(inf))
+        return mergeParts(stationid, night, parts) if len(parts) > 0 else None
+
+    def writePart(self, stationid, night, partname, part):
+        fname = os.path.join(self.rootdir, manifestPrefix(stationid, night), partname + '.json')
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname + '.tmp', 'w') as outf:
+            json.dump(part, outf)
+        os.replace(fname + '.tmp', fname)
+
+
+def getManifestStore(s3client, bucket):
+    """ Return the manifest store to use. Setting MANIFESTDIR selects a local folder instead of S3. """
+    localdir = os.getenv('MANIFESTDIR', default=None)
+    if localdir:
+        return LocalManifestStore(localdir)
+    if bucket[:5] == 's3://':
+        bucket = bucket[5:]
+    return S3ManifestStore(s3client, bucket)
+
+
+def _byStationNight(ffnames):
+    res = {}
+    for ff in ffnames:
+        ff = normaliseFFName(ff)
+        spls = ff.split('_')
+        res.setdefault((spls[1], captureNight(spls[2], spls[3])), []).append(ff)
+    return res
+
+
+def addToManifests(store, folder, ff_names):
+    """ Record the detections from an FTPdetectinfo file in the manifests of the nights they belong to.
+
+    Arguments:
+        store: [S3ManifestStore or LocalManifestStore] Where the manifests are held.
+        folder: [str] Name of the upload folder, eg UK0006_20221121_164424_325844.
+        ff_names: [list] FF file names of the detections.
+
+    Return:
+        [int] the number of parts written.
+    """
+    bynight = _byStationNight(ff_names)
+    for (stationid, night), ffs in bynight.items():
+        # the part is named after the upload folder, so a reprocessed upload replaces its own entries
+        store.writePart(stationid, night, folder, {'folder': folder, 'meteors': sorted(set(ffs))})
+    return len(bynight)
+
+
+def addPublished(store, keys):
+    """ Record website keys that have been published, eg img/single/2023/202312/FF_UK0006_20231201_201234_567_012345.jpg
+
+    Arguments:
+        store: [S3ManifestStore or LocalManifestStore] Where the manifests are held.
+        keys: [list] keys of the jpgs and mp4s that have been copied to the website.
+
+    Return:
+        [int] the number of parts written.
+    """
+    published = {}
+    for key in keys:
+        fname = os.path.basename(key)
+        ext = os.path.splitext(fname)[1]
+        if fname[:3] not in ['FF_', 'FR_'] or ext not in ['.jpg', '.mp4']:
+            continue
+        ff = normaliseFFName(fname)
+        published.setdefault(ff, {})[ext[1:]] = key
+    partname = 'published_' + datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S') + '_' + uuid.uuid4().hex[:8]
+    bynight = _byStationNight(published.keys())
+    for (stationid, night), ffs in bynight.items():
+        store.writePart(stationid, night, partname, {'published': {ff: published[ff] for ff in ffs}})
+    return len(bynight)
+
+
+def lookupImages(store, ffname):
+    """ Find the published jpg and mp4 for an FF file from the manifest.
+
+    Arguments:
+        store: [S3ManifestStore or LocalManifestStore] Where the manifests are held.
+        ffname: [str] FF file name.
+
+    Return:
+        found, jpg, mp4: [bool, str, str] found is False if the manifest doesn't list the detection. jpg and
+            mp4 are None unless they've been recorded as published, in which case the caller should check
+            the website for them itself.
+    """
+    ffname = normaliseFFName(ffname)
+    spls = ffname.split('_')
+    manifest = store.read(spls[1], captureNight(spls[2], spls[3]))
+    if manifest is None or ffname not in manifest['meteors']:
+        return False, None, None
+    keys = manifest['meteors'][ffname]
+    return True, keys.get('jpg'), keys.get('mp4')
+
+
+def listDetections(store, stationid, night, startdt=None, enddt=None):
+    """ List the FF files of a station's detections on a night, optionally between two datetimes.
+
+    Return:
+        [list] FF names, or None if there's no manifest for the station and night.
+    """
+    manifest = store.read(stationid, night)
+    if manifest is None:
+        return None
+    ffs = sorted(manifest['meteors'])
+    if startdt is not None:
+        ffs = [ff for ff in ffs if startdt <= datetime.datetime.strptime('_'.join(ff.split('_')[2:4]), '%Y%m%d_%H%M%S') <= enddt]
+    return ffs
+
+
+def listPublished(store, stationid, night, imgtype, startdt=None, enddt=None):
+    """ List the website keys of a station's published images on a night, optionally between two datetimes.
+
+    Arguments:
+        store: [S3ManifestStore or LocalManifestStore] Where the manifests are held.
+        stationid: [str] Station ID.
+        night: [str] Night, as YYYYMMDD.
+        imgtype: [str] 'jpg' or 'mp4'.
+
+    Return:
+        [list] keys, or None if there's no manifest for the station and night.
+    """
+    ffs = listDetections(store, stationid, night, startdt, enddt)
+    if ffs is None:
+        return None
+    meteors = store.read(stationid, night)['meteors']
+    return [meteors[ff][imgtype] for ff in ffs if imgtype in meteors[ff]]
+
+
+if __name__ == '__main__':
+    # record the files in a local folder as published under a website prefix, eg
+    #   python -m reports.imageManifest $evt/jpgs img/single/2023/202312
+    localdir, webprefix = sys.argv[1], sys.argv[2].rstrip('/')
+    import boto3
+    store = getManifestStore(boto3.client('s3'), os.getenv('UKMONSHAREDBUCKET', default='s3://ukmda-shared'))
+    if os.path.isdir(localdir):
+        addPublished(store, [f'{webprefix}/{fname}' for fname in os.listdir(localdir)])
@@ -5,6 +5,8 @@ import os
 from numpy.core.umath_tests import inner1d
 import math
 
+from ftpDetectReader import readFTPdetectinfoColumnar
+
 # Define Julian epoch
 JULIAN_EPOCH = datetime(2000, 1, 1, 12)  # noon (the epoch name is unrelated)
 J2000_JD = timedelta(2451545)  # julian epoch in julian dates
@@ -323,6 +325,8 @@ def filenameToDatetime(file_name):
 def readFTPdetectinfo(ff_directory, file_name, ret_input_format=False):
     """ Read the CAMS format FTPdetectinfo file. 
 
+    This is a thin wrapper around readFTPdetectinfoColumnar, which should be used directly by new code.
+
     Arguments:
         ff_directory: [str] Directory where the FTPdetectinfo file is.
         file_name: [str] Name of the FTPdetectinfo file.
@@ -336,110 +340,34 @@ def readFTPdetectinfo(ff_directory, file_name, ret_input_format=False):
         [tuple]: Two options, see ret_input_format.
     """
 
-    ff_name = ''
-
-
-    # Open the FTPdetectinfo file
-    with open(os.path.join(ff_directory, file_name)) as f:
-
-        entry_counter = 0
-        meteor_list = []
-        meteor_meas = []
-        cam_code = meteor_No = n_segments = fps = hnr = mle = binn = px_fm = rho = phi = None
-        calib_status = 0
-
-        # Skip the header
-        for i in range(11):
-            next(f)
-
-
-        for line in f:
-            
-            line = line.replace('\n', '').replace('\r', '')
-
-
-            # The separator marks the beginning of a new meteor
-            if "-------------------------------------------------------" in line:
-
-                # Add the read meteor info to the final list
-                if meteor_meas:
-                    meteor_list.append([ff_name, cam_code, meteor_No, n_segments, fps, hnr, mle, binn, 
-                        px_fm, rho, phi, meteor_meas])
-
-                # Reset the line counter to 0
-                entry_counter = 0
-                meteor_meas = []
-
-
-            # Read the calibration status
-            if entry_counter == 0:
-
-                if 'Uncalibrated' in line:
-                    calib_status = 0
-
-                else:
-                    calib_status = 1
+    ftp = readFTPdetectinfoColumnar(ff_directory, file_name)
 
+    meteor_list = []
+    for i, ff_name in enumerate(ftp.ff_names):
+        meteor_No, n_segments, fps, hnr, mle, binn, px_fm, rho, phi = ftp.header[i].tolist()
+        calib_status = int(ftp.calib_status[i])
+        meteor_meas = [[calib_status] + row for row in ftp.meteor(i).tolist()]
+        meteor_list.append([ff_name, ftp.cam_code, meteor_No, n_segments, fps, hnr, mle, binn, 
+            px_fm, rho, phi, meteor_meas])
 
-            # Read the name of the FF file
-            if entry_counter == 1:
-                ff_name = line
+    # If the return in the format suitable for the writeFTPdetectinfo function, reformat the output list
+    if ret_input_format:
 
-            # Read the meteor parameters
-            if entry_counter == 3:
-                cam_code, meteor_No, n_segments, fps, hnr, mle, binn, px_fm, rho, phi = line.split()
-                meteor_No, n_segments, fps, hnr, mle, binn, px_fm, rho, phi = list(map(float, [meteor_No, 
-                    n_segments, fps, hnr, mle, binn, px_fm, rho, phi]))
+        output_list = []
 
-            # Read meteor measurements
-            if entry_counter > 3:
-                
-                # Skip lines with NaNs for centroids
-                if '00nan' in line:
-                    continue
+        for entry in meteor_list:
+            ff_name, cam_code, meteor_No, n_segments, fps, hnr, mle, binn, px_fm, rho, phi, \
+                meteor_meas = entry
 
-                mag = np.nan
+            # Remove the calibration status from the list of centroids
+            meteor_meas = [line[1:] for line in meteor_meas]
 
-                # Read magnitude if it is in the file
-                if len(line.split()) > 8:
+            output_list.append([ff_name, meteor_No, rho, phi, meteor_meas])
 
-                    line_sp = line.split()
+        return ftp.cam_code, (meteor_list[-1][4] if meteor_list else None), output_list
 
-                    mag = float(line_sp[8])
-
-                # Read meteor frame-by-frame measurements
-                frame_n, x, y, ra, dec, azim, elev, inten = list(map(float, line.split()[:8]))
-
-                meteor_meas.append([calib_status, frame_n, x, y, ra, dec, azim, elev, inten, mag])
-
-
-            entry_counter += 1
-
-
-        # Add the last entry to the list
-        if meteor_meas:
-            meteor_list.append([ff_name, cam_code, meteor_No, n_segments, fps, hnr, mle, binn, px_fm, 
-                rho, phi, meteor_meas])
-
-
-        # If the return in the format suitable for the writeFTPdetectinfo function, reformat the output list
-        if ret_input_format:
-
-            output_list = []
-
-            for entry in meteor_list:
-                ff_name, cam_code, meteor_No, n_segments, fps, hnr, mle, binn, px_fm, rho, phi, \
-                    meteor_meas = entry
-
-                # Remove the calibration status from the list of centroids
-                meteor_meas = [line[1:] for line in meteor_meas]
-
-                output_list.append([ff_name, meteor_No, rho, phi, meteor_meas])
-
-            return cam_code, fps, output_list
-
-        else:
-            return meteor_list
+    else:
+        return meteor_list
 
 
 def vectNorm(vect):
@@ -563,6 +491,8 @@ class simpleConfig(object):
         self.shower_file_name = 'established_showers.csv'
         self.shower_lasun_threshold = 2.0
         self.shower_max_radiant_separation = 7.5
+        self.shower_radiant_time_step = 300
+        self.shower_radiant_cache_size = 20000
         self.fps = 25
 
 
@@ -0,0 +1,68 @@
+# Copyright (C) 2018-2023 Mark McIntyre
+
+import os
+import sys
+import json
+
+import pytest
+
+here = os.path.split(os.path.abspath(__file__))[0]
+codedir = os.path.join(here, '..', 'pythoncode')
+sys.path.insert(0, codedir)
+
+from supportFuncs import simpleConfig # noqa: E402
+from ShowerAssociation import showerAssociation # noqa: E402
+
+testdir = os.path.join(here, '..', '..', 'fetchECSV', 'tests')
+ftpfile = 'FTPdetectinfo_UK005U_20240809_201258_058797.txt'
+
+# showers assigned to the Perseid upload by the per-meteor association, before it was batched.
+# Every other meteor in the file has no shower.
+NDA = ['FF_UK005U_20240810_001928_133_0368640.fits:1']
+PER = ['FF_UK005U_20240809_205337_439_0060160.fits:2',
+    'FF_UK005U_20240809_212036_588_0100608.fits:1', 'FF_UK005U_20240809_212219_066_0103168.fits:1',
+    'FF_UK005U_20240809_212604_517_0108800.fits:1', 'FF_UK005U_20240809_212625_012_0109312.fits:1',
+    'FF_UK005U_20240809_213944_339_0129280.fits:1', 'FF_UK005U_20240809_214533_405_0137984.fits:1',
+    'FF_UK005U_20240809_214756_874_0141568.fits:1', 'FF_UK005U_20240809_215040_838_0145664.fits:1',
+    'FF_UK005U_20240809_215801_492_0156672.fits:1', 'FF_UK005U_20240809_221729_739_0185856.fits:1',
+    'FF_UK005U_20240809_230021_931_0250112.fits:1', 'FF_UK005U_20240809_230133_665_0251904.fits:1',
+    'FF_UK005U_20240809_231920_394_0278528.fits:1', 'FF_UK005U_20240809_231951_137_0279296.fits:1',
+    'FF_UK005U_20240809_232113_119_0281344.fits:1', 'FF_UK005U_20240809_232245_350_0283648.fits:1',
+    'FF_UK005U_20240809_232539_563_0288000.fits:1', 'FF_UK005U_20240809_233016_253_0294912.fits:1',
+    'FF_UK005U_20240810_003237_211_0388352.fits:1', 'FF_UK005U_20240810_003500_680_0391936.fits:1',
+    'FF_UK005U_20240810_003500_680_0391936.fits:2', 'FF_UK005U_20240810_003602_167_0393472.fits:1',
+    'FF_UK005U_20240810_004140_343_0401920.fits:1', 'FF_UK005U_20240810_004140_343_0401920.fits:2',
+    'FF_UK005U_20240810_004539_729_0407808.fits:1', 'FF_UK005U_20240810_005604_841_0423424.fits:1',
+    'FF_UK005U_20240810_005716_574_0425216.fits:1', 'FF_UK005U_20240810_010132_767_0431616.fits:1',
+    'FF_UK005U_20240810_011319_868_0449280.fits:1', 'FF_UK005U_20240810_011411_105_0450560.fits:1',
+    'FF_UK005U_20240810_011411_105_0450560.fits:2', 'FF_UK005U_20240810_011655_069_0454656.fits:1',
+    'FF_UK005U_20240810_012506_962_0466944.fits:1', 'FF_UK005U_20240810_012659_687_0469760.fits:1',
+    'FF_UK005U_20240810_012943_651_0473856.fits:1', 'FF_UK005U_20240810_013146_627_0476928.fits:1',
+    'FF_UK005U_20240810_013451_083_0481536.fits:1', 'FF_UK005U_20240810_013927_775_0488448.fits:1',
+    'FF_UK005U_20240810_015054_375_0505600.fits:1', 'FF_UK005U_20240810_015348_587_0509952.fits:1',
+    'FF_UK005U_20240810_015358_833_0510208.fits:1']
+
+
+def makeConfig(time_step):
+    with open(os.path.join(testdir, 'platepars_all_recalibrated.json')) as inf:
+        pp = list(json.load(inf).values())[0]
+    config = simpleConfig()
+    config.latitude = pp['lat']
+    config.longitude = pp['lon']
+    config.elevation = pp['elev']
+    config.shower_path = codedir
+    config.shower_radiant_time_step = time_step
+    return config
+
+
+# the apparent radiants are cached per 300s bucket so can differ slightly from the exact ones,
+# but that mustn't change which shower any meteor is assigned to
+@pytest.mark.parametrize('time_step', [300, 0])
+def test_showerAssociation(time_step):
+    assoc = showerAssociation(makeConfig(time_step), os.path.join(testdir, ftpfile))
+    assert len(assoc) == 72
+    showers = {f'{ff}:{int(no)}': (shwr.name if shwr is not None else None) for (ff, no), (_, shwr) in assoc.items()}
+    expected = {k: None for k in showers}
+    expected.update({k: 'PER' for k in PER})
+    expected.update({k: 'NDA' for k in NDA})
+    assert showers == expected
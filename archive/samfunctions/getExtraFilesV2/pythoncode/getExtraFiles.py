@@ -5,22 +5,34 @@ import os
 import sys
 import shutil
 import json
-from zipfile import ZipFile, ZIP_DEFLATED
+import time
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 from datetime import datetime, timedelta
-from boto3.dynamodb.conditions import Key
+from concurrent.futures import ThreadPoolExecutor
 
 from wmpl.Utils.Pickling import loadPickle
 from pickleAnalysis import createAdditionalOutput
 from createOrbitPageIndex import createOrbitPageIndex
 
 
+# station sites rarely change, so they're kept for the life of a warm container
+SITE_CACHE = {}
+
+# number of threads used to fetch each trajectory's images and supporting files
+MAX_WORKERS = 8
+
+
 def findSite(stationid, ddb):
-    table = ddb.Table('camdetails')
-    response = table.query(KeyConditionExpression=Key('stationid').eq(stationid))
+    if stationid in SITE_CACHE:
+        return SITE_CACHE[stationid]
+    # the low-level client is used because, unlike resources, it's safe to share between threads
+    response = ddb.meta.client.query(TableName='camdetails', KeyConditionExpression='stationid = :s', 
+        ExpressionAttributeValues={':s': {'S': stationid}})
     try:
         items = response['Items']
         if len(items) > 0:
-            return items[0]['site']
+            SITE_CACHE[stationid] = items[0]['site']['S']
+            return SITE_CACHE[stationid]
         else:
             return None
     except Exception:
@@ -28,6 +40,66 @@ def findSite(stationid, ddb):
     return None
 
 
+def findSites(stationids, ddb, pool):
+    """ Look up the sites of several stations at once, using the cache where possible.
+
+    Arguments:
+        stationids: [list] Station IDs to look up.
+        ddb: [boto3 resource] DynamoDB resource.
+        pool: [ThreadPoolExecutor] Pool to run the queries in.
+
+    Return:
+        [dict] Site of each station, or None if the station wasn't found.
+    """
+    # camdetails is keyed on stationid and site, so batch_get_item can't be used without the site
+    stationids = list(set(stationids))
+    sites = pool.map(lambda s: findSite(s, ddb), stationids)
+    return dict(zip(stationids, sites))
+
+
+def getObsFFName(obs, extrajpgs):
+    """ Work out the FF file name of an observation, either from its comment or from the extra jpgs list. """
+    id = None
+    try:
+        id = obs.station_id
+        print(id)
+    except Exception:
+        print('unable to get id')
+    try:
+        js = json.loads(obs.comment)
+        ffname = js['ff_name']
+        print(ffname)
+        # case when filename is nonstandard 
+        if 'FF_' not in ffname and 'FR_' not in ffname:
+            ffname = 'FF_' + ffname
+        ffname = ffname.replace('FR_', 'FF_').replace('.bin', '.fits')
+        if '.bin' not in ffname and '.fits' not in ffname:
+            ffname = ffname + '.fits'
+        return ffname
+    except Exception:
+        ffs = [x for x in extrajpgs if id is not None and id in x]
+        print(ffs)
+        if len(ffs) > 0:
+            return ffs[0]
+    return None
+
+
+def findObsImages(ffname, websitebucket, s3):
+    """ Return the names of the jpg and mp4 for an FF file, or None if they aren't on the website. """
+    dtstr = ffname.split('_')[2]
+    jpgname=f'img/single/{dtstr[:4]}/{dtstr[:6]}/{ffname}'.replace('fits','jpg')
+    mp4name=f'img/mp4/{dtstr[:4]}/{dtstr[:6]}/{ffname}'.replace('fits','mp4')
+    res = s3.meta.client.list_objects_v2(Bucket=websitebucket,Prefix=jpgname)
+    if res['KeyCount'] == 0:
+        print(f'{jpgname} not found')
+        jpgname = None
+    res = s3.meta.client.list_objects_v2(Bucket=websitebucket,Prefix=mp4name)
+    if res['KeyCount'] == 0:
+        print(f'{mp4name} not found')
+        mp4name = None
+    return jpgname, mp4name
+
+
 def generateExtraFiles(key, archbucket, websitebucket, ddb, s3):
     print(f'event {key} using {archbucket} and {websitebucket}')
     fuloutdir, fname = os.path.split(key)
@@ -71,63 +143,41 @@ def generateExtraFiles(key, archbucket, websitebucket, ddb, s3):
         jpgf = open(os.path.join(outdir, 'jpgs.lst'), 'w')
         mp4f = open(os.path.join(outdir, 'mpgs.lst'), 'w')
         print('opened image list files')
-        for obs in traj.observations:
-            try:
-                id = obs.station_id
-                print(id)
-            except Exception:
-                print('unable to get id')
-            gotff = False
-            try:
-                js = json.loads(obs.comment)
-                ffname = js['ff_name']
-                print(ffname)
-                # case when filename is nonstandard 
-                if 'FF_' not in ffname and 'FR_' not in ffname:
-                    ffname = 'FF_' + ffname
-                ffname = ffname.replace('FR_', 'FF_').replace('.bin', '.fits')
-                if '.bin' not in ffname and '.fits' not in ffname:
-                    ffname = ffname + '.fits'
-                gotff = True
-            except Exception:
-                ffs = [x for x in extrajpgs if id in x]
-                print(ffs)
-                if len(ffs) > 0:
-                    ffname = ffs[0]
-                    gotff = True
-                else:
-                    pass
-            if gotff is True: 
+        ffnames = [getObsFFName(obs, extrajpgs) for obs in traj.observations]
+        ffnames = [ff for ff in ffnames if ff is not None]
+
+        # the rest is almost all waiting on S3 and DynamoDB, so run it concurrently 
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            print('finding the sites and available images')
+            sites = findSites([ff.split('_')[1] for ff in ffnames], ddb, pool)
+            imgs = pool.map(lambda ff: findObsImages(ff, websitebucket, s3), ffnames)
+
+            # the archive folder to search for each observation, once per station and night
+            otherfiles = set()
+            for ffname in ffnames:
                 spls = ffname.split('_')
                 id = spls[1]
                 dtstr = spls[2]
                 tmstr = spls[3]
-                jpgname=f'img/single/{dtstr[:4]}/{dtstr[:6]}/{ffname}'.replace('fits','jpg')
-                mp4name=f'img/mp4/{dtstr[:4]}/{dtstr[:6]}/{ffname}'.replace('fits','mp4')
-                print('about to get a list of available jpgs')
-                res = s3.meta.client.list_objects_v2(Bucket=websitebucket,Prefix=jpgname)
-                if res['KeyCount'] > 0:
-                    jpgf.write(f'{jpgname}\n')
-                    jpghtml.write(f'<a href="/{jpgname}"><img src="/{jpgname}" width="20%"></a>\n')
-                else:
-                    print(f'{jpgname} not found')
-                print('about to get a list of available mp4s')
-                res = s3.meta.client.list_objects_v2(Bucket=websitebucket,Prefix=mp4name)
-                if res['KeyCount'] > 0:
-                    mp4f.write(f'{mp4name}\n')
-                    mp4html.write(f'<a href="/{mp4name}"><video width="20%"><source src="/{mp4name}" width="20%" type="video/mp4"></video></a>\n')
-                else:
-                    print(f'{mp4name} not found')             
-
-                print('about to find the site')
-                site = findSite(id, ddb)
+                site = sites[id]
                 if site is not None:
-                    fldr = site + '/' + id
                     evtdtval = datetime.strptime(f'{dtstr}_{tmstr}', '%Y%m%d_%H%M%S')
                     if evtdtval.hour < 13:
                         evtdtval = evtdtval + timedelta(days = -1)
                         dtstr = evtdtval.strftime('%Y%m%d')
-                    findOtherFiles(dtstr, archbucket, websitebucket, outdir, fldr, s3)
+                    otherfiles.add((dtstr, site + '/' + id))
+            futs = [pool.submit(findOtherFiles, dtstr, archbucket, websitebucket, outdir, fldr, s3) for dtstr, fldr in otherfiles]
+
+            # write the image lists in the order of the observations
+            for jpgname, mp4name in imgs:
+                if jpgname is not None:
+                    jpgf.write(f'{jpgname}\n')
+                    jpghtml.write(f'<a href="/{jpgname}"><img src="/{jpgname}" width="20%"></a>\n')
+                if mp4name is not None:
+                    mp4f.write(f'{mp4name}\n')
+                    mp4html.write(f'<a href="/{mp4name}"><video width="20%"><source src="/{mp4name}" width="20%" type="video/mp4"></video></a>\n')
+            for fut in futs:
+                fut.result()
 
         jpghtml.close()
         mp4html.close()
@@ -181,32 +231,17 @@ def findOtherFiles(evtdt, archbucket, websitebucket, outdir, fldr, s3):
     thispth = f'archive/{fldr}/{evtdt[:4]}/{evtdt[:6]}/{evtdt[:8]}/'
     print(f'looking in {thispth}')
     corrpth = ''
-    objlist = s3.meta.client.list_objects_v2(Bucket=archbucket,Prefix=thispth)
-    if objlist['KeyCount'] > 0:
-        keys = objlist['Contents']
-        for k in keys:
+    # busy folders have more than one page of results
+    paginator = s3.meta.client.get_paginator('list_objects_v2')
+    for objlist in paginator.paginate(Bucket=archbucket, Prefix=thispth):
+        for k in objlist.get('Contents', []):
             fname = k['Key']
-            #print(f'fname is {fname}')
             if 'fieldsums' in fname or 'radiants' in fname or '.csv' in fname:
                 _, corrpth = os.path.split(fname)
             if '.csv' in fname or '.kml' in fname or 'FTPdetectinfo' in fname:
                 _, locfname = os.path.split(fname)
                 locfname = os.path.join(outdir, locfname)
                 s3.meta.client.download_file(archbucket, fname, locfname)
-    while objlist['IsTruncated'] is True:
-        contToken = objlist['NextContinuationToken'] 
-        objlist = s3.meta.client.list_objects_v2(Bucket=archbucket,Prefix=thispth, ContinuationToken=contToken)
-        if objlist['KeyCount'] > 0:
-            keys = objlist['Contents']
-            for k in keys:
-                fname = k['Key']
-                #print(f'fname is {fname}')
-                if 'fieldsums' in fname or 'radiants' in fname or '.csv' in fname:
-                    _, corrpth = os.path.split(fname)
-            if '.csv' in fname or '.kml' in fname or 'FTPdetectinfo' in fname:
-                _, locfname = os.path.split(fname)
-                locfname = os.path.join(outdir, locfname)
-                s3.meta.client.download_file(archbucket, fname, locfname)
 
     if len(corrpth) > 30:
         corrpth = corrpth[:29]
@@ -238,7 +273,37 @@ def findOtherFiles(evtdt, archbucket, websitebucket, outdir, fldr, s3):
     return
 
 
-def pushFilesBack(outdir, archbucket, websitebucket, fldr, s3):
+# already-compressed formats gain nothing from being deflated again
+STORED_TYPES = ('.jpg', '.jpeg', '.png', '.mp4', '.gif', '.zip', '.gz')
+
+
+def getUploadTarget(f, webpth, archbucket, websitebucket, fldr, yr, ym, ymd, pth):
+    """ Return the bucket and key a file should be pushed to, or None if it only goes in the zip. """
+    # some files need to be pushed to the website, some to the archive bucket
+    if '3dtrack' in f or '2dtrack' in f:
+        return websitebucket, os.path.join(webpth, f)
+    elif '.lst' in f:
+        return archbucket, os.path.join(f'matches/RMSCorrelate/trajectories/{yr}/{ym}/{ymd}/{pth}', f)
+    elif 'summary' in f:
+        return archbucket, os.path.join(fldr, f)
+    elif 'orbit_full.csv' in f:
+        return archbucket, os.path.join(f'matches/{yr}/fullcsv', f)
+    return None
+
+
+def pushFilesBack(outdir, archbucket, websitebucket, fldr, s3, compresslevel=6):
+    """ Upload the output files to the website and shared buckets, and zip them all up for the website. 
+
+    Arguments:
+        outdir: [str] Folder holding the output files. Its name is the orbit name.
+        archbucket: [str] Shared bucket name.
+        websitebucket: [str] Website bucket name.
+        fldr: [str] Folder in the shared bucket holding the trajectory.
+        s3: [boto3 resource] S3 resource.
+
+    Keyword arguments:
+        compresslevel: [int] Deflate level used for files that aren't already compressed. Default 6.
+    """
     # get filelist before creating the zipfile! 
     flist = os.listdir(outdir)
 
@@ -251,37 +316,35 @@ def pushFilesBack(outdir, archbucket, websitebucket, fldr, s3):
     else:
         webpth = f'reports/{yr}/orbits/{ym}/{pth}/'
 
-    zipfname = os.path.join(outdir, pth +'.zip')
-    zipf = ZipFile(zipfname, 'w', compression=ZIP_DEFLATED, compresslevel=9)
-
-    for f in flist:
-        #print(f)
-        locfname = os.path.join(outdir, f)
-        zipf.write(locfname)
-        # some files need to be pushed to the website, some to the archive bucket
-        if '3dtrack' in f or '2dtrack' in f:
-            key = os.path.join(webpth, f)
-            extraargs = getExtraArgs(locfname)
-            s3.meta.client.upload_file(locfname, websitebucket, key, ExtraArgs=extraargs)
-        elif '.lst' in f:
-            key = os.path.join(f'matches/RMSCorrelate/trajectories/{yr}/{ym}/{ymd}/{pth}', f)
-            extraargs = getExtraArgs(locfname)
-            s3.meta.client.upload_file(locfname, archbucket, key, ExtraArgs=extraargs)
-        elif 'summary' in f:
-            key = os.path.join(fldr, f)
-            # print(locfname, key)
-            extraargs = getExtraArgs(locfname)
-            s3.meta.client.upload_file(locfname, archbucket, key, ExtraArgs=extraargs)
-        elif 'orbit_full.csv' in f:
-            key = os.path.join(f'matches/{yr}/fullcsv', f)
-            extraargs = getExtraArgs(locfname)
-            s3.meta.client.upload_file(locfname, archbucket, key, ExtraArgs=extraargs)
-
-    zipf.close()
-    # now we push the zipfile
-    key = os.path.join(webpth, pth + '.zip')
-    extraargs = getExtraArgs(zipfname)
-    s3.meta.client.upload_file(zipfname, websitebucket, key, ExtraArgs=extraargs) 
+    tstart = time.time()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        # start the uploads, then build the zip while they run
+        futs = []
+        for f in flist:
+            target = getUploadTarget(f, webpth, archbucket, websitebucket, fldr, yr, ym, ymd, pth)
+            if target is not None:
+                locfname = os.path.join(outdir, f)
+                futs.append(pool.submit(s3.meta.client.upload_file, locfname, target[0], target[1], 
+                    ExtraArgs=getExtraArgs(locfname)))
+
+        zipfname = os.path.join(outdir, pth +'.zip')
+        with ZipFile(zipfname, 'w') as zipf:
+            for f in flist:
+                locfname = os.path.join(outdir, f)
+                if os.path.splitext(f)[1].lower() in STORED_TYPES:
+                    zipf.write(locfname, compress_type=ZIP_STORED)
+                else:
+                    zipf.write(locfname, compress_type=ZIP_DEFLATED, compresslevel=compresslevel)
+        tzip = time.time()
+
+        # now we push the zipfile
+        key = os.path.join(webpth, pth + '.zip')
+        extraargs = getExtraArgs(zipfname)
+        futs.append(pool.submit(s3.meta.client.upload_file, zipfname, websitebucket, key, ExtraArgs=extraargs))
+        for fut in futs:
+            fut.result()
+    tend = time.time()
+    print(f'zipped {len(flist)} files in {tzip-tstart:.1f}s, {len(futs)} uploads finished after {tend-tstart:.1f}s')
     return 
 
 
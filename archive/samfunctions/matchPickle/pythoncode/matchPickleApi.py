@@ -2,11 +2,58 @@
 import json
 import os
 import boto3
+from collections import OrderedDict
 
 # need to include WMPL because the pickle file references structures in it
 from wmpl.Utils.Pickling import loadPickle
 
 
+class TrajectoryCache(object):
+    """ LRU cache of trajectories, kept for the life of a warm container. Entries are keyed on the 
+        S3 key and hold the ETag and the trajectory's JSON, so a trajectory is only downloaded again 
+        if it has changed in S3. The unpickled trajectory isn't kept, as it's several times the size 
+        of its JSON and isn't needed once that's been rendered.
+
+    Keyword arguments:
+        max_bytes: [int] Limit on the memory used by the JSON held. 
+        max_entries: [int] Maximum number of trajectories held.
+    """
+    def __init__(self, max_bytes=128*1024*1024, max_entries=100):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key, etag):
+        """ Return the json held for key if it has the given ETag, otherwise None. """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] != etag:
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, etag, pstr):
+        self.remove(key)
+        if len(pstr) > self.max_bytes:
+            return
+        self.entries[key] = (etag, pstr)
+        self.nbytes += len(pstr)
+        while self.nbytes > self.max_bytes or len(self.entries) > self.max_entries:
+            _, (_, oldstr) = self.entries.popitem(last=False)
+            self.nbytes -= len(oldstr)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= len(entry[1])
+
+
+TRAJ_CACHE = TrajectoryCache(max_bytes=int(os.getenv('CACHEMB', default='128'))*1024*1024)
+
+
 def lambda_handler(event, context):
     archbucket = os.getenv('ARCHBUCKET', default= 'ukmda-shared')
 
@@ -34,9 +81,16 @@ def lambda_handler(event, context):
         key = k['Key']
         if rettyp.lower() == 'json':
             print('returning json type')
-            s3.download_file(archbucket, key, f'/tmp/{pfname}')
-            p = loadPickle('/tmp', pfname)
-            pstr = p.toJson()
+            # the listing gives the current ETag, so a cached copy can be checked without another request
+            pstr = TRAJ_CACHE.get(key, k['ETag'])
+            if pstr is not None:
+                print('using cached trajectory')
+            else:
+                s3.download_file(archbucket, key, f'/tmp/{pfname}')
+                p = loadPickle('/tmp', pfname)
+                pstr = p.toJson()
+                TRAJ_CACHE.put(key, k['ETag'], pstr)
+                os.remove(f'/tmp/{pfname}')
         else:
             print('returning presigned url')
             url = s3.generate_presigned_url(ClientMethod='get_object', 
@@ -6,11 +6,141 @@ import boto3
 import dateutil
 import datetime
 import os
+import io
+import csv
+import gzip
 import pytz
 from operator import itemgetter
 
 
-def FindMatch(bucket, csvfile, d1, d2, op):
+# the yearly events files are split into daily partitions by createSearchableFormat, 
+# with an index giving the time range covered by each
+INDEX_ROOT = 'search/indexes'
+
+
+class S3IndexStore(object):
+    def __init__(self, bucket):
+        self.s3 = boto3.client('s3')
+        self.bucket = bucket
+
+    def read(self, key):
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except Exception:
+            return None
+
+
+class LocalIndexStore(object):
+    """ Reads the index from a local copy of the bucket, for testing. """
+    def __init__(self, rootdir):
+        self.rootdir = rootdir
+
+    def read(self, key):
+        fname = os.path.join(self.rootdir, key)
+        if not os.path.isfile(fname):
+            return None
+        with open(fname, 'rb') as inf:
+            return inf.read()
+
+
+def getIndexStore(bucket):
+    localdir = os.getenv('SRCHLOCALDIR', default=None)
+    if localdir:
+        return LocalIndexStore(localdir)
+    return S3IndexStore(bucket)
+
+
+def parseOptions(d1, op):
+    """ Convert the search options into a filter function and the best-N settings.
+
+    Options are separated by underscores:
+        s:LYR filter by shower
+        m:-1 filter by mag less than or equal to X
+        l:UK0006 filter by station
+        t:S only single-station detections, t: (anything else) only matches
+        b:N the brightest N single-station detections of mag -1 or brighter
+    """
+    tests = []
+    utc=pytz.UTC
+    comptime = utc.localize(datetime.datetime.today() + datetime.timedelta(days=-30))
+    if d1 < comptime:
+        tests.append(lambda r: r['source'] != '3Live')
+    best = False
+    bestcount = 9999
+
+    def magBelow(r, limit):
+        try:
+            return float(r['Mag']) <= limit
+        except ValueError:
+            return False
+
+    if len(op) > 0:
+        splits = op.split('_')
+        for spl in splits:
+            if len(spl) == 0:
+                continue
+            val = spl[2:]
+            if spl[:2] == 's:':
+                shwrs = ('J8_' + val, ' ' + val, val)
+                tests.append(lambda r, shwrs=shwrs: r['shower'] in shwrs)
+            if spl[:2] == 'm:':
+                tests.append(lambda r, lim=float(val): magBelow(r, lim))
+            if spl[:2] == 'l:':
+                tests.append(lambda r, val=val: val in r['loccam'])
+            if spl[:2] == 't:':
+                src = '2Single' if val == 'S' else '1Matched'
+                tests.append(lambda r, src=src: r['source'] == src)
+            if spl[:2] == 'b:':
+                best = True
+                tests.append(lambda r: r['source'] == '2Single')
+                tests.append(lambda r: magBelow(r, -1))
+                bestcount= int(val)
+    return (lambda r: all(t(r) for t in tests)), best, bestcount
+
+
+def readPartitions(store, d1, d2):
+    """ Yield the rows of every daily partition that overlaps the period d1 to d2. 
+        Returns None if a year in the period hasn't been partitioned.
+    """
+    ds1 = d1.timestamp()
+    ds2 = d2.timestamp()
+    keys = []
+    for yr in range(d1.year, d2.year + 1):
+        idx = store.read(f'{INDEX_ROOT}/{yr}/index.json')
+        if idx is None:
+            return None
+        idx = json.loads(idx)
+        keys += [f'{INDEX_ROOT}/{yr}/{v["file"]}' for v in idx.values() if v['max'] > ds1 and v['min'] < ds2]
+    rows = []
+    for key in keys:
+        data = store.read(key)
+        if data is None:
+            continue
+        rdr = csv.DictReader(io.StringIO(gzip.decompress(data).decode('utf-8')))
+        rows += [r for r in rdr if ds1 < float(r['eventtime']) < ds2]
+    return rows
+
+
+def FindMatch(bucket, csvfile, d1, d2, op, store=None):
+    """ Find events between d1 and d2 matching the options in op. The daily partitions are 
+        used if they exist, otherwise the year's events file is searched with S3 Select. 
+    """
+    if store is None:
+        store = getIndexStore(bucket)
+    rows = readPartitions(store, d1, d2)
+    if rows is None:
+        return FindMatchSelect(bucket, csvfile, d1, d2, op)
+    rowfilter, best, bestcount = parseOptions(d1, op)
+    hdr = ['eventtime','source','shower','Mag','loccam','url','imgs']
+    res = []
+    for r in rows:
+        if rowfilter(r):
+            res.append(','.join(r[h] for h in hdr).replace('https://archive.ukmeteornetwork.co.uk','').replace('https://archive.ukmeteors.co.uk',''))
+    print(f'{len(res)} of {len(rows)} rows selected')
+    return formatResults(res, best, bestcount)
+
+
+def FindMatchSelect(bucket, csvfile, d1, d2, op):
     s3 = boto3.client('s3')
     ds1 = d1.timestamp()
     ds2 = d2.timestamp()
@@ -57,6 +187,10 @@ def FindMatch(bucket, csvfile, d1, d2, op):
             lines = records.split('\n')
             for r in lines:
                 res.append(r.replace('https://archive.ukmeteornetwork.co.uk','').replace('https://archive.ukmeteors.co.uk',''))
+    return formatResults(res, best, bestcount)
+
+
+def formatResults(res, best, bestcount):
     res.sort()
     res2 = []
     for r in res:
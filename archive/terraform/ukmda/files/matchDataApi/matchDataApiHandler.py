@@ -3,6 +3,98 @@ import datetime
 import os
 import boto3
 import json
+import csv
+from collections import OrderedDict
+
+# the per-day row indexes written by converters/createMatchIndex.py
+INDEX_ROOT = 'matches/matched/index'
+
+SUMMARY_FIELDS = '_localtime,_mjd,_sol,_ID1,_amag,_ra_o,_dc_o,_ra_t,_dc_t,_elng,_elat,_vo,_vi,_vg,_vs,_a,_q,_e,_p,_peri,_node,_incl,'\
+    '_stream,_mag,_dur,_lng1,_lat1,_H1,_lng2,_lat2,_H2,_LD21,_az1r,_ev1r,_Nts,_Nos,_leap,_tme,_dt,'\
+    'dtstamp,orbname,iau,name,mass,pi,Q,true_anom,EA,MA,Tj,T,last_peri,jacchia1,Jacchia2,numstats,stations'
+
+# parsed report points are kept while the container is warm, as popular events are requested repeatedly
+POINTS_CACHE = OrderedDict()
+POINTS_CACHE_SIZE = 50
+
+
+def readDayIndex(s3, target, day):
+    try:
+        obj = s3.get_object(Bucket=target, Key=f'{INDEX_ROOT}/{day[:4]}/{day}.json')
+        return json.loads(obj['Body'].read())
+    except Exception:
+        return None
+
+
+def readIndexedRows(s3, target, idx, rows, maxgap=65536):
+    """ Fetch rows of the year's matches file using ranged reads, merging rows that are close together.
+
+    Arguments:
+        s3: [boto3 client] S3 client.
+        target: [str] Bucket holding the matches file.
+        idx: [dict] The day's index.
+        rows: [list] Index entries of the rows to fetch.
+
+    Keyword arguments:
+        maxgap: [int] Rows separated by fewer bytes than this are fetched in one read.
+
+    Return:
+        [list] a dict of column name to value for each row, or None if the file no longer matches the index.
+    """
+    if len(rows) == 0:
+        return []
+    key = f"matches/matched/{idx['file']}"
+    rows = sorted(rows)
+    ranges = [[rows[0][0], rows[0][0] + rows[0][1]]]
+    for r in rows[1:]:
+        if r[0] - ranges[-1][1] < maxgap:
+            ranges[-1][1] = max(ranges[-1][1], r[0] + r[1])
+        else:
+            ranges.append([r[0], r[0] + r[1]])
+    records = []
+    for beg, end in ranges:
+        resp = s3.get_object(Bucket=target, Key=key, Range=f'bytes={beg}-{end-1}')
+        # the file has been rewritten since the index was built
+        if int(resp['ContentRange'].split('/')[1]) != idx['size']:
+            return None
+        data = resp['Body'].read()
+        for r in rows:
+            if beg <= r[0] < end:
+                lin = data[r[0]-beg:r[0]-beg+r[1]].decode('utf-8')
+                records.append(dict(zip(idx['header'], next(csv.reader([lin])))))
+    return records
+
+
+def toJsonLines(records, fields=None):
+    """ Format records as S3 Select does, one JSON object per line. """
+    res = ''
+    for rec in records:
+        if fields is not None:
+            rec = {f: rec.get(f, '') for f in fields}
+        res = res + json.dumps(rec, separators=(',', ':')) + '\n'
+    return res
+
+
+def indexedQuery(s3, target, reqtyp, reqval, statid=None):
+    """ Answer a request from the day index. Returns None if there's no usable index. """
+    day = reqval[:8]
+    idx = readDayIndex(s3, target, day)
+    if idx is None:
+        return None
+    if reqtyp == 'matches':
+        return toJsonLines([{'orbname': r[2]} for r in idx['rows']])
+    if reqtyp == 'station':
+        return toJsonLines([{'orbname': r[2]} for r in idx['rows'] if statid in r[3]])
+    if reqtyp == 'detail':
+        rows = [r for r in idx['rows'] if r[2] == reqval]
+        if len(rows) == 0:
+            # the orbit may be indexed under a different day, so let S3 Select look for it
+            return None
+        records = readIndexedRows(s3, target, idx, rows)
+        return None if records is None else toJsonLines(records)
+    # summary
+    records = readIndexedRows(s3, target, idx, idx['rows'])
+    return None if records is None else toJsonLines(records, SUMMARY_FIELDS.split(','))
 
 
 def lambda_handler(event, context):
@@ -25,14 +117,12 @@ def lambda_handler(event, context):
         res = '{"invalid request type - must be one of \'matches\', \'details\', \'station\',\'summary\'"}'
     else:
         print(f'{reqtyp} {reqval} {points}')
+        statid = None
         if reqtyp == 'summary':
             d1 = datetime.datetime.strptime(reqval, '%Y%m%d')
             idxfile = 'matches/matched/matches-full-{:04d}.csv'.format(d1.year)
             res = '{"no matches"}'
-            fieldlist = '_localtime,_mjd,_sol,_ID1,_amag,_ra_o,_dc_o,_ra_t,_dc_t,_elng,_elat,_vo,_vi,_vg,_vs,_a,_q,_e,_p,_peri,_node,_incl,'\
-                '_stream,_mag,_dur,_lng1,_lat1,_H1,_lng2,_lat2,_H2,_LD21,_az1r,_ev1r,_Nts,_Nos,_leap,_tme,_dt,'\
-                'dtstamp,orbname,iau,name,mass,pi,Q,true_anom,EA,MA,Tj,T,last_peri,jacchia1,Jacchia2,numstats,stations'
-            expr = f"SELECT {fieldlist} from s3object s where s._localtime like '_{reqval}%'"
+            expr = f"SELECT {SUMMARY_FIELDS} from s3object s where s._localtime like '_{reqval}%'"
             fhi = {"FileHeaderInfo": "Use"}
         elif reqtyp == 'matches':
             d1 = datetime.datetime.strptime(reqval, '%Y%m%d')
@@ -54,12 +144,15 @@ def lambda_handler(event, context):
             fhi = {"FileHeaderInfo": "Use"}
 
         s3 = boto3.client('s3')
-        resp = s3.select_object_content(Bucket=target, Key=idxfile, ExpressionType='SQL',
-            Expression=expr, InputSerialization={'CSV': fhi, 'CompressionType': 'NONE'}, OutputSerialization={'JSON': {}}, )
-        res=''
-        for event in resp['Payload']:
-            if 'Records' in event:
-                res = res + event['Records']['Payload'].decode('utf-8')
+        res = indexedQuery(s3, target, reqtyp, reqval, statid)
+        if res is None:
+            print('no usable index, using S3 Select')
+            resp = s3.select_object_content(Bucket=target, Key=idxfile, ExpressionType='SQL',
+                Expression=expr, InputSerialization={'CSV': fhi, 'CompressionType': 'NONE'}, OutputSerialization={'JSON': {}}, )
+            res=''
+            for event in resp['Payload']:
+                if 'Records' in event:
+                    res = res + event['Records']['Payload'].decode('utf-8')
         if reqtyp == 'summary':
             res = '[' + res.replace('}\n{','},\n{') +']'
         if points is True:
@@ -67,13 +160,8 @@ def lambda_handler(event, context):
             url = json.loads(res)['img']
             url = url.replace('ground_track.png','report.txt')
             reppth = url.split('//', 1)[1].split('/',1)[1]
-            _, repname = os.path.split(reppth)
             try:
-                tmpfname = f'/tmp/{repname}'
-                s3.download_file(webbuck, reppth, tmpfname)
-                flis = open(tmpfname, 'r').readlines()
-                os.remove(tmpfname)
-                res = fileToJsonString(flis)
+                res = json.dumps({'points': getReportPoints(s3, webbuck, reppth)})
             except Exception:
                 print('report file unavailable')
                 res = '{"points": "unavailable"}'
@@ -84,11 +172,26 @@ def lambda_handler(event, context):
     }
 
 
-def fileToJsonString(flis):
+def getReportPoints(s3, webbuck, reppth):
+    """ Return the points from a trajectory report, using the cache if possible. """
+    if reppth in POINTS_CACHE:
+        POINTS_CACHE.move_to_end(reppth)
+        return POINTS_CACHE[reppth]
+    obj = s3.get_object(Bucket=webbuck, Key=reppth)
+    flis = obj['Body'].read().decode('utf-8').splitlines(keepends=True)
+    pts = parseReportPoints(flis)
+    POINTS_CACHE[reppth] = pts
+    if len(POINTS_CACHE) > POINTS_CACHE_SIZE:
+        POINTS_CACHE.popitem(last=False)
+    return pts
+
+
+def parseReportPoints(flis):
+    """ Extract the table of points from a WMPL trajectory report as a list of dicts. """
     hdr = ['No','statid','ign','t','jd','m1','m2','az','alt','azl','altl','rao', 
            'deco','ral','decl','X','Y','Z','lat','lon','H','range','length','svd',
            'lag','vel','pvel', 'hres','vres','ares','vmag','amag']
-    ptsarray='['
+    pts = []
     gotpts = False
     for fli in flis:
         if 'Points' in fli:
@@ -97,15 +200,12 @@ def fileToJsonString(flis):
         elif '------' in fli or ' No' in fli:
             continue
         elif gotpts is True and (len(fli) < 2 or 'Notes' in fli):
-            gotpts=False
             break
         elif gotpts is True:
             spls = fli.split(',')
-            thisrow = '{'
-            for h, s in zip(hdr, spls):
-                thisrow = thisrow + f'"{h}": "{s.strip()}",'
-            thisrow = thisrow[:-1] + '},'
-            ptsarray = ptsarray + thisrow
-    ptsarray = ptsarray[:-1] + ']'
-    ptsarray = '{' + f'"points": {ptsarray}' + '}'
-    return ptsarray
+            pts.append({h: s.strip() for h, s in zip(hdr, spls)})
+    return pts
+
+
+def fileToJsonString(flis):
+    return json.dumps({'points': parseReportPoints(flis)})
@@ -3,6 +3,7 @@
 # script to scan live data as it arrives for brightness information
 
 import os
+import time
 import boto3
 from tempfile import mkdtemp
 from shutil import rmtree
@@ -11,77 +12,72 @@ from decimal import Decimal
 import json
 
 
-def storeInDDb(evtdets, camdets):
-    dtval = evtdets['dtval']
-    ffname = evtdets['ffname']
-    camid = camdets['camid']
-
-    bmax = evtdets['bmax']
-    bave = evtdets['bave']
-    bstd = evtdets['bstd']
-
-    # table partition key will be the night of capture
-    if dtval.hour < 13:
-        partkey = int((dtval - datetime.timedelta(days=1)).strftime('%Y%m%d'))
-    else:
-        partkey = int(dtval.strftime('%Y%m%d'))
-    #table sort key will be the timestamp because we can then easily do a range select
-    sortkey = dtval.timestamp()
-    sortkeydec = json.loads(json.dumps(sortkey), parse_float=Decimal)
-
-    expdate = int((dtval + datetime.timedelta(days=3)).timestamp())
-
-    ddb = boto3.resource('dynamodb', region_name='eu-west-2')
-    table = ddb.Table('LiveBrightness')
-
-    response = table.get_item(Key = {'CaptureNight': partkey, 'Timestamp': sortkeydec})
-    #can't have duplicate keys in dynamodb, so add a microsecond to identical values, unless its the same event
-    while 'Item' in response.keys():
-        if response['Item']['ffname'] == ffname:
+# DynamoDB limits on the number of items in one batch request
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+MAX_RETRIES = 8
+
+# how far behind a camera's high-water mark we remember which events have been stored, in seconds
+SEEN_WINDOW = int(os.getenv('SEENWINDOW', default='3600'))
+
+
+def toDecimal(val):
+    return json.loads(json.dumps(val), parse_float=Decimal)
+
+
+class LiveFeedWriter(object):
+    """ Collects the rows for the LiveBrightness and live tables and writes them in batches.
+
+    Duplicates are removed in memory, and the LiveBrightness keys are checked with batch_get_item
+    rather than an item at a time. The writer is kept for the life of the Lambda container, and
+    remembers the newest timestamp stored for each camera, along with the events stored within
+    SEEN_WINDOW of it, so a repeated event is skipped without reading the table at all.
+    """
+    def __init__(self, ddb=None):
+        if ddb is None:
+            ddb = boto3.resource('dynamodb', region_name='eu-west-2')
+        self.ddb = ddb
+        self.hwm = {}
+        self.recent = {}
+        self.brightness = []
+        self.pending = set()
+        self.live = {}
+
+    def addBrightness(self, evtdets, camdets):
+        dtval = evtdets['dtval']
+        ffname = evtdets['ffname']
+        camid = camdets['camid']
+
+        # table partition key will be the night of capture
+        if dtval.hour < 13:
+            partkey = int((dtval - datetime.timedelta(days=1)).strftime('%Y%m%d'))
+        else:
+            partkey = int(dtval.strftime('%Y%m%d'))
+        #table sort key will be the timestamp because we can then easily do a range select
+        sortkey = dtval.timestamp()
+        if ffname in self.recent.get(camid, {}) or ffname in self.pending:
             print(f'{ffname} already logged')
-            break
-        sortkey += 0.000001
-        sortkeydec = json.loads(json.dumps(sortkey), parse_float=Decimal)
-        response = table.get_item(Key = {'CaptureNight': partkey, 'Timestamp': sortkeydec})
-    print(f'inserting {ffname} with timestamp {sortkeydec}')
-    response = table.put_item(
-        Item={
-            'CaptureNight': partkey,
-            'Timestamp': sortkeydec,
-            'bmax': bmax, 
-            'bave': bave,
-            'bstd': bstd,
-            'camid': camid,
-            'ffname': ffname,
-            'ExpiryDate': expdate
-        }   
-    )    
-    #print(response)
-
-    return response['ResponseMetadata']['HTTPStatusCode']
-
-
-def updateLiveTable(event, dtval):
-    record = event['Records'][0]
-    fname = record['s3']['object']['key']
-    _, barefname = os.path.split(fname)
-    if 'P.jpg' not in barefname:
-        print(f'{barefname} not a jpg')
-        return 
-    expdate = int((dtval + datetime.timedelta(days=90)).timestamp())
-    tstamp = str(int(dtval.timestamp()*1000))
-    yr = dtval.strftime('%Y')
-    mth = dtval.strftime('%m')
-    ddb = boto3.resource('dynamodb', region_name='eu-west-2')
-    table = ddb.Table('live')
-    if barefname[0] == 'M':
-        statname = barefname[17:].replace('P.jpg','').replace('_',' ')
-    else:
-        statname = barefname[3:9]
-
-    print(f'inserting {barefname} with timestamp {dtval}')
-    response = table.put_item(
-        Item={
+            return
+        expdate = int((dtval + datetime.timedelta(days=3)).timestamp())
+        self.pending.add(ffname)
+        self.brightness.append({'CaptureNight': partkey, 'sortkey': sortkey, 'bmax': evtdets['bmax'], 
+            'bave': evtdets['bave'], 'bstd': evtdets['bstd'], 'camid': camid, 'ffname': ffname, 
+            'ExpiryDate': expdate})
+
+    def addLive(self, fname, dtval):
+        _, barefname = os.path.split(fname)
+        if 'P.jpg' not in barefname:
+            print(f'{barefname} not a jpg')
+            return 
+        expdate = int((dtval + datetime.timedelta(days=90)).timestamp())
+        tstamp = str(int(dtval.timestamp()*1000))
+        yr = dtval.strftime('%Y')
+        mth = dtval.strftime('%m')
+        if barefname[0] == 'M':
+            statname = barefname[17:].replace('P.jpg','').replace('_',' ')
+        else:
+            statname = barefname[3:9]
+        self.live[(barefname, tstamp)] = {
             'image_name': barefname,
             'timestamp': tstamp,
             'image_timestamp': tstamp, 
@@ -89,13 +85,104 @@ def updateLiveTable(event, dtval):
             'year': yr,
             'month': mth,
             'expirydate': expdate
-        }  
-    ) 
-    return response['ResponseMetadata']['HTTPStatusCode'] 
-
-
-def processXml(event):
-    record = event['Records'][0]
+        }
+
+    def _batchGet(self, tblname, keys):
+        # return the items that exist for the given keys, retrying any the service didn't process
+        found = []
+        for i in range(0, len(keys), BATCH_GET_SIZE):
+            request = {tblname: {'Keys': keys[i:i+BATCH_GET_SIZE]}}
+            for attempt in range(MAX_RETRIES):
+                response = self.ddb.batch_get_item(RequestItems=request)
+                found += response['Responses'].get(tblname, [])
+                request = response.get('UnprocessedKeys', {})
+                if not request:
+                    break
+                time.sleep(min(0.05 * 2**attempt, 2))
+            if request:
+                raise RuntimeError(f'unable to read {len(request[tblname]["Keys"])} keys from {tblname}')
+        return found
+
+    def _batchWrite(self, tblname, items):
+        for i in range(0, len(items), BATCH_WRITE_SIZE):
+            request = {tblname: [{'PutRequest': {'Item': item}} for item in items[i:i+BATCH_WRITE_SIZE]]}
+            for attempt in range(MAX_RETRIES):
+                response = self.ddb.batch_write_item(RequestItems=request)
+                request = response.get('UnprocessedItems', {})
+                if not request:
+                    break
+                time.sleep(min(0.05 * 2**attempt, 2))
+            if request:
+                raise RuntimeError(f'unable to write {len(request[tblname])} items to {tblname}')
+
+    def _resolveBrightness(self):
+        #can't have duplicate keys in dynamodb, so add a microsecond to identical values, unless its the same event
+        owners = {}
+        todo = self.brightness
+        toinsert = []
+        while len(todo) > 0:
+            for b in todo:
+                b['Timestamp'] = toDecimal(b['sortkey'])
+            unknown = list({(b['CaptureNight'], b['Timestamp']) for b in todo} - set(owners))
+            for key in unknown:
+                owners[key] = None
+            keys = [{'CaptureNight': k[0], 'Timestamp': k[1]} for k in unknown]
+            for item in self._batchGet('LiveBrightness', keys):
+                owners[(item['CaptureNight'], item['Timestamp'])] = item['ffname']
+            clashes = []
+            for b in todo:
+                key = (b['CaptureNight'], b['Timestamp'])
+                if owners[key] is None:
+                    owners[key] = b['ffname']
+                    toinsert.append(b)
+                elif owners[key] == b['ffname']:
+                    print(f'{b["ffname"]} already logged')
+                    self._remember(b)
+                else:
+                    b['sortkey'] += 0.000001
+                    clashes.append(b)
+            todo = clashes
+        return toinsert
+
+    def _remember(self, b):
+        camid = b['camid']
+        self.hwm[camid] = max(self.hwm.get(camid, b['sortkey']), b['sortkey'])
+        recent = self.recent.setdefault(camid, {})
+        recent[b['ffname']] = b['sortkey']
+        for ffname in [f for f in recent if recent[f] < self.hwm[camid] - SEEN_WINDOW]:
+            del recent[ffname]
+
+    def flush(self):
+        """ Write everything collected so far, returning the number of new LiveBrightness rows. """
+        try:
+            toinsert = self._resolveBrightness() if len(self.brightness) > 0 else []
+            for b in toinsert:
+                print(f'inserting {b["ffname"]} with timestamp {b["Timestamp"]}')
+            self._batchWrite('LiveBrightness', [{k: v for k, v in b.items() if k != 'sortkey'} for b in toinsert])
+            for b in toinsert:
+                self._remember(b)
+            for item in self.live.values():
+                print(f'inserting {item["image_name"]} with timestamp {item["timestamp"]}')
+            self._batchWrite('live', list(self.live.values()))
+        finally:
+            # if anything failed, the invocation is retried with the same events
+            self.brightness = []
+            self.pending = set()
+            self.live = {}
+        return len(toinsert)
+
+
+_writer = None
+
+
+def getWriter():
+    global _writer
+    if _writer is None:
+        _writer = LiveFeedWriter()
+    return _writer
+
+
+def processXml(record):
     fname = record['s3']['object']['key']
     buck = 'ukmda-live'
     s3 = boto3.resource('s3')
@@ -157,7 +244,10 @@ def processXml(event):
 
 
 def lambda_handler(event, context):
-    evtdets, camdets = processXml(event)
-    if evtdets is not None:
-        storeInDDb(evtdets, camdets)
-        updateLiveTable(event, evtdets['dtval'])
+    writer = getWriter()
+    for record in event['Records']:
+        evtdets, camdets = processXml(record)
+        if evtdets is not None:
+            writer.addBrightness(evtdets, camdets)
+            writer.addLive(record['s3']['object']['key'], evtdets['dtval'])
+    writer.flush()
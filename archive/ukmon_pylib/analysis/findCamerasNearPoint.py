@@ -4,31 +4,18 @@
 
 import os
 import sys
-import json
-import numpy as np
-import requests
 
-from meteortools.utils.Math import greatCircleDistance
+from reports.CameraDetails import loadCameraIndex, loadLocationDetails
 
-def camerasNearTo(lat, lon, distFromPt):
-    l1 = np.radians(lat)
-    g1 = np.radians(lon)
-    cams = []
+
+def camerasNearTo(lat, lon, distFromPt, camdets=None):
     datadir = os.getenv('DATADIR', default='/home/ec2-user/prod/data')
-    camdb = os.path.join(datadir, 'admin', 'cameraLocs.json')
-    caminfo = json.load(open(camdb))
-    for cam in caminfo:
-        l2 = np.radians(caminfo[cam]['lat'])
-        g2 = np.radians(caminfo[cam]['lon'])
-        dist = greatCircleDistance(l1, g1, l2, g2)
-        # print(dist)
-        if dist < distFromPt:
-            url = f'https://api.ukmeteors.co.uk/camdetails?camid={cam}'
-            res = requests.get(url)
-            if res.status_code == 200:
-                dta = json.loads(res.text)
-                cams.append(dta[0]['eMail'])
-    cams = list(set(cams))
+    nearby = loadCameraIndex(datadir).withinRadius(lat, lon, distFromPt)
+    nearby = nearby[nearby.dist < distFromPt]
+    # look up the owners in one go rather than calling the API for each camera
+    if camdets is None:
+        camdets = loadLocationDetails()
+    cams = sorted(set(camdets[camdets.stationid.isin(nearby.index)].eMail))
     camstr = ''
     for cam in cams:
         camstr = camstr + cam + ';'
@@ -5,10 +5,15 @@
 
 import sys
 import os
+import json
+import time
+import hashlib
 import pandas as pd
 import numpy as np
+import matplotlib
 from matplotlib import pyplot as plt
 import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 from meteortools.utils import getShowerDates as sd
 from meteortools.fileformats import imoWorkingShowerList as imo
@@ -17,6 +22,9 @@ SMALL_SIZE = 8
 MEDIUM_SIZE = 10
 BIGGER_SIZE = 12
 
+SNGL_COLS = ['Shwr','Dtstamp','Y','M','ID','Mag']
+MATCH_COLS = ['_M_ut', '_stream','_Nos','_ID1','_vg','_vs','_dur','_LD21','_H1','_H2','_ra_o','_dc_o','_a','_mag','_localtime','_amag', 'dtstamp']
+
 
 def logMessage(msg):
     dtstr = datetime.datetime.now().strftime('%b %d %H:%M:%S')
@@ -466,7 +474,108 @@ def magDistributionVis(dta, shwrname, outdir, binwidth=0.2):
     return min(magdf['Mag'])
 
 
-def showerAnalysis(shwr, dtstr):
+def loadShowerData(yr, datadir=None):
+    """ Read the year's single-station and matched data. This can be done once and shared between
+        calls to showerAnalysis when reporting on several showers.
+
+    Arguments:
+        yr: [int] the year to load.
+
+    Keyword arguments:
+        datadir: [str] the data folder. Default is $DATADIR.
+
+    Return:
+        sngl, mtch: [dataframes] the single-station and matched data.
+    """
+    if datadir is None:
+        datadir = os.getenv('DATADIR', default='/home/ec2-user/prod/data')
+    singleFile = os.path.join(datadir, 'single', f'singles-{yr}.parquet.snap')
+    sngl = pd.read_parquet(singleFile, columns=SNGL_COLS)
+    sngl = sngl[sngl['Y']==int(yr)] # just in case there's some pollution in the database
+    matchfile = os.path.join(datadir, 'matched', 'matches-full-{}.parquet.snap'.format(yr))
+    mtch = pd.read_parquet(matchfile, columns=MATCH_COLS)
+    return sngl, mtch
+
+
+def initChartWorker():
+    # the workers have no display
+    matplotlib.use('Agg')
+
+
+def chartPool(maxworkers=None):
+    """ Create a process pool for rendering charts. Pass it to showerAnalysis to share it between showers. """
+    if maxworkers is None:
+        maxworkers = int(os.getenv('CHARTWORKERS', default=min(8, os.cpu_count() or 1)))
+    return ProcessPoolExecutor(max_workers=maxworkers, initializer=initChartWorker)
+
+
+def renderChart(func, dta, args):
+    """ Render one chart, returning the function's result and how long it took. Runs in a worker process. """
+    start = time.time()
+    res = func(dta, *args)
+    return res, time.time() - start
+
+
+def chartHash(func, dta, args):
+    """ Hash a chart's input data and parameters, to tell whether it needs redrawing. """
+    hsh = hashlib.sha1(f'{func.__name__}{args}{list(dta.columns)}'.encode())
+    hsh.update(pd.util.hash_pandas_object(dta, index=False).values.tobytes())
+    return hsh.hexdigest()
+
+
+def renderCharts(jobs, outdir, cachefile, pool=None):
+    """ Render a set of charts in parallel, skipping any whose input data haven't changed since the last run.
+
+    Arguments:
+        jobs: [list] tuples of (name, func, dta, args, outfiles). Each chart is drawn by calling func(dta, *args),
+            and outfiles are the image files it creates.
+        outdir: [str] where the images are saved.
+        cachefile: [str] json file recording the hash, result and render time of each chart.
+
+    Keyword arguments:
+        pool: [ProcessPoolExecutor] pool to render in. If None, one is created for this set of charts.
+
+    Return:
+        [dict] the result of each chart's function, keyed on name.
+    """
+    cache = {}
+    if os.path.isfile(cachefile):
+        with open(cachefile) as inf:
+            cache = json.load(inf)
+
+    results = {}
+    futures = {}
+    ownpool = pool is None
+    if ownpool:
+        pool = chartPool()
+    try:
+        for name, func, dta, args, outfiles in jobs:
+            hsh = chartHash(func, dta, args)
+            prev = cache.get(name, {})
+            if prev.get('hash') == hsh and all([os.path.isfile(os.path.join(outdir, f)) for f in outfiles]):
+                logMessage(f'{name} unchanged, not redrawing')
+                results[name] = prev['result']
+                continue
+            futures[name] = (pool.submit(renderChart, func, dta, args), hsh)
+        for name, (fut, hsh) in futures.items():
+            res, elapsed = fut.result()
+            logMessage(f'{name} took {elapsed:.2f}s')
+            results[name] = res
+            # round-trip through json so a fresh result looks the same as a cached one
+            cache[name] = json.loads(json.dumps({'hash': hsh, 'result': res, 'rendertime': round(elapsed, 3),
+                'rendered': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}, default=lambda x: x.item()))
+    finally:
+        if ownpool:
+            pool.shutdown()
+
+    os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+    with open(cachefile + '.tmp', 'w') as outf:
+        json.dump(cache, outf, indent=2)
+    os.replace(cachefile + '.tmp', cachefile)
+    return results
+
+
+def showerAnalysis(shwr, dtstr, sngl=None, mtch=None, pool=None):
     datadir = os.getenv('DATADIR', default='/home/ec2-user/prod/data')
 
     # set up paths, files etc
@@ -482,19 +591,17 @@ def showerAnalysis(shwr, dtstr):
         outdir = os.path.join(datadir, 'reports', str(yr), shwr)
         
     os.makedirs(outdir, exist_ok=True)
+    # kept out of the reports folder so it isn't copied to the website
+    cachefile = os.path.join(datadir, 'chartcache', os.path.relpath(outdir, os.path.join(datadir, 'reports')), 'charts.json')
 
-    cols = ['Shwr','Dtstamp','Y','M','ID','Mag']
-    filt = None
     if shwr != 'ALL':
         sl = imo.IMOshowerList()
         maxdt = sl.getEnd(shwr) + datetime.timedelta(days=10)
         mindt = sl.getStart(shwr) + datetime.timedelta(days=-10)
 
-    # read the single-station data
-    singleFile = os.path.join(datadir, 'single', f'singles-{yr}.parquet.snap')
-    sngl = pd.read_parquet(singleFile, columns=cols, filters=filt)
-
-    sngl = sngl[sngl['Y']==int(yr)] # just in case there's some pollution in the database
+    # read the single-station and matched data, unless the caller already has
+    if sngl is None or mtch is None:
+        sngl, mtch = loadShowerData(yr, datadir)
 
     # select the required data
     if shwr != 'ALL':
@@ -502,6 +609,9 @@ def showerAnalysis(shwr, dtstr):
         sngl = sngl[sngl['Shwr']==shwr]
         sngl = sngl[sngl.Dtstamp > mindt.timestamp()]
         sngl = sngl[sngl.Dtstamp < maxdt.timestamp()]
+        mtch = mtch[mtch['_stream']==shwr]
+        mtch = mtch[mtch.dtstamp > mindt.timestamp()]
+        mtch = mtch[mtch.dtstamp < maxdt.timestamp()]
     else:
         shwrname = 'All Showers'
 
@@ -510,39 +620,47 @@ def showerAnalysis(shwr, dtstr):
         mthname = tmpdt.strftime('%B')
         shwrname = 'All Showers, {}'.format(mthname)
         sngl = sngl[sngl['M']==int(mth)]
+        mtch = mtch[mtch['_M_ut']==int(mth)]
 
-    numsngl = 0
-    numcams = 0
-    bestvmag = 0
-    # now get the graphs and stats
+    # each chart gets just the columns it uses, which keeps the hashing and copying to the workers cheap
+    jobs = []
     if len(sngl) > 0:
-        numsngl = timeGraph(sngl, shwrname, outdir, 10)
-        numcams = stationGraph(sngl, shwrname, outdir, 20)
-        bestvmag = magDistributionVis(sngl, shwrname, outdir)
+        jobs.append(('timeGraph', timeGraph, sngl[['Dtstamp','Shwr']], (shwrname, outdir, 10), ['02_stream_plot_timeline_single.jpg']))
+        jobs.append(('stationGraph', stationGraph, sngl[['ID']], (shwrname, outdir, 20), ['01_streamcounts_plot_by_station.jpg']))
+        jobs.append(('magDistributionVis', magDistributionVis, sngl[['Mag']], (shwrname, outdir), ['07_stream_plot_vis_mag.jpg']))
         if shwr == 'ALL':
-            showerGraph(sngl, 'observed', outdir)
-        pass
-    sngl = None
+            jobs.append(('showerGraphObserved', showerGraph, sngl[['Shwr']], ('observed', outdir), ['01_streamcounts_plot_shower_observed.jpg']))
 
-    cols = ['_M_ut', '_stream','_Nos','_ID1','_vg','_vs','_dur','_LD21','_H1','_H2','_ra_o','_dc_o','_a','_mag','_localtime','_amag', 'dtstamp']
-    filt = None
-    matchfile = os.path.join(datadir, 'matched', 'matches-full-{}.parquet.snap'.format(yr))
-    mtch = pd.read_parquet(matchfile, columns=cols, filters=filt)
+    if len(mtch) > 0:
+        if shwr == 'ALL':
+            binsize = 1440
+        else:
+            binsize = 60
+        jobs.append(('matchesGraphs', matchesGraphs, mtch[['_localtime','_ID1','_Nos']], (shwrname, outdir, binsize), 
+            ['03_stream_plot_timeline_matches.jpg', '04_stream_plot_by_correllation.jpg']))
+        jobs.append(('magDistributionAbs', magDistributionAbs, mtch[['_mag','_amag']], (shwrname, outdir), ['08_stream_plot_mag.jpg']))
+        jobs.append(('velDistributionVg', velDistribution, mtch[['_vg']], (shwrname, outdir, 'vg'), ['05_stream_plot_vel.jpg']))
+        jobs.append(('velDistributionVs', velDistribution, mtch[['_vs']], (shwrname, outdir, 'vs'), ['06_heliocentric_velocity.jpg']))
+        jobs.append(('distanceDistribution', distanceDistribution, mtch[['_LD21']], (shwrname, outdir), ['07_observed_trajectory_LD21.jpg']))
+        jobs.append(('durationDistribution', durationDistribution, mtch[['_dur']], (shwrname, outdir), ['13_meteor_duration.jpg']))
+        if mth is not None:
+            jobs.append(('ablationDistribution', ablationDistribution, mtch[['_H1','_H2']], (shwrname, outdir), ['11_stream_ablation.jpg']))
+        if shwr != 'ALL':
+            jobs.append(('semimajorDistribution', semimajorDistribution, mtch[['_a']], (shwrname, outdir), ['10_semimajoraxisfreq.jpg']))
+            jobs.append(('radiantDistribution', radiantDistribution, mtch[['_ra_o','_dc_o']], (shwrname, outdir), ['12_stream_plot_radiant.jpg']))
+        else:
+            jobs.append(('showerGraphMatched', showerGraph, mtch[['_stream']], ('matched', outdir), ['01_streamcounts_plot_shower_matched.jpg']))
 
-    # select the required data
-    if shwr != 'ALL':
-        id, shwrname, sl, dt = sd.getShowerDets(shwr)
-        mtch = mtch[mtch['_stream']==shwr]
-        mtch = mtch[mtch.dtstamp > mindt.timestamp()]
-        mtch = mtch[mtch.dtstamp < maxdt.timestamp()]
-    else:
-        shwrname = 'All Showers'
+    results = renderCharts(jobs, outdir, cachefile, pool)
 
-    if mth is not None:
-        tmpdt = datetime.datetime.strptime(mth, '%m')
-        mthname = tmpdt.strftime('%B')
-        shwrname = 'All Showers, {}'.format(mthname)
-        mtch = mtch[mtch['_M_ut']==int(mth)]
+    numsngl = 0
+    numcams = 0
+    bestvmag = 0
+    if len(sngl) > 0:
+        numsngl = results['timeGraph']
+        numcams = results['stationGraph']
+        bestvmag = results['magDistributionVis']
+    sngl = None
 
     nummatch = 0
     nummatched = 0
@@ -552,27 +670,15 @@ def showerAnalysis(shwr, dtstr):
     slowest = 0
 
     if len(mtch) > 0:
-        if shwr == 'ALL':
-            binsize = 1440
-        else:
-            binsize = 60
-
-        nummatch, nummatched = matchesGraphs(mtch, shwrname, outdir, binsize)
-        bestamag, bestvmag = magDistributionAbs(mtch, shwrname, outdir)
-        velDistribution(mtch, shwrname, outdir, 'vg')
-        velDistribution(mtch, shwrname, outdir, 'vs')
-        longest = distanceDistribution(mtch, shwrname, outdir)
-        slowest = durationDistribution(mtch, shwrname, outdir)
+        nummatch, nummatched = results['matchesGraphs']
+        bestamag, bestvmag = results['magDistributionAbs']
+        longest = results['distanceDistribution']
+        slowest = results['durationDistribution']
         if mth is not None:
-            lowest = ablationDistribution(mtch, shwrname, outdir)
+            lowest = results['ablationDistribution']
         else:
             lowest = min(mtch['_H2'])
         lowest = max(0, lowest) # can't be underground
-        if shwr != 'ALL':
-            semimajorDistribution(mtch, shwrname, outdir)
-            radiantDistribution(mtch, shwrname, outdir)
-        else:
-            showerGraph(mtch, 'matched', outdir)
     mtch = None
 
     # create summary file
@@ -11,6 +11,7 @@ import shutil
 import datetime
 import boto3
 from reports.CameraDetails import loadLocationDetails
+from converters.createStationIndex import loadStationIndex
 
 SMALL_SIZE = 8
 MEDIUM_SIZE = 10
@@ -133,7 +134,7 @@ def shwrGraph(dta, loc, outdir, when):
     return 'showers_by_station.jpg'
 
 
-def reportOneSite(yr, mth, loc, sngl, mful, idlist, outdir):
+def reportOneSite(yr, mth, loc, sngl, mful, idlist, outdir, statidx=None):
     print(f'processing {loc}')
     when = f'{yr}'
     if mth is not None:
@@ -162,10 +163,13 @@ def reportOneSite(yr, mth, loc, sngl, mful, idlist, outdir):
 
     # select the required data
     statfltr = sngl[sngl['ID'].isin(idlist)]
-    xtrafltr = pd.DataFrame()
-    for id in idlist:
-        xtmp = mful[mful['stations'].str.contains(id)]    
-        xtrafltr =pd.concat([xtrafltr,xtmp]).drop_duplicates()
+    if statidx is not None:
+        xtrafltr = statidx.select(mful, idlist).drop_duplicates()
+    else:
+        xtrafltr = pd.DataFrame()
+        for id in idlist:
+            xtmp = mful[mful['stations'].str.contains(id)]    
+            xtrafltr =pd.concat([xtrafltr,xtmp]).drop_duplicates()
     
     if mth is not None:
         if len(statfltr) > 0:
@@ -295,7 +299,10 @@ if __name__ == '__main__':
     camlist = loadLocationDetails()
    
     sngl = pd.read_parquet(os.path.join(datadir, 'single', f'singles-{yr}.parquet.snap'), columns=snglcols)
-    mful = pd.read_parquet(os.path.join(datadir, 'matched', f'matches-full-{yr}.parquet.snap'), columns=matchcols)
+    matchfile = os.path.join(datadir, 'matched', f'matches-full-{yr}.parquet.snap')
+    mful = pd.read_parquet(matchfile, columns=matchcols).reset_index(drop=True)
+    # row numbers of each station's matches, so we don't have to search the whole file for every station
+    statidx = loadStationIndex(matchfile)
 
     sngl = sngl[sngl['Y']==int(yr)] # just in case there's some pollution in the database
     mful = mful[mful['_Y_ut']==int(yr)] 
@@ -321,4 +328,4 @@ if __name__ == '__main__':
 
         os.makedirs(outdir, exist_ok=True)
 
-        numsngl, nummatch = reportOneSite(yr, mth, loc, sngl, mful, idlist, outdir)
+        numsngl, nummatch = reportOneSite(yr, mth, loc, sngl, mful, idlist, outdir, statidx)
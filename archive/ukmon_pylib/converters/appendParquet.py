@@ -0,0 +1,269 @@
+# incrementally maintain the yearly singles and matches parquet files
+# Copyright (C) 2018-2023 Mark McIntyre
+#
+# The yearly csv files only ever grow, but converting the whole year to parquet every night
+# means reprocessing millions of rows to add a few thousand. Instead, each night's rows are
+# written as a dated partition in a folder alongside the csv file, eg
+#
+#   single/singles-2023.parts/base.parquet.snap
+#   single/singles-2023.parts/20231201-020304-123456.parquet.snap
+#
+# and the single-file singles-2023.parquet.snap used by downloads and the reports is then
+# rebuilt by copying each partition in as a row group. Once there are too many partitions,
+# they're compacted back into the base partition.
+#
+# New rows are deduplicated against earlier partitions using a hash of the key columns,
+# stored alongside each partition, so the existing data doesn't need to be read again.
+
+import sys
+import os
+import json
+import datetime
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# columns that identify a duplicated match, as used in consolidateOutput.sh
+MATCH_KEYS = ['_mjd','_sol','_ID1','_ra_o','_dc_o','_amag','_ra_t','_dc_t']
+PART_SUFFIX = '.parquet.snap'
+KEY_SUFFIX = '.keys.npy'
+MANIFEST = 'manifest.json'
+BASE_PART = 'base'
+MAX_PARTS = 32
+
+
+def partsDir(csvfname):
+    fn, _ = os.path.splitext(csvfname)
+    return fn + '.parts'
+
+
+def isMatchFile(csvfname):
+    return 'match' in os.path.basename(csvfname)
+
+
+def readCsv(csvfname, ismatch):
+    """ Read a singles or matches csv file, tidying it up as toParquet does. """
+    df = pd.read_csv(csvfname, skipinitialspace=True)
+    # rename columns to be unique
+    df = df.rename(columns={'m':'mi'})
+    df = df.rename(columns={'_m_ut':'_mi_ut'})
+    if ismatch:
+        # fill in any #NAs in the mjd column
+        df['mjd'] = df.mjd.fillna(df._mjd)
+        df = df.drop_duplicates(subset=MATCH_KEYS)
+    else:
+        df = df.drop_duplicates()
+    return df.reset_index(drop=True)
+
+
+def keyHashes(df, ismatch):
+    """ Hash the columns used to identify duplicates. Numbers are hashed as floats, as a column
+        can be read as integers one night and floats the next.
+    """
+    keys = df[MATCH_KEYS].copy() if ismatch else df.copy()
+    for col in keys.columns:
+        if pd.api.types.is_numeric_dtype(keys[col]) and not pd.api.types.is_bool_dtype(keys[col]):
+            keys[col] = keys[col].astype(np.float64)
+    return pd.util.hash_pandas_object(keys, index=False).values
+
+
+def loadManifest(pqdir):
+    mfname = os.path.join(pqdir, MANIFEST)
+    if not os.path.isfile(mfname):
+        return {}
+    with open(mfname) as inf:
+        return json.load(inf)
+
+
+def saveManifest(pqdir, manifest):
+    mfname = os.path.join(pqdir, MANIFEST)
+    with open(mfname + '.tmp', 'w') as outf:
+        json.dump(manifest, outf, indent=2)
+    os.replace(mfname + '.tmp', mfname)
+
+
+def listPartitions(pqdir):
+    """ Return the partition names in the order they were written, base first. """
+    manifest = loadManifest(pqdir)
+    return sorted(manifest.keys(), key=lambda p: (p != BASE_PART, manifest[p]['written']))
+
+
+def changedPartitions(pqdir, since=None):
+    """ Report which partitions have been written since a given time.
+
+    Arguments:
+        pqdir: [str] the partition folder, eg single/singles-2023.parts
+
+    Keyword arguments:
+        since: [datetime or str] only report partitions written after this time (UTC). Default all.
+
+    Return:
+        [list] the full paths of the partitions, in the order they were written.
+    """
+    manifest = loadManifest(pqdir)
+    if isinstance(since, datetime.datetime):
+        since = since.strftime('%Y-%m-%dT%H:%M:%S')
+    parts = [p for p in listPartitions(pqdir) if since is None or manifest[p]['written'] > since]
+    return [os.path.join(pqdir, p + PART_SUFFIX) for p in parts]
+
+
+def readPartitions(pqdir, columns=None, filters=None, since=None):
+    """ Read the partitioned data into a dataframe, optionally just those written since a given time. """
+    parts = changedPartitions(pqdir, since)
+    if len(parts) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.read_parquet(parts, columns=columns, filters=filters)
+
+
+def newPartitionName(pqdir, manifest):
+    """ Return a name for a new partition, based on the current time, that isn't already in use. """
+    basename = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')
+    partname = basename
+    seq = 0
+    while partname in manifest or os.path.isfile(os.path.join(pqdir, partname + PART_SUFFIX)):
+        seq += 1
+        partname = f'{basename}-{seq}'
+    return partname
+
+
+def writePartition(pqdir, partname, df, ismatch, schema=None, manifest=None, overwrite=False):
+    """ Write a dataframe as a partition along with the hashes of its keys, and record it in the manifest.
+        If a schema is supplied the data are cast to it, which raises an exception if that's not possible.
+        An existing partition is only replaced if overwrite is True, otherwise FileExistsError is raised.
+    """
+    if manifest is None:
+        manifest = loadManifest(pqdir)
+    fname = os.path.join(pqdir, partname + PART_SUFFIX)
+    if not overwrite and (partname in manifest or os.path.isfile(fname)):
+        raise FileExistsError(f'partition {partname} already exists in {pqdir}')
+    tbl = pa.Table.from_pandas(df, preserve_index=False)
+    if schema is not None:
+        tbl = tbl.select(schema.names).cast(schema)
+    pq.write_table(tbl, fname + '.tmp', compression='snappy')
+    os.replace(fname + '.tmp', fname)
+    np.save(os.path.join(pqdir, partname + KEY_SUFFIX), keyHashes(df, ismatch))
+    manifest[partname] = {'rows': len(df), 'written': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')}
+    saveManifest(pqdir, manifest)
+    return manifest
+
+
+def removePartition(pqdir, partname):
+    for suff in [PART_SUFFIX, KEY_SUFFIX]:
+        fname = os.path.join(pqdir, partname + suff)
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+
+def writeSingleFile(csvfname):
+    """ Rebuild the single-file parquet artefact by copying in each partition as row groups.
+        Nothing is converted from csv, and the data are never all held in memory at once.
+    """
+    pqdir = partsDir(csvfname)
+    fn, _ = os.path.splitext(csvfname)
+    outfname = fn + PART_SUFFIX
+    parts = changedPartitions(pqdir)
+    schema = pq.read_schema(parts[0]).remove_metadata()
+    with pq.ParquetWriter(outfname + '.tmp', schema, compression='snappy') as writer:
+        for part in parts:
+            writer.write_table(pq.read_table(part).replace_schema_metadata())
+    os.replace(outfname + '.tmp', outfname)
+    return outfname
+
+
+def rebuild(csvfname):
+    """ Recreate the partitions from scratch using the whole year's csv file. """
+    ismatch = isMatchFile(csvfname)
+    pqdir = partsDir(csvfname)
+    os.makedirs(pqdir, exist_ok=True)
+    for part in loadManifest(pqdir).keys():
+        removePartition(pqdir, part)
+    saveManifest(pqdir, {})
+    print(f'rebuilding {pqdir} from {csvfname}')
+    writePartition(pqdir, BASE_PART, readCsv(csvfname, ismatch), ismatch, manifest={}, overwrite=True)
+    return writeSingleFile(csvfname)
+
+
+def compact(csvfname):
+    """ Merge all the partitions back into the base partition. """
+    ismatch = isMatchFile(csvfname)
+    pqdir = partsDir(csvfname)
+    parts = listPartitions(pqdir)
+    if len(parts) < 2:
+        return
+    print(f'compacting {len(parts)} partitions in {pqdir}')
+    schema = pq.read_schema(changedPartitions(pqdir)[0]).remove_metadata()
+    tbl = pa.concat_tables([pq.read_table(p).replace_schema_metadata() for p in changedPartitions(pqdir)])
+    # new rows were deduplicated as they arrived, but do it again in case of rows from an interrupted run
+    df = tbl.to_pandas()
+    df = df.drop_duplicates(subset=MATCH_KEYS if ismatch else None).reset_index(drop=True)
+    writePartition(pqdir, BASE_PART, df, ismatch, schema=schema, manifest={}, overwrite=True)
+    for part in parts:
+        if part != BASE_PART:
+            removePartition(pqdir, part)
+    return
+
+
+def appendCsv(csvfname, newcsv, maxparts=MAX_PARTS):
+    """ Add the rows in newcsv to the parquet data for csvfname, and update the single-file artefact.
+
+    Arguments:
+        csvfname: [str] the yearly csv file, eg single/singles-2023.csv, which newcsv's rows have already been added to.
+        newcsv: [str] csv file containing tonight's new rows.
+
+    Keyword arguments:
+        maxparts: [int] compact the partitions once there are more than this many. Default 32.
+
+    Return:
+        [str] the name of the single-file parquet artefact.
+    """
+    ismatch = isMatchFile(csvfname)
+    pqdir = partsDir(csvfname)
+    manifest = loadManifest(pqdir)
+    if BASE_PART not in manifest:
+        # first run, so the yearly csv file is the only source of data
+        return rebuild(csvfname)
+
+    newdf = readCsv(newcsv, ismatch)
+    seen = np.concatenate([np.load(os.path.join(pqdir, p + KEY_SUFFIX)) for p in listPartitions(pqdir)])
+    newdf = newdf[~np.isin(keyHashes(newdf, ismatch), seen)].reset_index(drop=True)
+    print(f'{len(newdf)} new rows for {pqdir}')
+    if len(newdf) > 0:
+        schema = pq.read_schema(os.path.join(pqdir, BASE_PART + PART_SUFFIX)).remove_metadata()
+        partname = newPartitionName(pqdir, manifest)
+        try:
+            manifest = writePartition(pqdir, partname, newdf, ismatch, schema=schema, manifest=manifest)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, KeyError, ValueError) as e:
+            # tonight's data can't be made to match the types of the existing data
+            print(f'unable to append to {pqdir}: {e}')
+            removePartition(pqdir, partname)
+            return rebuild(csvfname)
+        if len(manifest) > maxparts:
+            compact(csvfname)
+    return writeSingleFile(csvfname)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Incrementally maintain the yearly parquet files.')
+    arg_parser.add_argument('action', choices=['append', 'compact', 'rebuild', 'changed'], help='what to do')
+    arg_parser.add_argument('csvfile', help='the yearly csv file, eg singles-2023.csv')
+    arg_parser.add_argument('newcsv', nargs='?', help='csv file of new rows, for append')
+    arg_parser.add_argument('-s', '--since', help='for changed, report partitions written after this time eg 2023-12-01T00:00:00')
+    arg_parser.add_argument('-m', '--maxparts', type=int, default=MAX_PARTS, help='compact after this many partitions')
+    args = arg_parser.parse_args()
+
+    if args.action == 'append':
+        if args.newcsv is None:
+            print('append needs the csv file of new rows')
+            sys.exit(1)
+        appendCsv(args.csvfile, args.newcsv, args.maxparts)
+    elif args.action == 'compact':
+        compact(args.csvfile)
+        writeSingleFile(args.csvfile)
+    elif args.action == 'rebuild':
+        rebuild(args.csvfile)
+    else:
+        for part in changedPartitions(partsDir(args.csvfile), args.since):
+            print(part)
@@ -0,0 +1,55 @@
+# create an index of the rows in a matches-full-yyyy.csv file
+# Copyright (C) 2018-2023 Mark McIntyre
+#
+# The index gives the byte offset and length of each row, so that the match data API can fetch 
+# the rows it needs with ranged reads instead of scanning the whole year's file. One index file 
+# is written per day, named after the date in the _localtime column. 
+
+import sys
+import os
+import csv
+import json
+
+
+def createMatchIndex(csvfname, outdir=None):
+    """ Index the rows of a matches-full CSV file by day.
+
+    Arguments:
+        csvfname: [str] full path to the matches-full-yyyy.csv file.
+
+    Keyword arguments:
+        outdir: [str] where to write the index files. Default is index/yyyy alongside the csv file.
+
+    Return:
+        [int] number of days indexed.
+    """
+    matchdir, fname = os.path.split(csvfname)
+    yr = fname.split('-')[2][:4]
+    if outdir is None:
+        outdir = os.path.join(matchdir, 'index', yr)
+    os.makedirs(outdir, exist_ok=True)
+
+    days = {}
+    with open(csvfname, 'rb') as inf:
+        hdrline = inf.readline()
+        header = next(csv.reader([hdrline.decode('utf-8')]))
+        orbcol = header.index('orbname')
+        ltcol = header.index('_localtime')
+        stcol = header.index('stations')
+        offset = len(hdrline)
+        for lin in inf:
+            row = next(csv.reader([lin.decode('utf-8')]), None)
+            if row is not None and len(row) == len(header):
+                # _localtime looks like _20230411_201500
+                day = row[ltcol].strip()[1:9]
+                days.setdefault(day, []).append([offset, len(lin), row[orbcol].strip(), row[stcol].strip()])
+            offset += len(lin)
+
+    for day, rows in days.items():
+        with open(os.path.join(outdir, f'{day}.json'), 'w') as outf:
+            json.dump({'file': fname, 'size': offset, 'header': header, 'rows': rows}, outf)
+    return len(days)
+
+
+if __name__ == '__main__':
+    createMatchIndex(sys.argv[1])
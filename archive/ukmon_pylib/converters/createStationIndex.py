@@ -0,0 +1,109 @@
+# create an index from station id to the rows of the matches parquet file
+# Copyright (C) 2018-2023 Mark McIntyre
+#
+# Finding the matches a station contributed to means searching the stations column of every
+# match, which the station reports did once per camera. This index is built in one pass and
+# saved alongside the parquet file as matches-full-yyyy.stations.npz, so that the rows for
+# a station can be picked out directly.
+
+import sys
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+
+INDEX_SUFFIX = '.stations.npz'
+
+
+class StationIndex(object):
+    """ Maps station ids to row numbers in the matches parquet file.
+
+    Attributes:
+        stations: [ndarray] sorted station ids.
+        offsets: [ndarray] the rows for stations[i] are rows[offsets[i]:offsets[i+1]].
+        rows: [ndarray] row numbers, sorted within each station.
+    """
+    def __init__(self, stations, offsets, rows):
+        self.stations = stations
+        self.offsets = offsets
+        self.rows = rows
+
+    def rowsFor(self, statids):
+        """ Return the sorted row numbers of the matches that any of statids took part in. """
+        res = []
+        for statid in statids:
+            i = np.searchsorted(self.stations, statid)
+            if i < len(self.stations) and self.stations[i] == statid:
+                res.append(self.rows[self.offsets[i]:self.offsets[i+1]])
+        if len(res) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(res))
+
+    def select(self, df, statids):
+        """ Select the matches that any of statids took part in. df must be read from the indexed
+            parquet file, and may have been filtered, but not reindexed.
+        """
+        pos = df.index.get_indexer(self.rowsFor(statids))
+        return df.iloc[pos[pos >= 0]]
+
+    def counts(self):
+        """ Return a series of the number of matches for each station. """
+        return pd.Series(np.diff(self.offsets), index=self.stations)
+
+
+def buildStationIndex(stations):
+    """ Build the index from the stations column of the matches data.
+
+    Arguments:
+        stations: [Series] the stations column, each entry a list of station ids separated by semicolons.
+
+    Return:
+        [StationIndex]
+    """
+    exploded = stations.reset_index(drop=True).fillna('').str.split(r'[^A-Za-z0-9]+').explode()
+    exploded = exploded[exploded.str.len() > 0]
+    statids = exploded.to_numpy(dtype=str)
+    rows = exploded.index.values.astype(np.int64)
+    # sorting by station then row groups each station's rows together, in order
+    order = np.lexsort((rows, statids))
+    statids = statids[order]
+    rows = rows[order]
+    keep = np.ones(len(rows), dtype=bool)
+    keep[1:] = (statids[1:] != statids[:-1]) | (rows[1:] != rows[:-1])
+    statids = statids[keep]
+    rows = rows[keep]
+    uniq, starts = np.unique(statids, return_index=True)
+    offsets = np.append(starts, len(rows)).astype(np.int64)
+    return StationIndex(uniq, offsets, rows)
+
+
+def sourceStamp(pqfname):
+    return np.array([pq.ParquetFile(pqfname).metadata.num_rows, os.stat(pqfname).st_mtime_ns], dtype=np.int64)
+
+
+def createStationIndex(pqfname):
+    """ Build the station index for a matches parquet file and save it alongside. """
+    stations = pd.read_parquet(pqfname, columns=['stations'])['stations']
+    statidx = buildStationIndex(stations)
+    idxfname = pqfname.replace('.parquet.snap', INDEX_SUFFIX)
+    # np.savez adds .npz to names that don't end with it
+    tmpfname = idxfname.replace('.npz', '.tmp.npz')
+    np.savez(tmpfname, stations=statidx.stations, offsets=statidx.offsets, rows=statidx.rows, stamp=sourceStamp(pqfname))
+    os.replace(tmpfname, idxfname)
+    return statidx
+
+
+def loadStationIndex(pqfname):
+    """ Load the station index for a matches parquet file, rebuilding it if the parquet file has changed. """
+    idxfname = pqfname.replace('.parquet.snap', INDEX_SUFFIX)
+    if os.path.isfile(idxfname):
+        with np.load(idxfname) as data:
+            if np.array_equal(data['stamp'], sourceStamp(pqfname)):
+                return StationIndex(data['stations'], data['offsets'], data['rows'])
+    print(f'creating station index for {pqfname}')
+    return createStationIndex(pqfname)
+
+
+if __name__ == '__main__':
+    createStationIndex(sys.argv[1])
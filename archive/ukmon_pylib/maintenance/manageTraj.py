@@ -5,6 +5,8 @@ import os
 import pandas as pd
 import boto3
 
+from converters.appendParquet import rebuild as rebuildParquet
+
 
 # delete an orbit from the database
 def deleteDuplicate(trajname):
@@ -24,9 +26,10 @@ def deleteDuplicate(trajname):
     idx = df[df.orbname==trajname].index
     if len(idx) > 0:
         df = df.drop(index=idx)
-        df.to_parquet(fname, compression='snappy')
         csvfname = os.path.join(datadir, 'matched','matches-full-{}.csv'.format(yr))
         df.to_csv(csvfname, index=False)
+        # recreate the parquet file and its partitions so the change isn't lost on the next append
+        rebuildParquet(csvfname)
 
         deleteWebPage(trajname)
         return 1
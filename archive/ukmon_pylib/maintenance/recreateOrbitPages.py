@@ -4,6 +4,8 @@ import boto3
 import platform
 from wmpl.Utils.Pickling import loadPickle, savePickle
 from traj.pickleAnalyser import createAdditionalOutput
+from traj.ShowerAssociation import associateShowerTrajs
+from reports.imageManifest import getManifestStore, captureNight, listPublished
 import requests
 import datetime
 import json
@@ -36,12 +38,40 @@ def getExtraArgs(fname):
 
 
 def getImgList(outdir, traj):
+    """ Return the names of the jpgs that may belong to the trajectory's observations.
+
+    The jpgs folder alongside the trajectory is used if there is one. Otherwise, for each station with 
+    an image manifest for the night that records published jpgs, those from 10s before to 20s after the 
+    trajectory are listed. The other stations' images are found with the live images API, as before.
+
+    Arguments:
+        outdir: [str] Folder holding the trajectory.
+        traj: [Trajectory] The trajectory.
+
+    Return:
+        [list] jpg file names, eg FF_UK0006_20231201_201234_567_012345.jpg
+    """
     if os.path.isdir(os.path.join(outdir, '..', 'jpgs')):
         imglist = os.listdir(os.path.join(outdir, '..', 'jpgs'))
         return imglist
     orbname=traj.output_dir.replace('\\','/').split('/')[-1]
-    testdt = datetime.datetime.strptime(orbname.replace('-','_')[:15], '%Y%m%d_%h%m%s')
+    testdt = datetime.datetime.strptime(orbname.replace('-','_')[:15], '%Y%m%d_%H%M%S')
     testdt = testdt + datetime.timedelta(seconds=-10)
+
+    # use the nightly image manifests for the stations that have them
+    store = getManifestStore(boto3.client('s3'), os.getenv('UKMONSHAREDBUCKET', default='s3://ukmda-shared'))
+    night = captureNight(testdt.strftime('%Y%m%d'), testdt.strftime('%H%M%S'))
+    imglist = []
+    livestats = []
+    for statid in sorted(set(obs.station_id for obs in traj.observations)):
+        keys = listPublished(store, statid, night, 'jpg', testdt, testdt + datetime.timedelta(seconds=30))
+        if keys:
+            imglist += [os.path.basename(k) for k in keys]
+        else:
+            livestats.append(statid)
+    if len(livestats) == 0:
+        return imglist
+
     dtstr = testdt.strftime('%Y-%m-%dT%H:%M:%S.000Z')
     dtstr2 = (testdt + datetime.timedelta(seconds=30)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
     apiurl = 'https://api.ukmeteors.co.uk/liveimages/getlive'
@@ -49,9 +79,9 @@ def getImgList(outdir, traj):
     res = requests.get(apiurl)
     if res.status_code == 200:
         jsondata = json.loads(res.text)
-        return jsondata['images']
+        return imglist + [img for img in jsondata['images'] if any(statid in img for statid in livestats)]
     else:
-        return []
+        return imglist
 
 
 def createExtraJpgtxt(outdir, traj, availableimages):
@@ -134,8 +164,9 @@ def fixupTrajComments(traj, availableimages, outdir, picklename):
     return
 
 
-def recreateOrbitFiles(outdir, pickname, doupload=False):
-    traj = loadPickle(outdir, pickname)
+def recreateOrbitFiles(outdir, pickname, doupload=False, traj=None, shower_obj=None, associated=False):
+    if traj is None:
+        traj = loadPickle(outdir, pickname)
     traj.save_results = True
     # need to add the enable_OSM_plot attribute if its missing
     if not hasattr(traj,'enable_OSM_plot'):
@@ -143,7 +174,7 @@ def recreateOrbitFiles(outdir, pickname, doupload=False):
         savePickle(traj, outdir, pickname)
     print('loaded pickle')
     if platform.node() == 'MARKSDT':
-        createAdditionalOutput(traj, outdir)
+        createAdditionalOutput(traj, outdir, shower_obj=shower_obj, associated=associated)
         print('created additional output')
     basename = pickname[:15]
     repname = basename + '_report.txt'
@@ -185,14 +216,39 @@ def recreateOrbitFiles(outdir, pickname, doupload=False):
     return 
 
 
-if __name__ == '__main__':
-    dirnam, picknam = os.path.split(sys.argv[1])
-    doupload = False
-    if len(sys.argv) > 2: 
-        doupload = True
+def fixupOrbitFolder(picklename):
+    """ Rename an old-style orbit folder, eg 20231201-201234.567, to the current style. """
+    dirnam, picknam = os.path.split(picklename)
     if '-' in dirnam:
         newdirnam = dirnam[:-3].replace('-','_') + '_UK'
         os.rename(dirnam, newdirnam)
-        recreateOrbitFiles(newdirnam, picknam, doupload)
-    else:
-        recreateOrbitFiles(dirnam, picknam, doupload)
+        dirnam = newdirnam
+    return dirnam, picknam
+
+
+def recreateManyOrbitFiles(picklenames, doupload=False, chunksize=100):
+    """ Recreate the orbit pages of many trajectories. The trajectories are loaded a chunk at a time 
+        and each chunk is associated with showers in one call.
+
+    Arguments:
+        picklenames: [list] Full paths to the trajectory pickles.
+
+    Keyword arguments:
+        doupload: [bool] Upload the results to the website. Default False.
+        chunksize: [int] Number of trajectories to hold in memory at once. Default 100.
+    """
+    for i in range(0, len(picklenames), chunksize):
+        chunk = [fixupOrbitFolder(p) for p in picklenames[i:i+chunksize]]
+        trajs = [loadPickle(dirnam, picknam) for dirnam, picknam in chunk]
+        # the shower is only needed for the additional output
+        associated = platform.node() == 'MARKSDT'
+        showers = associateShowerTrajs(trajs) if associated else [None]*len(trajs)
+        for (dirnam, picknam), traj, shower_obj in zip(chunk, trajs, showers):
+            recreateOrbitFiles(dirnam, picknam, doupload, traj=traj, shower_obj=shower_obj, associated=associated)
+
+
+if __name__ == '__main__':
+    # any argument that isn't a pickle, eg 'force', means upload the results
+    picklenames = [a for a in sys.argv[1:] if a.endswith('.pickle')]
+    doupload = len(picklenames) < len(sys.argv) - 1
+    recreateManyOrbitFiles(picklenames, doupload)
@@ -3,13 +3,26 @@
 import os
 import glob 
 import json
+import time
+import datetime
+from decimal import Decimal
+import numpy as np
 import pandas as pd 
+import pyarrow as pa
+import pyarrow.parquet as pq
 import boto3
+from scipy.spatial import cKDTree
 
 '''
 creating and managing the more-accurate camera location info
 '''
 
+EARTH_RADIUS = 6371.0
+
+# bump this if the layout of the camera details snapshot changes, so that old ones are discarded
+SNAPSHOT_VERSION = 1
+SNAPSHOT_META_KEY = b'ukmda_snapshot'
+
 
 def getCamLocDirFov(camid, datadir=None):
     if datadir is None:
@@ -39,17 +52,238 @@ def updateCamLocDirFovDB(datadir=None):
         json.dump(camdb, outf, indent=4)
 
 
-def loadLocationDetails(table='camdetails', ddb=None, loadall=False):
+def greatCircleDistances(lat1, lon1, lat2, lon2):
+    """ Great circle distance in km between points given in degrees. Any of the arguments may be
+        arrays or Series, which are broadcast against each other.
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype=float)) for x in [lat1, lon1, lat2, lon2]]
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1)/2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def unitVectors(lat, lon):
+    """ Convert latitudes and longitudes in degrees to an array of unit vectors, one per row. """
+    lat = np.radians(np.atleast_1d(np.asarray(lat, dtype=float)))
+    lon = np.radians(np.atleast_1d(np.asarray(lon, dtype=float)))
+    return np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+
+
+class CameraIndex(object):
+    """ Spatial index of camera locations, for finding cameras near a point or able to see it.
+
+    The cameras are held in a KD-tree of unit vectors on the sphere, where the straight-line distance
+    between two vectors increases with the great circle distance between the locations.
+
+    Arguments:
+        camdb: [dict] camera details keyed by camera id, as saved in cameraLocs.json by updateCamLocDirFovDB.
+
+    Attributes:
+        cams: [DataFrame] the camera details, indexed by camera id.
+    """
+    def __init__(self, camdb):
+        self.cams = pd.DataFrame.from_dict(camdb, orient='index').sort_index()
+        self.xyz = unitVectors(self.cams.lat, self.cams.lon)
+        self.tree = cKDTree(self.xyz)
+
+    def _results(self, rows, lat, lon):
+        res = self.cams.iloc[rows].copy()
+        res['dist'] = greatCircleDistances(lat, lon, res.lat, res.lon)
+        return res.sort_values(by=['dist'])
+
+    def withinRadius(self, lat, lon, radius):
+        """ Return the cameras within radius km of a point, nearest first, with a column dist giving
+            the distance in km.
+        """
+        # chord length subtended by the radius, with a little slack for rounding
+        chord = 2 * np.sin(min(radius / EARTH_RADIUS, np.pi) / 2) * 1.000001
+        rows = self.tree.query_ball_point(unitVectors(lat, lon)[0], chord)
+        res = self._results(sorted(rows), lat, lon)
+        return res[res.dist <= radius]
+
+    def nearest(self, lat, lon, k=1):
+        """ Return the k nearest cameras to a point, nearest first, with a column dist giving the distance in km. """
+        k = min(k, len(self.cams))
+        if k == 0:
+            return self._results([], lat, lon)
+        _, rows = self.tree.query(unitVectors(lat, lon)[0], k=k)
+        return self._results(np.atleast_1d(rows), lat, lon)
+
+    def camerasViewing(self, lat, lon, height, maxdist=1000):
+        """ Return the cameras whose field of view covers a point.
+
+        Arguments:
+            lat: [float] latitude of the point in degrees.
+            lon: [float] longitude of the point in degrees.
+            height: [float] height of the point above the ground in km.
+
+        Keyword arguments:
+            maxdist: [float] only consider cameras within this many km of the point. Default 1000.
+
+        Return:
+            [DataFrame] the cameras, nearest first, with columns dist giving the ground distance in km,
+            and offaxis giving the angle of the point from the centre of the field of view in degrees.
+        """
+        cams = self.withinRadius(lat, lon, maxdist)
+        up = unitVectors(cams.lat, cams.lon)
+        clat, clon = np.radians(cams.lat.values), np.radians(cams.lon.values)
+        east = np.column_stack([-np.sin(clon), np.cos(clon), np.zeros(len(cams))])
+        north = np.column_stack([-np.sin(clat)*np.cos(clon), -np.sin(clat)*np.sin(clon), np.cos(clat)])
+
+        # line of sight from each camera to the point
+        campos = up * (EARTH_RADIUS + cams.ele.values[:, None]/1000.0)
+        los = unitVectors(lat, lon)[0] * (EARTH_RADIUS + height) - campos
+        los = los / np.linalg.norm(los, axis=1)[:, None]
+
+        # direction each camera is pointing, from the azimuth (east of north) and altitude
+        az, alt = np.radians(cams.az.values), np.radians(cams.alt.values)
+        pointing = (east * (np.cos(alt)*np.sin(az))[:, None] + north * (np.cos(alt)*np.cos(az))[:, None]
+            + up * np.sin(alt)[:, None])
+
+        cams = cams.copy()
+        cams['offaxis'] = np.degrees(np.arccos(np.clip(np.sum(los * pointing, axis=1), -1, 1)))
+        # treat the field of view as a circle with the same diagonal, and the point must be above the horizon
+        halffov = np.sqrt(cams.fov_h**2 + cams.fov_v**2) / 2
+        above = np.sum(los * up, axis=1) > 0
+        return cams[(cams.offaxis <= halffov) & above]
+
+
+_camIndexes = {}
+
+
+def loadCameraIndex(datadir=None):
+    """ Return a CameraIndex of the cameras in cameraLocs.json, building it once per process
+        and again only if the file has changed.
+    """
+    if datadir is None:
+        datadir = os.getenv('DATADIR', default='/home/ec2-user/prod/data/')
+    camlocs = os.path.join(datadir, 'admin', 'cameraLocs.json')
+    mtime = os.stat(camlocs).st_mtime_ns
+    if camlocs not in _camIndexes or _camIndexes[camlocs][0] != mtime:
+        with open(camlocs) as inf:
+            _camIndexes[camlocs] = (mtime, CameraIndex(json.load(inf)))
+    return _camIndexes[camlocs][1]
+
+
+def _plainValue(val):
+    # DynamoDB returns all numbers as Decimals, which can't be saved to parquet alongside other types
+    if isinstance(val, Decimal):
+        return int(val) if val == val.to_integral_value() else float(val)
+    return val
+
+
+def scanTable(table, ddb):
+    """ Scan the whole of a DynamoDB table, following LastEvaluatedKey across pages.
+
+    Arguments:
+        table: [str] name of the table.
+        ddb: [object] boto3 DynamoDB resource.
+
+    Return:
+        [DataFrame] one row per item.
+    """
+    tbl = ddb.Table(table)
+    kwargs = {}
+    items = []
+    while True:
+        res = tbl.scan(**kwargs)
+        items += [{k: _plainValue(v) for k, v in item.items()} for item in res.get('Items', [])]
+        if 'LastEvaluatedKey' not in res:
+            break
+        kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
+    df = pd.DataFrame(items)
+    # columns with a mix of types, eg numbers and strings, are saved as strings
+    for col in df.columns:
+        if df[col].dtype == object and df[col].dropna().map(type).nunique() > 1:
+            df[col] = df[col].map(lambda x: x if pd.isna(x) else str(x))
+    return df
+
+
+def tableMarker(table, ddb):
+    """ Return the item count and size of a table, which change when items are added or removed.
+        DynamoDB only updates these every few hours, so they can't be relied on alone.
+        Returns None if the table can't be described.
+    """
+    try:
+        desc = ddb.meta.client.describe_table(TableName=table)['Table']
+        return [desc['ItemCount'], desc['TableSizeBytes']]
+    except Exception as e:
+        print(f'unable to describe {table}: {e}')
+        return None
+
+
+def _readSnapshot(snapfile):
+    if not os.path.isfile(snapfile):
+        return None, None
+    try:
+        tbl = pq.read_table(snapfile)
+        meta = json.loads(tbl.schema.metadata[SNAPSHOT_META_KEY])
+    except Exception as e:
+        print(f'unable to read {snapfile}: {e}')
+        return None, None
+    if meta.get('version') != SNAPSHOT_VERSION:
+        return None, None
+    return meta, tbl.to_pandas()
+
+
+def _writeSnapshot(snapfile, df, meta):
+    try:
+        os.makedirs(os.path.dirname(snapfile), exist_ok=True)
+        tbl = pa.Table.from_pandas(df, preserve_index=False)
+        tbl = tbl.replace_schema_metadata({**tbl.schema.metadata, SNAPSHOT_META_KEY: json.dumps(meta).encode()})
+        pq.write_table(tbl, snapfile + '.tmp', compression='snappy')
+        os.replace(snapfile + '.tmp', snapfile)
+    except Exception as e:
+        print(f'unable to save {snapfile}: {e}')
+
+
+_snapshots = {}
+
+
+def getTableSnapshot(table='camdetails', ddb=None, refresh=False, ttl=None):
+    """ Return the contents of a DynamoDB table, from memory if it's been read in this process within
+        the TTL, otherwise from a local parquet snapshot in $DATADIR/admin if that's within the TTL and
+        the table's item count and size haven't changed, and otherwise by scanning the table again.
+
+    Keyword arguments:
+        table: [str] name of the table. Default camdetails.
+        ddb: [object] boto3 DynamoDB resource, created if needed.
+        refresh: [bool] scan the table even if the snapshot is current. Default False.
+        ttl: [float] maximum age of the snapshot in seconds. Default $CAMDETAILSTTL or 3600.
+
+    Return:
+        [DataFrame] the table contents. This is shared between callers, so must not be modified.
+    """
+    if ttl is None:
+        ttl = float(os.getenv('CAMDETAILSTTL', default='3600'))
+    now = time.time()
+    cached = _snapshots.get(table)
+    if not refresh and cached is not None and now - cached[0] < ttl:
+        return cached[1]
+
     if not ddb:
         prof = os.getenv('UKMPROFILE',default='ukmonshared')
         conn = boto3.Session(profile_name=prof)
         ddb = conn.resource('dynamodb', region_name='eu-west-2') 
-    table = ddb.Table(table)
-    res = table.scan()
-    # strictly, should check for LastEvaluatedKey here, in case there was more than 1MB of data,
-    # however that equates to around 30,000 users which i hope we never have... 
-    values = res.get('Items', [])
-    camdets = pd.DataFrame(values)
+    datadir = os.getenv('DATADIR', default='/home/ec2-user/prod/data/')
+    snapfile = os.path.join(datadir, 'admin', f'{table}.parquet.snap')
+    meta, df = _readSnapshot(snapfile)
+    marker = tableMarker(table, ddb)
+    if refresh or meta is None or now - meta['fetched'] >= ttl or (marker is not None and marker != meta['marker']):
+        try:
+            df = scanTable(table, ddb)
+            meta = {'version': SNAPSHOT_VERSION, 'fetched': now, 'marker': marker,
+                'fetchedutc': datetime.datetime.utcfromtimestamp(now).strftime('%Y-%m-%dT%H:%M:%S')}
+            _writeSnapshot(snapfile, df, meta)
+        except Exception as e:
+            if df is None:
+                raise
+            print(f'unable to scan {table}, using snapshot from {meta["fetchedutc"]}: {e}')
+    _snapshots[table] = (meta['fetched'], df)
+    return df
+
+
+def loadLocationDetails(table='camdetails', ddb=None, loadall=False, refresh=False):
+    camdets = getTableSnapshot(table, ddb, refresh).copy()
     camdets.sort_values(by=['stationid'], inplace=True)
     if not loadall:
         camdets.dropna(inplace=True, subset=['eMail','humanName','site'])
@@ -1,12 +1,13 @@
 # Copyright (C) 2018-2023 Mark McIntyre
 #
 # python module to read data in various formats and create a format that can be searched
-# with S3 SQL statements from a lambda function. The lambda is invoked from a REST API
+# from a lambda function. The lambda is invoked from a REST API
 # via the Search page on the website. 
 #
 
 import sys
 import os
+import json
 import pandas as pd
 import datetime 
 
@@ -112,6 +113,52 @@ def convertMatchToSrchable(datadir, year, newonly=True):
         return outdf, None
 
 
+def buildPartitionedIndex(datadir, year):
+    """ Split the year's searchable events file into one sorted, gzipped file per day, plus an index 
+        giving the earliest and latest event time and the number of rows in each day's file. 
+        The search lambda uses the index to read only the days that overlap the requested period.
+        Only days whose row count has changed are rewritten.
+
+    Args:
+        datadir (str): the data folder, holding searchidx/yyyy-allevents.csv
+        year (str): the year to process
+
+    Returns:
+        list: the days that were rewritten
+    """
+    allevents = os.path.join(datadir, 'searchidx', f'{year}-allevents.csv')
+    outdir = os.path.join(datadir, 'searchidx', f'{year}')
+    if not os.path.isfile(allevents):
+        return []
+    os.makedirs(outdir, exist_ok=True)
+    idxfile = os.path.join(outdir, 'index.json')
+    oldidx = {}
+    if os.path.isfile(idxfile):
+        with open(idxfile) as inf:
+            oldidx = json.load(inf)
+
+    print(datetime.datetime.now(), f'partitioning {allevents}')
+    df = pd.read_csv(allevents, dtype=str, keep_default_na=False)
+    df = df.assign(_ts=pd.to_numeric(df.eventtime, errors='coerce')).dropna(subset=['_ts'])
+    df = df.sort_values(by=['_ts'], kind='stable')
+    df = df.assign(_day=pd.to_datetime(df._ts, unit='s', utc=True).dt.strftime('%Y%m%d'))
+
+    newidx = {}
+    changed = []
+    for day, daydf in df.groupby('_day', sort=True):
+        newidx[day] = {'file': f'{day}.csv.gz', 'min': float(daydf._ts.min()), 
+            'max': float(daydf._ts.max()), 'rows': int(len(daydf))}
+        if oldidx.get(day) == newidx[day]:
+            continue
+        daydf.drop(columns=['_ts', '_day']).to_csv(os.path.join(outdir, f'{day}.csv.gz'), 
+            index=False, compression='gzip')
+        changed.append(day)
+    with open(idxfile, 'w') as outf:
+        json.dump(newidx, outf, indent=1)
+    print(datetime.datetime.now(), f'{len(changed)} of {len(newidx)} days rewritten')
+    return changed
+
+
 if __name__ == '__main__':
     if len(sys.argv) < 3:
         print('usage: python createSearchableFormat.py year dest mode')
@@ -142,5 +189,9 @@ if __name__ == '__main__':
             if fname is not None:
                 os.remove(fname)
         
+        # split the year's events into daily partitions for the search lambda
+        elif mode == 'index':
+            buildPartitionedIndex(datadir, year)
+
         else:
-            print('usage: createSearchableFormat yyyy matches_or_singles')
+            print('usage: createSearchableFormat yyyy matches_or_singles_or_index')
@@ -5,7 +5,42 @@ import boto3
 import shutil
 import sys
 import os
-from traj.pickleAnalyser import getAllMp4s
+from traj.pickleAnalyser import getAllMp4s, getTrajSummary
+from traj.trajSummaryStore import getSummaryStore
+from reports.imageManifest import getManifestStore, lookupImages
+
+
+def createMp4ListFromManifest(picklename, store, key=None, version=None):
+    """ Write the mpgs.lst used by getAllMp4s from the nightly image manifests rather than fetching it.
+        This only succeeds if the manifests record a published mp4 for every observation, as
+        otherwise there's no telling whether the rest exist.
+
+    Arguments:
+        picklename: [str] Full path to the trajectory pickle.
+        store: [S3ManifestStore or LocalManifestStore] Where the manifests are held.
+
+    Keyword arguments:
+        key: [str] Key of the trajectory in the summary store. Default is the pickle's path.
+        version: [str] Version of the pickle, eg its S3 ETag. Default is the file's mtime and size.
+
+    Return:
+        [bool] True if mpgs.lst was created.
+    """
+    summ = getTrajSummary(picklename, key=key, version=version)
+    mp4s = []
+    for ffname in summ['ffnames']:
+        if ffname is None:
+            continue
+        _, _, mp4 = lookupImages(store, ffname)
+        if mp4 is None:
+            return False
+        mp4s.append(mp4)
+    if len(mp4s) == 0:
+        return False
+    with open(os.path.join(os.path.dirname(picklename), 'mpgs.lst'), 'w') as outf:
+        for mp4 in mp4s:
+            outf.write(f'{mp4}\n')
+    return True
 
 
 def getBestNMp4s(yr, mth, numtoget):
@@ -24,6 +59,7 @@ def getBestNMp4s(yr, mth, numtoget):
     tmpdir = os.getenv('TMP', default='/tmp')
     wsbucket = os.getenv('UKMONSHAREDBUCKET', default='s3://ukmda-shared')[5:]
     s3 = boto3.resource('s3')
+    store = getManifestStore(s3.meta.client, wsbucket)
     mp4df = pd.DataFrame()
     for traj in sorteddata.url:
         trdir = traj[traj.find('reports'):]
@@ -37,12 +73,17 @@ def getBestNMp4s(yr, mth, numtoget):
         key = trdir + '/' + picklefile
         picklename = os.path.join(locdir, picklefile)
         try: 
-            s3.meta.client.download_file(wsbucket, key, picklename)
+            # the pickle is only needed if it hasn't already been summarised
+            etag = s3.meta.client.head_object(Bucket=wsbucket, Key=key)['ETag']
+            s3key = f's3://{wsbucket}/{key}'
+            if getSummaryStore().get(s3key, etag) is None:
+                s3.meta.client.download_file(wsbucket, key, picklename)
             key = trdir + '/mpgs.lst'
             locfname = os.path.join(locdir, 'mpgs.lst')
             try:
-                s3.meta.client.download_file(wsbucket, key, locfname) # used by getAllMP4s
-                newdf = getAllMp4s(picklename)
+                if not createMp4ListFromManifest(picklename, store, key=s3key, version=etag):
+                    s3.meta.client.download_file(wsbucket, key, locfname) # used by getAllMP4s
+                newdf = getAllMp4s(picklename, key=s3key, version=etag)
                 mp4df = pd.concat([mp4df, newdf])
             except:
                 pass
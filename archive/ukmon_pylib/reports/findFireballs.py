@@ -12,6 +12,8 @@ from tempfile import mkdtemp
 from shutil import rmtree
 
 from traj.pickleAnalyser import getBestView
+from traj.trajSummaryStore import getSummaryStore
+from converters.appendParquet import rebuild as rebuildParquet
 from meteortools.utils import jd2Date
 
 
@@ -34,9 +36,10 @@ def markAsFireball(trajname, tof=True):
         exit(0)
     print(f'setting {trajname} to {tof}')
     df.loc[df.orbname==trajname, ['isfb']] = tof
-    df.to_parquet(fname, compression='snappy')
     csvfname = os.path.join(datadir, 'matched','matches-full-{}.csv'.format(yr))
     df.to_csv(csvfname, index=False)
+    # recreate the parquet file and its partitions so the change isn't lost on the next append
+    rebuildParquet(csvfname)
 
     return 
 
@@ -59,7 +62,11 @@ def createMDFiles(fbs, outdir, orbdir):
             picklename = trajdir[:15] +'_trajectory.pickle'
             fname = pickledir + '/' + picklename
             pickfile = os.path.join(tmpdir, picklename)
-            s3.download_file(srcbucket, fname, pickfile)
+            # the pickle is only needed if it hasn't already been summarised
+            etag = s3.head_object(Bucket=srcbucket, Key=fname)['ETag']
+            s3key = f's3://{srcbucket}/{fname}'
+            if getSummaryStore().get(s3key, etag) is None:
+                s3.download_file(srcbucket, fname, pickfile)
         except:
             print(f'unable to collect {fname}')
         else:
@@ -67,7 +74,7 @@ def createMDFiles(fbs, outdir, orbdir):
             targfile = os.path.join(tmpdir, 'jpgs.lst')
             try:
                 s3.download_file(srcbucket, fname, targfile)
-                bestimg = getBestView(pickfile)
+                bestimg = getBestView(pickfile, key=s3key, version=etag)
                 #print(bestimg)
                 if bestimg[:3] == 'FF_':
                     pth = fb.url[:fb.url.find('reports/')]
@@ -10,7 +10,7 @@ import shutil
 import argparse
 
 from meteortools.utils import getActiveShowers
-from analysis.showerAnalysis import showerAnalysis
+from analysis.showerAnalysis import showerAnalysis, loadShowerData, chartPool
 from reports.findFireballs import findFireballs
 
 
@@ -181,16 +181,19 @@ def reportActiveShowers(ymd, thisshower=None, thismth=None, includeMinor=False):
     if thismth is not None:
         dtstr = dtstr + thismth
 
-    for shwr in shwrlist:
-        print(f'processing {shwr} for {dtstr}')
-        shwrname = showerAnalysis(shwr, int(dtstr))
-        findFireballs(int(dtstr), shwr, 999)
-        if thismth is None:
-            outdir=os.path.join(datadir, 'reports', dtstr, shwr)
-        else:
-            outdir=os.path.join(datadir, 'reports', dtstr[:4], shwr, thismth)
-        # findRelevantPngs(shwr, pltdir, outdir) # WMPL no longer generates the plots
-        createShowerIndexPage(dtstr, shwr, shwrname, outdir, datadir)
+    # read the data once and share it, and the chart renderers, between all the showers
+    sngl, mtch = loadShowerData(int(dtstr[:4]), datadir)
+    with chartPool() as pool:
+        for shwr in shwrlist:
+            print(f'processing {shwr} for {dtstr}')
+            shwrname = showerAnalysis(shwr, int(dtstr), sngl=sngl, mtch=mtch, pool=pool)
+            findFireballs(int(dtstr), shwr, 999)
+            if thismth is None:
+                outdir=os.path.join(datadir, 'reports', dtstr, shwr)
+            else:
+                outdir=os.path.join(datadir, 'reports', dtstr[:4], shwr, thismth)
+            # findRelevantPngs(shwr, pltdir, outdir) # WMPL no longer generates the plots
+            createShowerIndexPage(dtstr, shwr, shwrname, outdir, datadir)
     return shwrlist
 
 
@@ -7,9 +7,7 @@ import shutil
 import argparse
 import requests
 from tempfile import mkdtemp
-from meteortools.utils import greatCircleDistance
-
-RAD2DEG=57.2958
+from reports.CameraDetails import greatCircleDistances
 
 
 def getFilteredEvents(sdtstr, edtstr, obslat, obslng, maxdist=100):
@@ -21,7 +19,7 @@ def getFilteredEvents(sdtstr, edtstr, obslat, obslng, maxdist=100):
     df = df[df.dtstamp >= stdt.timestamp()]
     df = df[df.dtstamp < eddt.timestamp()]
     # filter by location
-    df['gsdist'] = df.apply(lambda x: greatCircleDistance(obslat/RAD2DEG, obslng/RAD2DEG, x._lat1/RAD2DEG, x._lng1/RAD2DEG), axis=1)
+    df['gsdist'] = greatCircleDistances(obslat, obslng, df._lat1, df._lng1)
     df = df[df.gsdist <= maxdist]
     df['img'] = df.img.str.replace('ukmeteornetwork.co.uk','ukmeteors.co.uk')
     return list(df.img)
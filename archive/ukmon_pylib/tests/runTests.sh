@@ -19,6 +19,7 @@ cd $here/..
 if [ $# == 0 ] ; then
     pytest -v ./tests --cov=. --cov-report=term-missing
     pytest -v ../samfunctions/liveDetectionsReport/detectionsCsv.py
+    pytest -v ../samfunctions/ftpToUkmon/tests
 else
     pytest -v ./tests/test_$1.py --cov=$1 --cov-report=term-missing
 fi
@@ -0,0 +1,134 @@
+# Copyright (C) 2018-2023 Mark McIntyre
+
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+import pytest
+
+from converters.appendParquet import appendCsv, compact, rebuild, writePartition, partsDir, \
+    listPartitions, changedPartitions, loadManifest, BASE_PART, MATCH_KEYS
+
+
+def makeSingles(start, count):
+    return pd.DataFrame({'ID': [f'UK{i:04d}' for i in range(start, start + count)],
+        'Y': 2023, 'm': 12, 'Mag': [1.5 + i/10 for i in range(start, start + count)]})
+
+
+def makeMatches(start, count):
+    df = pd.DataFrame({k: [float(i) for i in range(start, start + count)] for k in MATCH_KEYS})
+    df['mjd'] = df._mjd
+    df['_ID1'] = [f'UK{i:04d}' for i in range(start, start + count)]
+    return df
+
+
+def setup(fname, df):
+    """ create a yearly csv file in a new folder """
+    tmpdir = tempfile.mkdtemp()
+    csvfname = os.path.join(tmpdir, fname)
+    df.to_csv(csvfname, index=False)
+    return tmpdir, csvfname
+
+
+def addRows(csvfname, df):
+    """ add rows to the yearly csv file as getRMSSingleData does, and write them to a file of new rows """
+    df.to_csv(csvfname, mode='a', header=False, index=False)
+    newcsv = os.path.join(os.path.dirname(csvfname), 'new.csv')
+    df.to_csv(newcsv, index=False)
+    return newcsv
+
+
+def readSingleFile(csvfname):
+    return pd.read_parquet(os.path.splitext(csvfname)[0] + '.parquet.snap')
+
+
+def test_appendCsv():
+    tmpdir, csvfname = setup('singles-2023.csv', makeSingles(0, 10))
+    appendCsv(csvfname, csvfname)
+    assert listPartitions(partsDir(csvfname)) == [BASE_PART]
+    assert len(readSingleFile(csvfname)) == 10
+
+    newcsv = addRows(csvfname, makeSingles(10, 5))
+    appendCsv(csvfname, newcsv)
+    assert len(listPartitions(partsDir(csvfname))) == 2
+    df = readSingleFile(csvfname)
+    assert len(df) == 15
+    assert 'mi' in df.columns
+    shutil.rmtree(tmpdir)
+
+
+def test_appendCsvDedupe():
+    tmpdir, csvfname = setup('singles-2023.csv', makeSingles(0, 10))
+    appendCsv(csvfname, csvfname)
+    # half of tonight's rows are already in the data
+    newcsv = addRows(csvfname, makeSingles(5, 10))
+    appendCsv(csvfname, newcsv)
+    assert len(readSingleFile(csvfname)) == 15
+    # and appending the same rows again adds nothing
+    appendCsv(csvfname, newcsv)
+    assert len(listPartitions(partsDir(csvfname))) == 2
+    assert len(readSingleFile(csvfname)) == 15
+    shutil.rmtree(tmpdir)
+
+
+def test_appendCsvMatches():
+    tmpdir, csvfname = setup('matches-full-2023.csv', makeMatches(0, 10))
+    appendCsv(csvfname, csvfname)
+    newdf = makeMatches(8, 4)
+    newdf['mjd'] = None
+    newcsv = addRows(csvfname, newdf)
+    appendCsv(csvfname, newcsv)
+    df = readSingleFile(csvfname)
+    assert len(df) == 12
+    assert df.mjd.isna().sum() == 0
+    shutil.rmtree(tmpdir)
+
+
+def test_appendCsvSameSecond():
+    tmpdir, csvfname = setup('singles-2023.csv', makeSingles(0, 10))
+    appendCsv(csvfname, csvfname)
+    # two appends in quick succession must both be kept
+    appendCsv(csvfname, addRows(csvfname, makeSingles(10, 5)))
+    appendCsv(csvfname, addRows(csvfname, makeSingles(15, 5)))
+    pqdir = partsDir(csvfname)
+    assert len(listPartitions(pqdir)) == 3
+    assert len(readSingleFile(csvfname)) == 20
+    with pytest.raises(FileExistsError):
+        writePartition(pqdir, listPartitions(pqdir)[1], makeSingles(30, 1), False)
+    assert len(readSingleFile(csvfname)) == 20
+    shutil.rmtree(tmpdir)
+
+
+def test_compact():
+    tmpdir, csvfname = setup('singles-2023.csv', makeSingles(0, 10))
+    appendCsv(csvfname, csvfname)
+    appendCsv(csvfname, addRows(csvfname, makeSingles(10, 5)), maxparts=5)
+    appendCsv(csvfname, addRows(csvfname, makeSingles(15, 5)), maxparts=2)
+    pqdir = partsDir(csvfname)
+    assert listPartitions(pqdir) == [BASE_PART]
+    assert loadManifest(pqdir)[BASE_PART]['rows'] == 20
+    assert len(os.listdir(pqdir)) == 3
+    assert len(readSingleFile(csvfname)) == 20
+    # and rows already compacted are still recognised as duplicates
+    appendCsv(csvfname, addRows(csvfname, makeSingles(18, 4)))
+    assert len(readSingleFile(csvfname)) == 22
+    compact(csvfname)
+    assert changedPartitions(pqdir) == [os.path.join(pqdir, BASE_PART + '.parquet.snap')]
+    shutil.rmtree(tmpdir)
+
+
+def test_rebuildFallback():
+    tmpdir, csvfname = setup('singles-2023.csv', makeSingles(0, 10))
+    appendCsv(csvfname, csvfname)
+    # a magnitude that can't be converted to the existing column type forces a rebuild from the csv
+    newdf = makeSingles(10, 2)
+    newdf['Mag'] = ['bad', 'data']
+    appendCsv(csvfname, addRows(csvfname, newdf))
+    pqdir = partsDir(csvfname)
+    assert listPartitions(pqdir) == [BASE_PART]
+    assert len(readSingleFile(csvfname)) == 12
+    assert len([f for f in os.listdir(pqdir) if f.endswith('.npy')]) == 1
+    rebuild(csvfname)
+    assert len(readSingleFile(csvfname)) == 12
+    shutil.rmtree(tmpdir)
@@ -6,6 +6,7 @@ import shutil
 
 from reports.CameraDetails import getCamLocDirFov, updateCamLocDirFovDB
 from reports.CameraDetails import loadLocationDetails, findEmail, findSite
+from reports.CameraDetails import loadCameraIndex, greatCircleDistances
 
 here = os.path.split(os.path.abspath(__file__))[0]
 datadir = os.getenv('TMP', default='/tmp')
@@ -24,6 +25,21 @@ def test_updateCamLocDirFovDB():
     shutil.rmtree(os.path.join(datadir,'admin'))
 
 
+def test_cameraIndex():
+    os.makedirs(os.path.join(datadir,'admin'))
+    updateCamLocDirFovDB(datadir)
+    camidx = loadCameraIndex(datadir)
+    near = camidx.nearest(53.31249, -2.0, 1)
+    dets = getCamLocDirFov('UK001M', datadir)
+    assert len(near) == 1
+    assert near.iloc[0].dist == greatCircleDistances(53.31249, -2.0, camidx.cams.lat, camidx.cams.lon).min()
+    near = camidx.withinRadius(dets['lat'], dets['lon'], 1)
+    assert 'UK001M' in near.index
+    assert near.loc['UK001M'].dist < 0.001
+    assert len(camidx.withinRadius(0, 0, 10)) == 0
+    shutil.rmtree(os.path.join(datadir,'admin'))
+
+
 def test_loadLocationDetails():
     caminfo = loadLocationDetails()
     caminfo = caminfo[caminfo.stationid=='UK0006']
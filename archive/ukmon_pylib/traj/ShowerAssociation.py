@@ -8,7 +8,6 @@
 
 
 import os
-import copy
 import numpy as np
 
 from wmpl.Config import config
@@ -29,9 +28,7 @@ class MeteorShower(object):
 
 
         # Find the shower code and name in the IAU table
-        IAU_Shower_line = iau_shower_list[iau_shower_list[:, 1].astype(int) == self.IAU_no][0]
-        self.IAU_code = IAU_Shower_line[3]
-        self.IAU_name = IAU_Shower_line[4]
+        self.IAU_code, self.IAU_name = getShowerCatalogue().iauCodeAndName(self.IAU_no)
 
 
     def __repr__(self):
@@ -46,6 +43,58 @@ class MeteorShower(object):
         return out_str
 
 
+class SolarLongitudeIndex(object):
+    def __init__(self, lasun_beg, lasun_end=None, bucket_width=1.0):
+        """ Index of table rows by solar longitude, so that only the rows which may be active at a given
+            solar longitude need to be looked at. Windows which wrap through 0/360 are handled.
+
+        NB: the same index is used by samfunctions/ftpToUkmon/pythoncode/Showers.py. Keep them in step.
+
+        Arguments:
+            lasun_beg: [ndarray] Start of each row's solar longitude window (deg).
+
+        Keyword arguments:
+            lasun_end: [ndarray] End of each row's window (deg). If None, each row is a single solar
+                longitude.
+            bucket_width: [float] Width of the index buckets (deg).
+        """
+
+        self.lasun_beg = np.asarray(lasun_beg, dtype=np.float64) % 360
+        if lasun_end is None:
+            self.lasun_end = self.lasun_beg
+        else:
+            self.lasun_end = np.asarray(lasun_end, dtype=np.float64) % 360
+
+        self.bucket_width = bucket_width
+        self.n_buckets = int(np.ceil(360.0/bucket_width))
+
+        # Put each row into every bucket its window touches
+        buckets = [[] for _ in range(self.n_buckets)]
+        first = np.floor(self.lasun_beg/bucket_width).astype(int)
+        span = np.floor(((self.lasun_beg % bucket_width) 
+            + (self.lasun_end - self.lasun_beg) % 360)/bucket_width).astype(int) + 1
+        for row, (b, n) in enumerate(zip(first, np.minimum(span, self.n_buckets))):
+            for i in range(b, b + n):
+                buckets[i % self.n_buckets].append(row)
+
+        self._buckets = [np.array(rows, dtype=np.int64) for rows in buckets]
+
+
+    def candidates(self, la_sun, margin=0.0):
+        """ Return the rows whose windows may include la_sun +/- margin (deg). The caller must still
+            check the rows exactly, since whole buckets are returned.
+        """
+
+        b_lo = int(np.floor((la_sun - margin)/self.bucket_width))
+        b_hi = int(np.floor((la_sun + margin)/self.bucket_width))
+
+        if b_hi - b_lo + 1 >= self.n_buckets:
+            return np.arange(len(self.lasun_beg))
+
+        return np.unique(np.concatenate([self._buckets[b % self.n_buckets] for b in range(b_lo, b_hi + 1)]))
+
+
+
 def loadGMNShowerTable(dir_path, file_name):
     """ Load the showers from the GMN table and init MeteorShower objects. 
     
@@ -91,28 +140,203 @@ def loadGMNShowerTable(dir_path, file_name):
     return np.array(gmn_shower_list)
 
 
-# Load the GMN table on startup
-if os.path.isfile(config.gmn_shower_table_npy):
-    
-    # Load the npy file (faster) if available
-    gmn_shower_list = np.load(config.gmn_shower_table_npy)
+class ShowerCatalogue(object):
+    def __init__(self, mmap=False):
+        """ The GMN and IAU shower tables, with the GMN table indexed by solar longitude. Use 
+            getShowerCatalogue() to get the copy shared by the whole process rather than creating one.
+
+        Keyword arguments:
+            mmap: [bool] Memory-map the npy files read-only rather than reading them into memory, so that
+                worker processes share the same pages. False by default.
+        """
+
+        mmap_mode = 'r' if mmap else None
+
+        # Load the GMN table
+        if os.path.isfile(config.gmn_shower_table_npy):
+
+            # Load the npy file (faster) if available
+            self.gmn_shower_list = np.load(config.gmn_shower_table_npy, mmap_mode=mmap_mode)
+
+        else:
+
+            # If not, load the text file and store the npy for faster loading later
+            self.gmn_shower_list = loadGMNShowerTable(*os.path.split(config.gmn_shower_table_file))
+            np.save(config.gmn_shower_table_npy, self.gmn_shower_list)
+
+        # Load the IAU table
+        if os.path.isfile(config.iau_shower_table_npy):
+
+            # Load the npy file (faster) if available
+            self.iau_shower_list = np.load(config.iau_shower_table_npy, mmap_mode=mmap_mode)
+        else:
+
+            # If not, load the text file and store the npy file for faster loading later
+            self.iau_shower_list = np.loadtxt(config.iau_shower_table_file, delimiter="|", usecols=range(20), 
+                dtype=str)
+            np.save(config.iau_shower_table_npy, self.iau_shower_list)
+
+        # Index the GMN table by solar longitude so each association only looks at nearby rows
+        self.gmn_shower_index = SolarLongitudeIndex(np.degrees(self.gmn_shower_list[:, 0]))
+
+        # Look up IAU table rows by number, and established showers by code. Where a code appears more than
+        # once, the last established entry is used.
+        self._iau_by_no = {}
+        self._iau_by_code = {}
+        for row in self.iau_shower_list:
+            self._iau_by_no.setdefault(int(row[1]), row)
+            if int(row[6]) > -1:
+                self._iau_by_code[row[3]] = row
+
+
+    def iauCodeAndName(self, IAU_no):
+        """ Return the IAU code and name of a shower given its IAU number. """
+
+        row = self._iau_by_no[int(IAU_no)]
+
+        return row[3], row[4]
+
+
+    def showerDetails(self, IAU_code):
+        """ Return the IAU number, name and peak solar longitude (deg) of an established shower, or None if 
+            the code isn't an established shower. 
+        """
+
+        row = self._iau_by_code.get(IAU_code)
+        if row is None:
+            return None
+
+        return int(row[1]), row[4].strip(), float(row[7])
+
+
+    def associate(self, la_sun, L_g, B_g, v_g, sol_window=1.0, max_radius=None, max_veldif_percent=10.0):
+        """ Associate a single radiant with a shower. See associateShower for the arguments.
+
+        Return:
+            [MeteorShower instance] MeteorShower instance for the closest match, or None for sporadics.
+        """
+
+        best_rows = self._bestRows(np.atleast_1d(la_sun), np.atleast_1d(L_g), np.atleast_1d(B_g), 
+            np.atleast_1d(v_g), sol_window, max_radius, max_veldif_percent)
+
+        return self._showerFromRow(best_rows[0])
+
+
+    def associateManyShowers(self, la_sun, L_g, B_g, v_g, sol_window=1.0, max_radius=None, max_veldif_percent=10.0):
+        """ As associateMany, but return a MeteorShower instance for each radiant, or None for sporadics. """
+
+        best_rows = self._bestRows(np.atleast_1d(la_sun), np.atleast_1d(L_g), np.atleast_1d(B_g), 
+            np.atleast_1d(v_g), sol_window, max_radius, max_veldif_percent)
+
+        return [self._showerFromRow(row) for row in best_rows]
+
+
+    def associateMany(self, la_sun, L_g, B_g, v_g, sol_window=1.0, max_radius=None, max_veldif_percent=10.0):
+        """ Associate many radiants with showers in one call. The arguments are as for associateShower, 
+            but la_sun, L_g, B_g and v_g are arrays with one entry per trajectory.
+
+        Return:
+            (IAU_no, IAU_code): [tuple of ndarrays] The IAU number and code of the best matching shower for 
+                each trajectory, or -1 and 'spo' for sporadics.
+        """
+
+        best_rows = self._bestRows(np.atleast_1d(la_sun), np.atleast_1d(L_g), np.atleast_1d(B_g), 
+            np.atleast_1d(v_g), sol_window, max_radius, max_veldif_percent)
+
+        IAU_no = np.full(len(best_rows), -1, dtype=int)
+        IAU_code = np.full(len(best_rows), 'spo', dtype=object)
+        matched = best_rows >= 0
+        IAU_no[matched] = np.round(self.gmn_shower_list[best_rows[matched], 5]).astype(int)
+        IAU_code[matched] = [self.iauCodeAndName(no)[0] for no in IAU_no[matched]]
+
+        return IAU_no, IAU_code
+
+
+    def _showerFromRow(self, row):
+        """ Init a shower object from a GMN table row, or return None if row is -1. """
 
-else:
+        if row < 0:
+            return None
 
-    # If not, load the text file and store the npy for faster loading later
-    gmn_shower_list = loadGMNShowerTable(*os.path.split(config.gmn_shower_table_file))
-    np.save(config.gmn_shower_table_npy, gmn_shower_list)
+        l0, L_l0, B_g, v_g, dispersion, IAU_no = self.gmn_shower_list[row]
+        shower_obj = MeteorShower(l0, (L_l0 + l0) % (2*np.pi), B_g, v_g, int(round(IAU_no)), 
+            dispersion=dispersion)
 
-# Load the IAU table
-if os.path.isfile(config.iau_shower_table_npy):
+        return shower_obj
 
-    # Load the npy file (faster) if available
-    iau_shower_list = np.load(config.iau_shower_table_npy)
-else:
 
-    # If not, load the text file and store the npy file for faster loading later
-    iau_shower_list = np.loadtxt(config.iau_shower_table_file, delimiter="|", usecols=range(20), dtype=str)
-    np.save(config.iau_shower_table_npy, iau_shower_list)
+    def _bestRows(self, la_sun, L_g, B_g, v_g, sol_window, max_radius, max_veldif_percent):
+        """ Return the GMN table row of the best matching shower for each radiant, or -1 if none match. """
+
+        n_traj = len(la_sun)
+        best_rows = np.full(n_traj, -1, dtype=int)
+
+        # Pair each radiant with the table rows near its solar longitude
+        candidates = [self.gmn_shower_index.candidates(np.degrees(ls), sol_window) for ls in la_sun]
+        traj_idx = np.repeat(np.arange(n_traj), [len(c) for c in candidates])
+        if len(traj_idx) == 0:
+            return best_rows
+        row_idx = np.concatenate(candidates)
+        rows = self.gmn_shower_list[row_idx]
+
+        la_sun = la_sun[traj_idx]
+        L_g = L_g[traj_idx]
+        B_g = B_g[traj_idx]
+        v_g = v_g[traj_idx]
+
+        # Find all showers in the solar longitude window
+        la_sun_diffs = np.abs((rows[:, 0] - la_sun + np.pi) % (2*np.pi) - np.pi)
+
+        # Compute the angular distance between the shower radiants and the reference radiant
+        radiant_distances = angleBetweenSphericalCoords(rows[:, 2], rows[:, 1], B_g, (L_g - la_sun) % (2*np.pi))
+
+        # Use the measured dispersion if no maximum radius is given
+        if max_radius is None:
+            max_radius = np.degrees(rows[:, 4])
+
+        # Find all showers within the maximum velocity difference limit
+        velocity_diff_percents = np.abs(100*(rows[:, 3] - v_g)/rows[:, 3])
+
+        matched = (la_sun_diffs <= np.radians(sol_window)) & (radiant_distances <= np.radians(max_radius)) \
+            & (velocity_diff_percents <= max_veldif_percent)
+        if not np.any(matched):
+            return best_rows
+
+        ### Choose the best matching shower by the solar longitude, radiant, and velocity closeness ###
+
+        # Compute the closeness parameters as a sum of normalized closeness by every individual parameter
+        closeness_param = la_sun_diffs/np.radians(sol_window) + radiant_distances/np.radians(max_radius) \
+            + velocity_diff_percents/max_veldif_percent
+
+        # Take the closest match for each radiant, using table order to break ties
+        traj_idx = traj_idx[matched]
+        row_idx = row_idx[matched]
+        closeness_param = closeness_param[matched]
+        order = np.lexsort((row_idx, closeness_param, traj_idx))
+        first = np.r_[True, traj_idx[order][1:] != traj_idx[order][:-1]]
+        best_rows[traj_idx[order][first]] = row_idx[order][first]
+
+        return best_rows
+
+
+
+# The catalogue is loaded the first time it's needed and then shared by the whole process
+shower_catalogue = None
+
+
+def getShowerCatalogue(mmap=False):
+    """ Return the process-wide ShowerCatalogue, loading it on first use.
+
+    Keyword arguments:
+        mmap: [bool] Memory-map the tables if this call loads them. False by default.
+    """
+
+    global shower_catalogue
+
+    if shower_catalogue is None:
+        shower_catalogue = ShowerCatalogue(mmap=mmap)
+
+    return shower_catalogue
 
 
 def associateShower(la_sun, L_g, B_g, v_g, sol_window=1.0, max_radius=None, max_veldif_percent=10.0):
@@ -136,73 +360,8 @@ def associateShower(la_sun, L_g, B_g, v_g, sol_window=1.0, max_radius=None, max_
         [MeteorShower instance] MeteorShower instance for the closest match, or None for sporadics.
     """
 
-    # Create a working copy of the shower table
-    temp_shower_list = copy.deepcopy(gmn_shower_list)
-
-    # Find all showers in the solar longitude window
-    la_sun_diffs = np.abs((temp_shower_list[:, 0] - la_sun + np.pi) % (2*np.pi) - np.pi)
-    temp_shower_list = temp_shower_list[la_sun_diffs <= np.radians(sol_window)]
-
-    # Check if any associations were found
-    if not len(temp_shower_list):
-        return None
-
-    # Compute the angular distance between the shower radiants and the reference radiant
-    radiant_distances = angleBetweenSphericalCoords(temp_shower_list[:, 2], temp_shower_list[:, 1], B_g, 
-        (L_g - la_sun) % (2*np.pi))
-    
-    # Use the measured dispersion if no maximum radius is given
-    if max_radius is None:
-        
-        # Get the maximum radius for each shower
-        max_radius = np.degrees(temp_shower_list[:, 4])
-    
-        # Filter the showers
-        filter_mask = radiant_distances <= np.radians(max_radius)
-        temp_shower_list = temp_shower_list[filter_mask]
-        max_radius = max_radius[filter_mask]
-    else:
-
-        # Filter the showers using a fixed radius
-        temp_shower_list = temp_shower_list[radiant_distances <= np.radians(max_radius)]
-
-    # Check if any associations were found
-    if not len(temp_shower_list):
-        return None
-
-    # Find all showers within the maximum velocity difference limit
-    velocity_diff_percents = np.abs(100*(temp_shower_list[:, 3] - v_g)/temp_shower_list[:, 3])
-    velocity_filter = velocity_diff_percents <= max_veldif_percent
-    temp_shower_list = temp_shower_list[velocity_filter]
-    
-    # Check if any associations were found
-    if not len(temp_shower_list):
-        return None
-    
-    # Filter the max radius if it's a numpy array
-    if isinstance(max_radius, np.ndarray):
-        max_radius = max_radius[velocity_filter]
-
-    ### Choose the best matching shower by the solar longitude, radiant, and velocity closeness ###
-
-    # Compute the closeness parameters as a sum of normalized closeness by every individual parameter
-    sol_dist_norm = np.abs(((temp_shower_list[:, 0] - la_sun + np.pi) % (2*np.pi) 
-        - np.pi))/np.radians(sol_window)
-    rad_dist_norm = angleBetweenSphericalCoords(temp_shower_list[:, 2], temp_shower_list[:, 1], B_g, (L_g 
-        - la_sun) % (2*np.pi))/np.radians(max_radius)
-    vg_dist_norm = np.abs(100*(temp_shower_list[:, 3] - v_g)/temp_shower_list[:, 3])/max_veldif_percent
-    closeness_param = sol_dist_norm + rad_dist_norm + vg_dist_norm
-
-    # Choose the best matching shower
-    best_shower = temp_shower_list[np.argmin(closeness_param)]
-
-    ### ###
-
-    # Init a shower object
-    l0, L_l0, B_g, v_g, dispersion, IAU_no = best_shower
-    shower_obj = MeteorShower(l0, (L_l0 + l0) % (2*np.pi), B_g, v_g, int(round(IAU_no)), dispersion=dispersion)
-
-    return shower_obj
+    return getShowerCatalogue().associate(la_sun, L_g, B_g, v_g, sol_window=sol_window, 
+        max_radius=max_radius, max_veldif_percent=max_veldif_percent)
 
 
 def associateShowerTraj(traj, sol_window=1.0, max_radius=None, max_veldif_percent=10.0):
@@ -229,6 +388,33 @@ def associateShowerTraj(traj, sol_window=1.0, max_radius=None, max_veldif_percen
         return None
 
 
+def associateShowerTrajs(trajs, sol_window=1.0, max_radius=None, max_veldif_percent=10.0):
+    """ Associate many trajectories with meteor showers in one call. See associateShowerTraj for the 
+        keyword arguments.
+
+    Arguments:
+        trajs: [list] Trajectory objects.
+
+    Return:
+        [list] MeteorShower instance for the closest match to each trajectory, or None for sporadics and 
+            trajectories without an orbit.
+    """
+
+    showers = [None]*len(trajs)
+    orbs = [(i, t.orbit) for i, t in enumerate(trajs) if getattr(getattr(t, 'orbit', None), 'L_g', None) is not None]
+    if len(orbs) == 0:
+        return showers
+
+    la_sun, L_g, B_g, v_g = (np.array([getattr(orb, k) for _, orb in orbs], dtype=np.float64) 
+        for k in ('la_sun', 'L_g', 'B_g', 'v_g'))
+    matched = getShowerCatalogue().associateManyShowers(la_sun, L_g, B_g, v_g, sol_window=sol_window, 
+        max_radius=max_radius, max_veldif_percent=max_veldif_percent)
+    for (i, _), shower_obj in zip(orbs, matched):
+        showers[i] = shower_obj
+
+    return showers
+
+
 
 
 if __name__ == "__main__":
@@ -3,7 +3,6 @@
 import os
 import sys
 import glob
-import shutil
 import datetime
 
 from wmpl.Trajectory.CorrelateRMS import TrajectoryReduced, DatabaseJSON 
@@ -17,46 +16,80 @@ class dummyMeteorObsRMS(object):
         self.id = id
 
 
-# merge a distributed engine DB back into the master DB
-def mergeDatabases(srcdir, srcdb, masterpth, masterfile, mastdb = None):
-    newdb = os.path.join(srcdir, srcdb)
-    mergedb = DatabaseJSON(newdb)
-    if mastdb is None:
-        mastdb = DatabaseJSON(masterfile)
-    mastdb.db_file_path = masterfile
-    # merge successful trajectories
-    for traj in mergedb.trajectories:
-        traj_obj = TrajectoryReduced(traj, json_dict = mergedb.trajectories[traj].__dict__)
-        traj_file_path = traj_obj.traj_file_path
-        traj_file_path = masterpth + '/' + traj_file_path[traj_file_path.find('trajectories'):]
-        traj_obj.traj_file_path = traj_file_path
-        mastdb.addTrajectory(traj_file_path, traj_obj=traj_obj)
-    # merge failed trajectories 
-    for traj in mergedb.failed_trajectories:
-        traj_obj = TrajectoryReduced(traj, json_dict = mergedb.failed_trajectories[traj].__dict__)
-        traj_file_path = traj_obj.traj_file_path
-        traj_file_path = masterpth + '/' + traj_file_path[traj_file_path.find('trajectories'):]
-        traj_obj.traj_file_path = traj_file_path
-        mastdb.addTrajectory(traj_file_path, traj_obj=traj_obj, failed=True)
-    # merge paired obs data
-    for p in mergedb.paired_obs:
-        ids = mergedb.paired_obs[p]
+def fixTrajPath(traj_file_path, masterpth):
+    return masterpth + '/' + traj_file_path[traj_file_path.find('trajectories'):]
+
+
+class DatabaseMerger(object):
+    """ Merge distributed engine DBs into the master DB in memory, then write the master once. 
+
+    Arguments:
+        masterfile: [str] Full path to the master DB.
+        masterpth: [str] Real path to the trajectories, as used in the master DB.
+
+    Keyword arguments:
+        mastdb: [DatabaseJSON] Already loaded master DB. If None, masterfile is loaded.
+    """
+    def __init__(self, masterfile, masterpth, mastdb=None):
+        if mastdb is None:
+            mastdb = DatabaseJSON(masterfile)
+        mastdb.db_file_path = masterfile
+        self.mastdb = mastdb
+        self.masterpth = masterpth
+        # sets of the paired obs in the master, so we don't search a list for every id
+        self.paired = {}
+
+    def addTrajectory(self, json_dict, failed=False):
+        traj_obj = TrajectoryReduced(None, json_dict=json_dict)
+        traj_obj.traj_file_path = fixTrajPath(traj_obj.traj_file_path, self.masterpth)
+        self.mastdb.addTrajectory(traj_obj.traj_file_path, traj_obj=traj_obj, failed=failed)
+        return traj_obj
+
+    def addPairedObs(self, station_code, ids):
+        if station_code not in self.paired:
+            self.paired[station_code] = set(self.mastdb.paired_obs.get(station_code, []))
+        seen = self.paired[station_code]
         for id in ids:
-            met_obs = dummyMeteorObsRMS(p, id)
-            mastdb.addPairedObservation(met_obs)
-    # save the master DB again
-    mastdb.save()
-    return mastdb
+            # only ids the master doesn't already have are passed on to the DB
+            if id not in seen:
+                self.mastdb.addPairedObservation(dummyMeteorObsRMS(station_code, id))
+                seen.add(id)
+
+    def merge(self, newdb):
+        """ Add the trajectories, failed trajectories and paired obs of a distributed engine DB. """
+        mergedb = DatabaseJSON(newdb)
+        for traj in mergedb.trajectories:
+            self.addTrajectory(mergedb.trajectories[traj].__dict__)
+        for traj in mergedb.failed_trajectories:
+            self.addTrajectory(mergedb.failed_trajectories[traj].__dict__, failed=True)
+        for p in mergedb.paired_obs:
+            self.addPairedObs(p, mergedb.paired_obs[p])
+        return mergedb
+
+    def save(self, oldstr=None, newstr=None):
+        """ Save the master DB, then optionally replace oldstr by newstr in it. """
+        self.mastdb.save()
+        if oldstr is not None:
+            patchTrajDB(self.mastdb.db_file_path, newstr, oldstr=oldstr)
+
+
+# merge a distributed engine DB back into the master DB
+def mergeDatabases(srcdir, srcdb, masterpth, masterfile, mastdb = None, save=True):
+    merger = DatabaseMerger(masterfile, masterpth, mastdb)
+    merger.merge(os.path.join(srcdir, srcdb))
+    if save:
+        merger.save()
+    return merger.mastdb
 
 
 # utility to patch the database to have the right trajectory folder
 def patchTrajDB(dbfile, targpath, oldstr='/home/ec2-user/data/RMSCorrelate'):
-
+    tmpfile = dbfile + '.tmp'
     with open(dbfile, 'r') as inf:
-        with open(os.path.join('/tmp/processed_trajectories.json'), 'w') as outf:
+        with open(tmpfile, 'w') as outf:
             for lin in inf:
                 outf.write(lin.replace(oldstr, targpath))
-    shutil.copyfile('/tmp/processed_trajectories.json', dbfile)
+    os.replace(tmpfile, dbfile)
     return 
 
 
@@ -100,7 +133,7 @@ def dumpNewEntries(db1, db2, fname):
 
 if __name__ == '__main__':
     if len(sys.argv) < 3:
-        print('usage: consolidateDistTraj folder_containing_srcdbs full_path_to_targb')
+        print('usage: consolidateDistTraj folder_containing_srcdbs full_path_to_targb [rundate]')
         exit(0)
     srcdir = sys.argv[1]
     masterdb = sys.argv[2]
@@ -113,13 +146,12 @@ if __name__ == '__main__':
 
     flist = glob.glob1(srcdir, f'{rundt}*.json')
     flist.sort()
-    mastdb = None
+    merger = DatabaseMerger(masterdb, masterpth)
     for fl in flist:
-        #countDataInDb(os.path.join(srcdir, fl))
         tstamp = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
         print(f'{tstamp} processing {fl}')
         sys.stdout.flush()
-        mastdb = mergeDatabases(srcdir, fl, masterpth, masterdb, mastdb)
+        merger.merge(os.path.join(srcdir, fl))
 
-    print('patching path in mastdb')        
-    patchTrajDB(masterdb, masterpth, oldstr='/home/ec2-user/prod/data/distrib')
+    print('saving and patching path in mastdb')
+    merger.save(oldstr='/home/ec2-user/prod/data/distrib', newstr=masterpth)
@@ -227,6 +227,8 @@ def createDistribMatchingSh(matchstart, matchend, execmatchingsh):
 
         outf.write('logger -s -t execdistrib distributing candidates and launching containers\n')
         outf.write(f'time python -m traj.distributeCandidates {rundatestr} {calcdir}/candidates {srcpath}\n')
+        outf.write('distribstat=$?\n')
+        outf.write('if [ $distribstat -ne 0 ] ; then logger -s -t execdistrib some candidates were not distributed ; fi\n')
 
         # do this again to fetch todays results
         outf.write('logger -s -t execdistrib refetch latest trajectories\n')
@@ -238,6 +240,7 @@ def createDistribMatchingSh(matchstart, matchend, execmatchingsh):
 
         outf.write('unset AWS_PROFILE\n')
         outf.write('logger -s -t execdistrib done\n')
+        outf.write('exit $distribstat\n')
 
 
 if __name__ == '__main__':
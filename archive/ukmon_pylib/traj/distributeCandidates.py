@@ -12,14 +12,25 @@ import glob
 import math
 import datetime
 import boto3
+import numpy as np
 import time
 import pickle
+import heapq
+import shutil
+import syslog
+import threading
+import concurrent.futures
 
 
 def getClusterDetails(templdir):
-    sts = boto3.client('sts')
-    accid = sts.get_caller_identity()['Account']
-    if accid == '822069317839':
+    if getDryRunStatus() is True:
+        accid = None
+    else:
+        sts = boto3.client('sts')
+        accid = sts.get_caller_identity()['Account']
+    if accid is None:
+        clusdetails = os.path.join(templdir, 'clusdetails.txt')
+    elif accid == '822069317839':
         clusdetails = os.path.join(templdir, 'clusdetails-ee.txt')
     elif accid == '183798037734':
         clusdetails = os.path.join(templdir, 'clusdetails-mda.txt')
@@ -67,11 +78,321 @@ def getDebugStatus():
         return False
 
 
-def distributeCandidates(rundate, srcdir, targdir, clusdets, maxcount=20):
+class LocalStandIn(object):
+    """ Minimal local stand-in for the S3 and ECS clients, used by the dry-run mode. 
+        Uploads are copied under rootdir and tasks are given dummy ARNs, so the 
+        distribution stage can be exercised without touching AWS. 
+    """
+    def __init__(self, rootdir):
+        self.rootdir = rootdir
+        self.tasks = []
+        self.lock = threading.Lock()
+
+    def upload_file(self, Filename, Bucket, Key):
+        dst = os.path.join(self.rootdir, Bucket, Key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(Filename, dst)
+
+    def download_file(self, Bucket, Key, Filename):
+        shutil.copyfile(os.path.join(self.rootdir, Bucket, Key), Filename)
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            fname = os.path.join(self.rootdir, Bucket, obj['Key'])
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def describe_clusters(self, clusters):
+        return {'clusters': [{'clusterName': c, 'runningTasksCount': 0, 
+            'pendingTasksCount': len(self.tasks)} for c in clusters]}
+
+    def run_task(self, **kwargs):
+        with self.lock:
+            tasks = []
+            for _ in range(kwargs.get('count', 1)):
+                taskid = f'{len(self.tasks):032x}'
+                tasks.append({'taskArn': f'arn:aws:ecs:eu-west-2:000000000000:task/{kwargs["cluster"]}/{taskid}'})
+                self.tasks.append(kwargs)
+        return {'tasks': tasks, 'failures': []}
+
+
+def getDryRunStatus():
+    dry = os.getenv('DRYRUN', default='0')
+    if dry == '1':
+        return True
+    else:
+        return False
+
+
+def logError(msg):
+    """ Report a problem to the console and to syslog, where the execdistrib script logs too. """
+    print(msg)
+    syslog.openlog('distributeCandidates')
+    syslog.syslog(syslog.LOG_ERR, msg)
+
+
+def uploadCandidates(s3, uploads, outbucket, maxworkers=16, maxretries=5, maxdelay=60.0):
+    """ Upload candidate pickles to S3 using a bounded pool of threads. Failed uploads are retried, 
+        backing off exponentially between attempts.
+
+    Arguments:
+        s3: [boto3 client] S3 client, or LocalStandIn.
+        uploads: [list] (local file, target key) pairs.
+        outbucket: [str] Target bucket name.
+
+    Keyword arguments:
+        maxworkers: [int] Maximum number of concurrent uploads. Default 16.
+        maxretries: [int] Number of attempts before giving up on a file. Default 5.
+        maxdelay: [float] Longest wait between attempts, in seconds. Default 60.
+
+    Return:
+        [list] pairs that failed to upload.
+    """
+    failed = list(uploads)
+    delay = 1.0
+    for attempt in range(maxretries):
+        if attempt > 0:
+            print(f'{len(failed)} uploads failed, retrying in {delay:.0f}s')
+            time.sleep(delay)
+            delay = min(delay * 2, maxdelay)
+        pending, failed = failed, []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maxworkers) as pool:
+            futs = {pool.submit(s3.upload_file, src, outbucket, dst): (src, dst) for src, dst in pending}
+            for fut in concurrent.futures.as_completed(futs):
+                try:
+                    fut.result()
+                except Exception as e:
+                    print(f'failed to upload {futs[fut][0]}: {e}')
+                    failed.append(futs[fut])
+        if len(failed) == 0:
+            break
+    return failed
+
 
+def runTaskWithBackoff(ecsclient, taskjson, maxretries=10, maxdelay=60.0):
+    """ Launch one ECS task, backing off exponentially while ECS has no capacity or throttles us. 
+
+    Arguments:
+        ecsclient: [boto3 client] ECS client, or LocalStandIn.
+        taskjson: [dict] run_task parameters, as created by createTaskTemplate.
+
+    Keyword arguments:
+        maxretries: [int] Number of attempts before giving up. Default 10.
+        maxdelay: [float] Longest wait between attempts, in seconds. Default 60.
+
+    Return:
+        [str] the task ARN, or None if the task could not be started.
+    """
+    delay = 1.0
+    for attempt in range(maxretries):
+        try:
+            response = ecsclient.run_task(**taskjson)
+            if len(response['tasks']) > 0:
+                return response['tasks'][0]['taskArn']
+            reasons = ', '.join(f.get('reason', '') for f in response.get('failures', []))
+            print(f'no task started ({reasons}), retrying in {delay:.0f}s')
+        except Exception as e:
+            print(f'run_task failed ({e}), retrying in {delay:.0f}s')
+        time.sleep(delay)
+        delay = min(delay * 2, maxdelay)
+    return None
+
+
+# Starting coefficients for the solve-time model, in seconds. The solver runs with Monte Carlo 
+# enabled, so the time taken grows with the number of observations times the number of stations 
+# as well as with the number of measured points. The model is refitted from recorded runtimes
+# by refineCostModel.
+DEFAULT_COST_MODEL = {'percand': 60.0, 'perobsstation': 15.0, 'perpoint': 0.5}
+COST_FEATURES = ['percand', 'perobsstation', 'perpoint']
+
+# used to guess the number of points when a candidate can't be unpickled
+BYTES_PER_POINT = 400
+
+
+def candidateFeatures(fname):
+    """ Count the observations, stations and measured points in a candidate pickle. 
+
+    Arguments:
+        fname: [str] Full path to the candidate pickle.
+
+    Return:
+        [list] 1, observations x stations, and number of points, matching COST_FEATURES.
+    """
+    try:
+        # candidates are lists of (observation handle, MeteorObsRMS, ...) tuples
+        with open(fname, 'rb') as inf:
+            cand = pickle.load(inf)
+        metobs = [[x for x in c if hasattr(x, 'station_code')][0] for c in cand]
+        nobs = len(metobs)
+        nstations = len(set(m.station_code for m in metobs))
+        npoints = sum(len(m.data) for m in metobs)
+    except Exception:
+        nobs = nstations = 2
+        npoints = os.path.getsize(fname) // BYTES_PER_POINT
+    return [1, nobs * nstations, npoints]
+
+
+def estimateCost(features, costmodel):
+    return sum(costmodel[k] * f for k, f in zip(COST_FEATURES, features))
+
+
+def packCandidates(costs, numbucks):
+    """ Share candidates between containers so that the longest running container finishes as 
+        early as possible, by giving each candidate in turn, most expensive first, to the 
+        container with the least work so far. 
+
+    Arguments:
+        costs: [list] Estimated cost of each candidate.
+        numbucks: [int] Number of containers.
+
+    Return:
+        [list] for each container, the indices of the candidates assigned to it.
+    """
+    heap = [(0.0, i) for i in range(numbucks)]
+    bins = [[] for _ in range(numbucks)]
+    for idx in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        load, b = heapq.heappop(heap)
+        bins[b].append(idx)
+        heapq.heappush(heap, (load + costs[idx], b))
+    return [sorted(b) for b in bins]
+
+
+def moveFailedCandidates(s3, outbucket, srcdir, flist, bucknames, bins, costs, failed, maxworkers=16):
+    """ Move the candidates of any container with a failed upload to the containers whose uploads 
+        succeeded, least loaded first, and remove the copies left in the failed containers' folders. 
+
+    Arguments:
+        s3: [boto3 client] S3 client, or LocalStandIn.
+        outbucket: [str] Target bucket name.
+        srcdir: [str] Local folder holding the candidate pickles.
+        flist: [list] Candidate file names.
+        bucknames: [list] Container folder names.
+        bins: [list] for each container, the indices of its candidates in flist. Updated in place.
+        costs: [list] Estimated cost of each candidate.
+        failed: [list] (local file, target key) pairs that failed to upload, as returned by uploadCandidates.
+
+    Keyword arguments:
+        maxworkers: [int] Maximum number of concurrent uploads. Default 16.
+
+    Return:
+        [list] indices of the containers that can be started, and [list] names of the candidates that 
+        couldn't be uploaded anywhere.
+    """
+    failedkeys = set(dst for _, dst in failed)
+    bad = [i for i, b in enumerate(bucknames) if any(os.path.join(b, flist[j]) in failedkeys for j in bins[i])]
+    good = [i for i in range(len(bucknames)) if i not in bad]
+    stale = [os.path.join(bucknames[i], flist[j]) for i in bad for j in bins[i]]
+    stale = [{'Key': k} for k in stale if k not in failedkeys]
+
+    moves = []
+    if len(good) > 0:
+        heap = [(sum(costs[j] for j in bins[i]), i) for i in good]
+        heapq.heapify(heap)
+        for j in sorted([j for i in bad for j in bins[i]], key=lambda j: -costs[j]):
+            load, i = heapq.heappop(heap)
+            moves.append((j, i))
+            heapq.heappush(heap, (load + costs[j], i))
+    uploads = {(os.path.join(srcdir, flist[j]), os.path.join(bucknames[i], flist[j])): (j, i) for j, i in moves}
+    refailed = set(uploadCandidates(s3, list(uploads.keys()), outbucket, maxworkers=maxworkers))
+    for upl, (j, i) in uploads.items():
+        if upl not in refailed:
+            bins[i].append(j)
+    print(f'moved {len(uploads)-len(refailed)} candidates from {len(bad)} containers')
+
+    for k in range(0, len(stale), 1000):
+        try:
+            s3.delete_objects(Bucket=outbucket, Delete={'Objects': stale[k:k+1000]})
+        except Exception as e:
+            print(f'unable to remove unused candidates: {e}')
+
+    placed = set(j for j, _ in moves) - set(uploads[upl][0] for upl in refailed)
+    dropped = [flist[j] for i in bad for j in bins[i] if j not in placed]
+    return good, dropped
+
+
+def loadCostModel(s3, outbucket, modelkey):
+    costmodel = dict(DEFAULT_COST_MODEL)
+    locfile = os.path.join('/tmp', 'costmodel.json')
+    try:
+        s3.download_file(outbucket, modelkey, locfile)
+        with open(locfile) as inf:
+            costmodel.update(json.load(inf))
+    except Exception:
+        print('using default cost model')
+    return costmodel
+
+
+def recordRuntime(historyfile, rundate, buckname, plan, tsk):
+    """ Append the actual runtime of a finished container to the history used to refine the cost model. """
+    if buckname not in plan or 'startedAt' not in tsk or 'stoppedAt' not in tsk:
+        return
+    runtime = (tsk['stoppedAt'] - tsk['startedAt']).total_seconds()
+    newfile = not os.path.isfile(historyfile)
+    with open(historyfile, 'a') as outf:
+        if newfile:
+            outf.write('rundate,bucket,' + ','.join(COST_FEATURES) + ',estimate,runtime\n')
+        feats = ','.join(str(f) for f in plan[buckname]['features'])
+        outf.write(f"{rundate.strftime('%Y%m%d')},{buckname},{feats},{plan[buckname]['estimate']:.0f},{runtime:.0f}\n")
+
+
+def refineCostModel(historyfile, maxrows=1000, minrows=20):
+    """ Refit the cost model to the recorded container runtimes. 
+
+    Arguments:
+        historyfile: [str] CSV file of runtimes written by recordRuntime.
+
+    Keyword arguments:
+        maxrows: [int] Number of most recent containers to use. Default 1000.
+        minrows: [int] Don't refit with fewer containers than this. Default 20.
+
+    Return:
+        [dict] the new model, or None if there isn't enough history.
+    """
+    if not os.path.isfile(historyfile):
+        return None
+    with open(historyfile) as inf:
+        rows = [li.strip().split(',') for li in inf.readlines()[1:]][-maxrows:]
+    if len(rows) < minrows:
+        return None
+    nfeat = len(COST_FEATURES)
+    x = np.array([r[2:2+nfeat] for r in rows], dtype=np.float64)
+    y = np.array([r[-1] for r in rows], dtype=np.float64)
+    coefs = np.linalg.lstsq(x, y, rcond=None)[0]
+    # a negative coefficient makes no physical sense, so fall back to the default for that term
+    costmodel = {k: float(c) if c > 0 else DEFAULT_COST_MODEL[k] for k, c in zip(COST_FEATURES, coefs)}
+    print(f'refined cost model {costmodel}')
+    return costmodel
+
+
+def distributeCandidates(rundate, srcdir, targdir, clusdets, maxcount=20, dryrun=False, maxworkers=16):
+    """ Upload groups of candidates to S3 and start a container to solve each group. 
+
+    Arguments:
+        rundate: [datetime] Date being processed.
+        srcdir: [str] Local folder holding the candidate pickles.
+        targdir: [str] S3 url under which to create the per-container folders.
+        clusdets: [list] Cluster details, as returned by getClusterDetails.
+
+    Keyword arguments:
+        maxcount: [int] Average number of candidates per container. Default 20.
+        dryrun: [bool] Use a local stand-in for S3 and ECS, writing under /tmp/distrib-dryrun. 
+            Also enabled by setting DRYRUN=1. Default False.
+        maxworkers: [int] Number of concurrent uploads. Default 16.
+
+    Return:
+        [bool] False if the cluster isn't running or some candidates weren't handed to a container.
+    """
     clusname = clusdets[0]
+    dryrun = dryrun or getDryRunStatus()
 
-    ecsclient = boto3.client('ecs', region_name='eu-west-2')
+    if dryrun:
+        standin = LocalStandIn(os.path.join('/tmp', 'distrib-dryrun'))
+        ecsclient = standin
+        s3 = standin
+        print(f'dry run, writing to {standin.rootdir}')
+    else:
+        ecsclient = boto3.client('ecs', region_name='eu-west-2')
+        s3 = boto3.client('s3')
     status = ecsclient.describe_clusters(clusters=[clusname])
     if len(status['clusters']) == 0:
         print('cluster not running!')
@@ -82,7 +403,7 @@ def distributeCandidates(rundate, srcdir, targdir, clusdets, maxcount=20):
     flist = glob.glob1(srcdir, '*.pickle')
     if len(flist) == 0:
         print('no candidates to process')
-        return False
+        return True
     flist.sort()
 
     # work out how many buckets i need
@@ -95,38 +416,67 @@ def distributeCandidates(rundate, srcdir, targdir, clusdets, maxcount=20):
     targdir = targdir[targdir.find('/')+1:]
     buckroot = os.path.join(targdir, rundate.strftime('%Y%m%d'))
 
-    taskarns = [None] * numbucks
-    jsontempls = [None] * numbucks
-    bucknames = [None] * numbucks
-
-    isDbg = getDebugStatus()
+    # balance the expected solve time across the containers
+    costmodel = loadCostModel(s3, outbucket, os.path.join(targdir, 'costmodel.json'))
+    features = [candidateFeatures(os.path.join(srcdir, fli)) for fli in flist]
+    costs = [estimateCost(f, costmodel) for f in features]
+    bins = packCandidates(costs, numbucks)
+
+    bucknames = [buckroot + f'_{i:02d}' for i in range(numbucks)]
+
+    # in debug mode, only the first few buckets are processed
+    if getDebugStatus() is True:
+        bucknames = bucknames[:4]
+        bins = bins[:4]
+
+    uploads = []
+    for buckname, b in zip(bucknames, bins):
+        uploads += [(os.path.join(srcdir, flist[j]), os.path.join(buckname, flist[j])) for j in b]
+
+    # the containers can't start until their candidates are in place
+    tstart = time.time()
+    failed = uploadCandidates(s3, uploads, outbucket, maxworkers=maxworkers)
+    nbytes = sum(os.path.getsize(src) for src, _ in uploads)
+    print(f'uploaded {len(uploads)-len(failed)} of {len(uploads)} files, {nbytes/1024/1024:.1f} MB in {time.time()-tstart:.1f}s')
+
+    # a container missing some of its candidates would leave them unsolved, so move them elsewhere
+    dropped = []
+    if len(failed) > 0:
+        good, dropped = moveFailedCandidates(s3, outbucket, srcdir, flist, bucknames, bins, costs, failed, maxworkers=maxworkers)
+        bucknames = [bucknames[i] for i in good]
+        bins = [bins[i] for i in good]
+        if len(dropped) > 0:
+            logError(f'{len(dropped)} candidates could not be uploaded and will not be solved: {", ".join(dropped)}')
+    if len(bucknames) == 0:
+        logError(f'no containers could be started for {rundate.strftime("%Y%m%d")}')
+        return False
 
-    s3 = boto3.client('s3')
-    for i in range(0, numbucks):
-        bucknames[i] = buckroot + f'_{i:02d}'
-        filelist = flist[i::numbucks]
-        for fli in filelist:
-            src = os.path.join(srcdir, fli)
-            dst = os.path.join(bucknames[i], fli)
-            s3.upload_file(src, outbucket, dst)
-
-        taskjson = createTaskTemplate(rundate, bucknames[i], clusdets)
-
-        response = ecsclient.run_task(**taskjson)
-        while len(response['tasks']) == 0:
-            response = ecsclient.run_task(**taskjson)
-
-        taskarn = response['tasks'][0]['taskArn']
-        taskarns[i] = taskarn
-        jsontempls[i] = taskjson
-        print(taskarn[51:])
-        if isDbg is True and i == 3:
-            break
-    
-    # in debug mode, we don't fill the arrays entirely
-    taskarns = [e for e in taskarns if e is not None]
-    bucknames = [e for e in bucknames if e is not None]
-    jsontempls = [e for e in jsontempls if e is not None]
+    plan = {}
+    for buckname, b in zip(bucknames, bins):
+        plan[buckname] = {'candidates': [flist[j] for j in b], 
+            'features': [int(sum(features[j][k] for j in b)) for k in range(len(COST_FEATURES))],
+            'estimate': sum(costs[j] for j in b)}
+    loads = [p['estimate'] for p in plan.values()]
+    print(f'estimated container runtimes {min(loads):.0f}s to {max(loads):.0f}s')
+
+    # each container is told which bucket to read via its command line, so tasks can't be
+    # batched with run_task's count parameter. Launch them from a small pool instead, to stay
+    # within the ECS API rate limits
+    tstart = time.time()
+    jsontempls = [createTaskTemplate(rundate, b, clusdets) for b in bucknames]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        taskarns = list(pool.map(lambda t: runTaskWithBackoff(ecsclient, t), jsontempls))
+
+    for buckname, taskarn in zip(bucknames, taskarns):
+        if taskarn is None:
+            logError(f'unable to start a task for {buckname}, {len(plan[buckname]["candidates"])} candidates will not be solved')
+        else:
+            print(taskarn[51:])
+    launched = [i for i, a in enumerate(taskarns) if a is not None]
+    print(f'launched {len(launched)} of {len(bucknames)} tasks in {time.time()-tstart:.1f}s')
+
+    taskarns = [taskarns[i] for i in launched]
+    bucknames = [bucknames[i] for i in launched]
 
     print(f' {len(flist)} candidates, {len(taskarns)} arns')
     dmpdata = [bucknames, taskarns, clusname]
@@ -137,15 +487,100 @@ def distributeCandidates(rundate, srcdir, targdir, clusdets, maxcount=20):
     pickle.dump(dmpdata, open(src,'wb'))
     s3.upload_file(src, outbucket, dst)
 
+    # the plan is used by the monitor to record actual runtimes against the estimates
+    src = os.path.join('/tmp', rundate.strftime('%Y%m%d') + '-plan.json')
+    with open(src, 'w') as outf:
+        json.dump({b: plan[b] for b in bucknames}, outf, indent=2)
+    s3.upload_file(src, outbucket, buckroot + '-plan.json')
+
     status = ecsclient.describe_clusters(clusters=[clusname])
     rtc = status['clusters'][0]['runningTasksCount']
     ptc = status['clusters'][0]['pendingTasksCount']
     print(f'{rtc} running, {ptc} pending')
 
-    return True
+    return len(dropped) == 0 and len(launched) == len(jsontempls)
 
 
-def monitorProgress(rundate):
+def removeCandidateFolder(s3, archbucket, buckname):
+    """ Delete a container's candidate folder from S3, however many objects it holds. """
+    _, buckname = os.path.split(buckname)
+    pref = f'matches/distrib/{buckname}/'
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=archbucket, Prefix=pref):
+        keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if len(keys) > 0:
+            s3.delete_objects(Bucket=archbucket, Delete={'Objects': keys})
+
+
+def collectTaskLog(s3, archbucket, loggrp, contname, thisarn, logdir):
+    """ Save a task's CloudWatch log locally and to S3, naming it after the candidate folder it processed. """
+    realfname = None
+    os.makedirs(logdir, exist_ok=True)
+    tmpfname = os.path.join(logdir, f'{thisarn[51:]}.log')
+    with open(tmpfname, 'w') as outf:
+        for events in getLogDetails(loggrp, thisarn[51:], contname):
+            for evt in events:
+                evtdt = datetime.datetime.fromtimestamp(int(evt['timestamp']) / 1000)
+                msg = evt['message']
+                outf.write(f'{evtdt} {msg}\n')
+                if msg[:10] == 'processing':
+                    realfname = msg[11:].strip()
+    if realfname is None:
+        realfname = thisarn[51:]
+    locname = os.path.join(logdir, f'{realfname}.log')
+    os.rename(tmpfname, locname)
+    remlog = f'matches/distrib/logs/{realfname}.log'
+    s3.upload_file(Filename=locname, Bucket=archbucket, Key=remlog)
+
+
+def finishTask(s3, archbucket, loggrp, contname, thisarn, thisbuck, logdir, getlogs=True):
+    try:
+        removeCandidateFolder(s3, archbucket, thisbuck)
+    except Exception:
+        print('folder already removed')
+    if getlogs:
+        try:
+            collectTaskLog(s3, archbucket, loggrp, contname, thisarn, logdir)
+        except Exception as e:
+            print(f'unable to collect log for {thisarn[51:]}: {e}')
+    return thisarn
+
+
+def loadMonitorState(statefile, bucknames, taskarns, clusname):
+    """ Load the monitor's state file if it refers to the same set of tasks, otherwise start afresh. """
+    if os.path.isfile(statefile):
+        with open(statefile) as inf:
+            state = json.load(inf)
+        if state.get('origarns') == taskarns and state.get('clusname') == clusname:
+            ndone = len([t for t in state['tasks'] if t['status'] == 'done'])
+            print(f'resuming, {ndone} of {len(state["tasks"])} tasks already complete')
+            return state
+    tasks = [{'arn': a, 'bucket': b, 'status': 'running'} for a, b in zip(taskarns, bucknames)]
+    return {'clusname': clusname, 'origarns': list(taskarns), 'tasks': tasks}
+
+
+def saveMonitorState(statefile, state):
+    tmpfile = statefile + '.tmp'
+    with open(tmpfile, 'w') as outf:
+        json.dump(state, outf, indent=2)
+    os.replace(tmpfile, statefile)
+
+
+def monitorProgress(rundate, minpoll=15.0, maxpoll=120.0, maxworkers=8):
+    """ Wait for the distributed solver tasks to finish, restarting any that fail, then 
+        remove their candidate folders and collect their logs. 
+
+    Arguments:
+        rundate: [str] Date being processed, in YYYYMMDD format.
+
+    Keyword arguments:
+        minpoll: [float] Shortest interval between checks, in seconds. Default 15.
+        maxpoll: [float] Longest interval between checks, in seconds. Default 120.
+        maxworkers: [int] Number of threads used to tidy up after finished tasks. Default 8.
+
+    The state of each task is saved in $DATADIR/distrib/YYYYMMDD-monitor.json after every
+    check, so if the monitor is interrupted it will resume where it left off.
+    """
     client = boto3.client('ecs', region_name='eu-west-2')
     s3 = boto3.client('s3')
     archbucket = os.getenv('UKMONSHAREDBUCKET', default='s3://ukmda-shared')[5:]
@@ -171,145 +606,102 @@ def monitorProgress(rundate):
     # details of the loggroup and container name 
     loggrp = clusdets[4]
     contname = clusdets[5]
+    logdir = os.path.join(datadir, '..', 'logs', 'distrib')
 
-    # need to keep list of task ARNs and then check if they started properly.
-    # Look for "lastStatus": "STOPPED",
-    # if not "stopCode": "EssentialContainerExited"
-    # then launch it again
+    # the plan gives the estimated cost of each container, to compare with its actual runtime
+    planfile = os.path.join(datadir, 'distrib', rundate.strftime('%Y%m%d') + '-plan.json')
+    historyfile = os.path.join(datadir, 'distrib', 'runtimes.csv')
+    plan = {}
+    try:
+        s3.download_file(archbucket, f"matches/distrib/{rundate.strftime('%Y%m%d')}-plan.json", planfile)
+        with open(planfile) as inf:
+            plan = json.load(inf)
+    except Exception:
+        print('no plan available, runtimes will not be recorded')
+
+    statefile = os.path.join(datadir, 'distrib', rundate.strftime('%Y%m%d') + '-monitor.json')
+    state = loadMonitorState(statefile, bucknames, taskarns, clusname)
+    tasks = {t['arn']: t for t in state['tasks']}
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=maxworkers)
+    pending = {}
+
+    def finish(arn, getlogs=True):
+        # stopped tasks are tidied up in the background while we carry on monitoring
+        tasks[arn]['status'] = 'finishing'
+        pending[pool.submit(finishTask, s3, archbucket, loggrp, contname, arn, 
+            tasks[arn]['bucket'], logdir, getlogs)] = arn
+
+    # anything that was being tidied up when we were interrupted needs doing again
+    for t in state['tasks']:
+        if t['status'] == 'finishing':
+            finish(t['arn'])
 
     # wait 20s before testing whether everything is running
     time.sleep(20.0)
-    print('starting checks')    
-    taskcount = len(taskarns)
-    while taskcount > 0:
-        # can't describe more than 99 tasks at a time
-        sts = client.describe_tasks(cluster=clusname, tasks=taskarns[:99])
-        #print(sts)
-        for tsk in sts['failures']:
-            if tsk['reason'] == 'MISSING':
-                idx = taskarns.index(tsk['arn'])
-                thisarn=taskarns.pop(idx)
-                thisbuck = bucknames.pop(idx)
-                taskcount -= 1
-                _, thisbuck = os.path.split(thisbuck)
-                try:
-                    pref = f'matches/distrib/{thisbuck}/'
-                    objects_to_delete = s3.list_objects(Bucket=archbucket, Prefix=pref)
-                    delete_keys = {'Objects': []}
-                    delete_keys['Objects'] = [{'Key': k} for k in [obj['Key'] for obj in objects_to_delete.get('Contents', [])]]
-                    s3.delete_objects(Bucket=archbucket, Delete=delete_keys)
-                except:
-                    print('folder already removed')
-                print(f'task {tsk["arn"][51:]} completed already')
-        for tsk in sts['tasks']:
-            print(f'checking {tsk["taskArn"][51:]}')
-            idx = taskarns.index(tsk['taskArn'])
-            #print(tsk['taskArn'], tsk['lastStatus'])
-            if tsk['lastStatus'] == 'STOPPED':
-                if tsk['stopCode'] != 'EssentialContainerExited':
-                    # retry the task
-                    thisjson = createTaskTemplate(rundate, bucknames[idx])
-                    response = client.run_task(**thisjson)
-                    taskarns[idx] = response['tasks'][0]['taskArn']
-                    print('task restarted')
-                else:
-                    thisarn=taskarns.pop(idx)
-                    thisbuck = bucknames.pop(idx)
-                    taskcount -= 1
-                    _, thisbuck = os.path.split(thisbuck)
-                    try:
-                        pref = f'matches/distrib/{thisbuck}/'
-                        objects_to_delete = s3.list_objects(Bucket=archbucket, Prefix=pref)
-                        delete_keys = {'Objects': []}
-                        delete_keys['Objects'] = [{'Key': k} for k in [obj['Key'] for obj in objects_to_delete.get('Contents', [])]]
-                        s3.delete_objects(Bucket=archbucket, Delete=delete_keys)
-                    except:
-                        print('folder already removed')
-                    print('task completed')
-
-                    # collect the logs from CloudWatch 
-                    realfname=None
-                    logdir = os.path.join(datadir, '..', 'logs', 'distrib')
-                    os.makedirs(logdir, exist_ok=True)
-                    tmpfname = os.path.join(logdir, f'{thisarn[51:]}.log')
-                    with open(tmpfname, 'w') as outf:
-                        for events in getLogDetails(loggrp, thisarn[51:], contname):
-                            for evt in events:
-                                evtdt = datetime.datetime.fromtimestamp(int(evt['timestamp']) / 1000)
-                                msg = evt['message']
-                                outf.write(f'{evtdt} {msg}\n')
-                                if msg[:10] == 'processing':
-                                    realfname = msg[11:].strip()
-
-                    locname = os.path.join(logdir, f'{realfname}.log')
-                    os.rename(tmpfname, locname)
-                    remlog = f'matches/distrib/logs/{realfname}.log'
-                    s3.upload_file(Filename=locname, Bucket=archbucket, Key=remlog)
-        if len(taskarns) > 99:
-            sts = client.describe_tasks(cluster=clusname, tasks=taskarns[99:199])
+    print('starting checks')
+    interval = minpoll
+    while True:
+        running = [a for a, t in tasks.items() if t['status'] == 'running']
+        nfinished = 0
+        # describe_tasks accepts at most 100 tasks at a time
+        for i in range(0, len(running), 100):
+            sts = client.describe_tasks(cluster=clusname, tasks=running[i:i+100])
             for tsk in sts['failures']:
-                if tsk['reason'] == 'MISSING':
-                    idx = taskarns.index(tsk['arn'])
-                    thisarn=taskarns.pop(idx)
-                    thisbuck = bucknames.pop(idx)
-                    taskcount -= 1
-                    _, thisbuck = os.path.split(thisbuck)
-                    try:
-                        pref = f'matches/distrib/{thisbuck}/'
-                        objects_to_delete = s3.list_objects(Bucket=archbucket, Prefix=pref)
-                        delete_keys = {'Objects': []}
-                        delete_keys['Objects'] = [{'Key': k} for k in [obj['Key'] for obj in objects_to_delete.get('Contents', [])]]
-                        s3.delete_objects(Bucket=archbucket, Delete=delete_keys)
-                    except:
-                        print('folder already removed')
+                if tsk['reason'] == 'MISSING' and tsk['arn'] in tasks:
                     print(f'task {tsk["arn"][51:]} completed already')
+                    finish(tsk['arn'], getlogs=False)
+                    nfinished += 1
             for tsk in sts['tasks']:
-                print(f'checking {tsk["taskArn"][51:]}')
-                idx = taskarns.index(tsk['taskArn'])
-                if tsk['lastStatus'] == 'STOPPED':
-                    if tsk['stopCode'] != 'EssentialContainerExited':
-                        # retry the task
-                        thisjson = createTaskTemplate(rundate, bucknames[idx])
-                        response = client.run_task(**thisjson)
-                        taskarns[idx] = response['tasks'][0]['taskArn']
-                        print('task restarted')
-                    else:
-                        thisarn=taskarns.pop(idx)
-                        thisbuck = bucknames.pop(idx)
-                        taskcount -= 1
-                        _, thisbuck = os.path.split(thisbuck)
-                        try:
-                            pref = f'matches/distrib/{thisbuck}/'
-                            objects_to_delete = s3.list_objects(Bucket=archbucket, Prefix=pref)
-                            delete_keys = {'Objects': []}
-                            delete_keys['Objects'] = [{'Key': k} for k in [obj['Key'] for obj in objects_to_delete.get('Contents', [])]]
-                            s3.delete_objects(Bucket=archbucket, Delete=delete_keys)
-                        except:
-                            print('folder already removed')
-                        print('task completed')
-
-                        # collect the logs from CloudWatch 
-                        realfname=None
-                        logdir = os.path.join(datadir, '..', 'logs', 'distrib')
-                        os.makedirs(logdir, exist_ok=True)
-                        tmpfname = os.path.join(logdir, f'{thisarn[51:]}.log')
-                        with open(tmpfname, 'w') as outf:
-                            for events in getLogDetails(loggrp, thisarn[51:], contname):
-                                for evt in events:
-                                    evtdt = datetime.datetime.fromtimestamp(int(evt['timestamp']) / 1000)
-                                    msg = evt['message']
-                                    outf.write(f'{evtdt} {msg}\n')
-                                    if msg[:10] == 'processing':
-                                        realfname = msg[11:].strip()
-
-                        locname = os.path.join(logdir, f'{realfname}.log')
-                        os.rename(tmpfname, locname)
-                        remlog = f'matches/distrib/logs/{realfname}.log'
-                        s3.upload_file(Filename=locname, Bucket=archbucket, Key=remlog)
-        if taskcount > 0:
-            # wait 60s before checking again
-            print('sleeping for 60s')
-            time.sleep(60.0)
+                if tsk['lastStatus'] != 'STOPPED':
+                    continue
+                thisarn = tsk['taskArn']
+                if tsk.get('stopCode') != 'EssentialContainerExited':
+                    # retry the task
+                    thisjson = createTaskTemplate(rundate, tasks[thisarn]['bucket'], clusdets)
+                    newarn = runTaskWithBackoff(client, thisjson)
+                    if newarn is None:
+                        print(f'unable to restart {thisarn[51:]}')
+                        continue
+                    thistask = tasks.pop(thisarn)
+                    thistask['arn'] = newarn
+                    tasks[newarn] = thistask
+                    print(f'task {thisarn[51:]} restarted as {newarn[51:]}')
+                else:
+                    print(f'task {thisarn[51:]} completed')
+                    recordRuntime(historyfile, rundate, tasks[thisarn]['bucket'], plan, tsk)
+                    finish(thisarn)
+                    nfinished += 1
+
+        for fut in [f for f in pending if f.done()]:
+            arn = pending.pop(fut)
+            tasks[arn]['status'] = 'done'
+
+        state['tasks'] = list(tasks.values())
+        saveMonitorState(statefile, state)
+
+        stillrunning = len([t for t in tasks.values() if t['status'] == 'running'])
+        print(f'{len(tasks) - stillrunning} of {len(tasks)} tasks complete, {len(pending)} being tidied up')
+        if stillrunning == 0:
+            break
+
+        # check more often while tasks are completing, and back off while they're all busy
+        interval = minpoll if nfinished > 0 else min(interval * 1.5, maxpoll)
+        print(f'sleeping for {interval:.0f}s')
+        time.sleep(interval)
+
+    for fut in concurrent.futures.as_completed(list(pending)):
+        tasks[pending.pop(fut)]['status'] = 'done'
+    pool.shutdown()
+    state['tasks'] = list(tasks.values())
+    saveMonitorState(statefile, state)
+
+    costmodel = refineCostModel(historyfile)
+    if costmodel is not None:
+        modelfile = os.path.join(datadir, 'distrib', 'costmodel.json')
+        with open(modelfile, 'w') as outf:
+            json.dump(costmodel, outf, indent=2)
+        s3.upload_file(Filename=modelfile, Bucket=archbucket, Key='matches/distrib/costmodel.json')
     return
 
 
@@ -322,19 +714,7 @@ def getMissedLogs(picklefile):
     contname = 'trajcont'
     logdir = '/home/ec2-user/prod/logs/distrib'
     for thisarn in taskarns:
-        tmpfname = os.path.join(logdir, f'{thisarn[51:]}.log')
-        with open(tmpfname, 'w') as outf:
-            for events in getLogDetails(loggrp, thisarn[51:], contname):
-                for evt in events:
-                    evtdt = datetime.datetime.fromtimestamp(int(evt['timestamp']) / 1000)
-                    msg = evt['message']
-                    outf.write(f'{evtdt} {msg}\n')
-                    if msg[:10] == 'processing':
-                        realfname = msg[11:].strip()
-        locname = os.path.join(logdir, f'{realfname}.log')
-        os.rename(tmpfname, locname)
-        remlog = f'matches/distrib/logs/{realfname}.log'
-        s3.upload_file(Filename=locname, Bucket=archbucket, Key=remlog)
+        collectTaskLog(s3, archbucket, loggrp, contname, thisarn, logdir)
 
 
 def getLogDetails(loggrp, thisarn, contname, region_name='eu-west-2'):
@@ -377,5 +757,6 @@ if __name__ == '__main__':
     templdir,_ = os.path.split(__file__)
     clusdets = getClusterDetails(templdir)
     print(clusdets)
-    distributeCandidates(rundt, srcdir, targdir, clusdets)
+    if not distributeCandidates(rundt, srcdir, targdir, clusdets):
+        sys.exit(1)
     
@@ -1,72 +1,265 @@
 # small script to archive off old data from the JSON database
+# Copyright (C) 2018-2023 Mark McIntyre
+#
+# The database is read one entry at a time and each entry is routed in a single pass either
+# to a new copy of the live database or to the archive shard for the month it belongs to, eg
+#
+#   archive/202301_processed_trajectories.json
+#
+# Shards that already exist are merged with, so the archive can be rerun safely. Every file
+# is written to a temporary name and renamed into place, the shards before the live database,
+# so an interrupted run leaves records duplicated in the archive rather than lost.
 import datetime
-import os 
+import json
+import os
+import re
+import shutil
 import sys
 from dateutil.relativedelta import relativedelta
 
 from wmpl.Utils.TrajConversions import datetime2JD, jd2Date
-from wmpl.Trajectory.CorrelateRMS import DatabaseJSON
 
 # Name of json file with the list of processed directories
 JSON_DB_NAME = "processed_trajectories.json"
 
+# sections of the database that hold records, and where the date is found in each
+TRAJ_SECTIONS = ['failed_trajectories', 'trajectories']
+LIST_SECTIONS = {'processed_dirs': slice(14, 22), 'paired_obs': slice(7, 15)}
+DB_SECTIONS = sorted(TRAJ_SECTIONS + list(LIST_SECTIONS.keys()))
 
-def archiveOldRecords(db, db_dir, older_than=3):
+CHUNKSIZE = 1024*1024
+
+_whitespace = re.compile(r'\s*')
+_decoder = json.JSONDecoder()
+
+
+class _JsonStream(object):
+    """ Buffered reader that decodes one JSON value at a time from a file. """
+    def __init__(self, f, chunksize):
+        self.f = f
+        self.chunksize = chunksize
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        # discard what's been consumed and read more, at least doubling the buffer so that
+        # a value spanning many chunks isn't decoded over and over
+        data = self.f.read(max(self.chunksize, len(self.buf) - self.pos))
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Skip whitespace and return the next character, or '' at the end of the file. """
+        while True:
+            self.pos = _whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        ch = self.peek()
+        if ch == '' or ch not in chars:
+            raise ValueError(f'expected one of {chars} but found {ch!r} in {self.f.name}')
+        self.pos += 1
+        return ch
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                val, end = _decoder.raw_decode(self.buf, self.pos)
+                # a number that ends the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return val
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def streamDatabase(db_path, chunksize=CHUNKSIZE):
+    """ Read a JSON database one entry at a time, without loading the whole file.
+
+    Arguments:
+        db_path: [str] full path to the database file.
+
+    Keyword arguments:
+        chunksize: [int] how much to read from the file at a time. Default 1MB.
+
+    Return:
+        [generator] of (name, key, value). For entries in a section such as trajectories, name is
+        the section. Top-level values that aren't objects are returned with key None.
+    """
+    with open(db_path) as f:
+        js = _JsonStream(f, chunksize)
+        js.expect('{')
+        if js.peek() == '}':
+            return
+        while True:
+            name = js.value()
+            js.expect(':')
+            if js.peek() == '{':
+                js.expect('{')
+                if js.peek() == '}':
+                    js.expect('}')
+                else:
+                    while True:
+                        key = js.value()
+                        js.expect(':')
+                        yield name, key, js.value()
+                        if js.expect(',}') == '}':
+                            break
+            else:
+                yield name, None, js.value()
+            if js.expect(',}') == '}':
+                return
+
+
+class _ShardWriter(object):
+    """ Writes a database file section by section as entries arrive, merging in the contents of
+        any existing file of the same name. The file only replaces the original when closed.
     """
-    Archive off old records to keep the database size down
+    def __init__(self, db_path, merge=True):
+        self.db_path = db_path
+        self.existing = {}
+        if merge and os.path.isfile(db_path):
+            with open(db_path) as inf:
+                self.existing = json.load(inf)
+        self.section = None
+        self.written = []
+        self.nentries = 0
+        self.outf = open(db_path + '.tmp', 'w')
+        self.outf.write('{')
+
+    def _entry(self, key, value):
+        sep = ',' if self.nentries > 0 else ''
+        val = json.dumps(value, indent=4, sort_keys=True).replace('\n', '\n        ')
+        self.outf.write(f'{sep}\n        {json.dumps(key)}: {val}')
+        self.nentries += 1
+
+    def _openSection(self, section):
+        self._closeSection()
+        sep = ',' if len(self.written) > 0 else ''
+        self.outf.write(f'{sep}\n    {json.dumps(section)}: {{')
+        self.section = section
+        self.nentries = 0
+
+    def _closeSection(self):
+        if self.section is None:
+            return
+        # whatever's left of the existing file wasn't superseded by new entries
+        for key, value in self.existing.pop(self.section, {}).items():
+            self._entry(key, value)
+        self.outf.write('\n    }' if self.nentries > 0 else '}')
+        self.written.append(self.section)
+        self.section = None
+
+    def add(self, section, key, value):
+        if section != self.section:
+            self._openSection(section)
+        old = self.existing.get(section, {}).pop(key, None)
+        if isinstance(old, list) and isinstance(value, list):
+            seen = set(old)
+            value = old + [v for v in value if v not in seen]
+        self._entry(key, value)
+
+    def close(self, scalars):
+        self._closeSection()
+        # DatabaseJSON needs all the sections, even if empty
+        sections = DB_SECTIONS + [s for s in self.existing if isinstance(self.existing[s], dict)]
+        for section in [s for s in dict.fromkeys(sections) if s not in self.written]:
+            self._openSection(section)
+            self._closeSection()
+        merged = {k: v for k, v in self.existing.items() if not isinstance(v, dict)}
+        merged.update(scalars)
+        for key in sorted(merged):
+            self.outf.write(f',\n    {json.dumps(key)}: {json.dumps(merged[key])}')
+        self.outf.write('\n}\n')
+        self.outf.close()
+        os.replace(self.db_path + '.tmp', self.db_path)
+
+
+def archiveOldRecords(db_dir, older_than=3, chunksize=CHUNKSIZE):
+    """
+    Archive off old records to keep the database size down. Each record older than the cutoff
+    is moved to the archive shard for its month, in a single pass over the database.
+
+    Arguments:
+        db_dir: [str] folder containing the database.
 
     Keyword Arguments:
         older_than: [int] number of months to keep, default 3
+        chunksize: [int] how much of the database to read at a time. Default 1MB.
+
+    Return:
+        [dict] the number of records archived from each section.
     """
-    class DummyMetObs():
-        def __init__(self, station, obs_id):
-            self.station_code = station
-            self.id = obs_id
+    db_path = os.path.join(db_dir, JSON_DB_NAME)
+    arch_dir = os.path.join(db_dir, 'archive')
+    os.makedirs(arch_dir, exist_ok=True)
 
     archdate = datetime.datetime.now(datetime.timezone.utc) - relativedelta(months=older_than)
     archdate_jd = datetime2JD(archdate)
+    archday = archdate.strftime('%Y%m%d')
 
-    arch_db_path = os.path.join(db_dir, 'archive', f'{archdate.strftime("%Y%m")}_{JSON_DB_NAME}')
-    os.makedirs(os.path.join(db_dir, 'archive'), exist_ok=True)
-    archdb = DatabaseJSON(arch_db_path)
-
-    for traj in [t for t in db.trajectories if t < archdate_jd]:
-        if traj < archdate_jd:
-            archdb.addTrajectory(None, db.trajectories[traj], False)
-            db.removeTrajectory(db.trajectories[traj])
+    shutil.copy2(db_path, db_path + '.bak')
 
-    for traj in [t for t in db.failed_trajectories if t < archdate_jd]:
-        if traj < archdate_jd:
-            archdb.addTrajectory(None, db.failed_trajectories[traj], True)
-            db.removeTrajectory(db.failed_trajectories[traj])
+    keepdb = _ShardWriter(db_path + '.new', merge=False)
+    shards = {}
+    scalars = {}
+    counts = {s: 0 for s in DB_SECTIONS}
 
-    for station in db.processed_dirs:
-        arch_processed = [dirname for dirname in db.processed_dirs[station] if 
-                            datetime.datetime.strptime(dirname[14:22], '%Y%m%d').replace(tzinfo=datetime.timezone.utc) < archdate]
-        for dirname in arch_processed:
-            archdb.addProcessedDir(station, dirname)
-            db.processed_dirs[station].remove(dirname)
+    def getShard(yyyymm):
+        if yyyymm not in shards:
+            shard_path = os.path.join(arch_dir, f'{yyyymm}_{JSON_DB_NAME}')
+            shards[yyyymm] = _ShardWriter(shard_path)
+        return shards[yyyymm]
 
-    for station in db.paired_obs:
-        arch_processed = [obs_id for obs_id in db.paired_obs[station] if 
-                            datetime.datetime.strptime(obs_id[7:15], '%Y%m%d').replace(tzinfo=datetime.timezone.utc) < archdate]
-        for obs_id in arch_processed:
-            archdb.addPairedObservation(DummyMetObs(station, obs_id))
-            db.paired_obs[station].remove(obs_id)
+    for section, key, value in streamDatabase(db_path, chunksize):
+        if key is None:
+            scalars[section] = value
+        elif section in TRAJ_SECTIONS:
+            try:
+                jd = float(key)
+            except ValueError:
+                jd = archdate_jd
+            if jd < archdate_jd:
+                getShard(jd2Date(jd, dt_obj=True).strftime('%Y%m')).add(section, key, value)
+                counts[section] += 1
+            else:
+                keepdb.add(section, key, value)
+        elif section in LIST_SECTIONS and isinstance(value, list):
+            datepos = LIST_SECTIONS[section]
+            keep = []
+            archive = {}
+            for item in value:
+                dtstr = item[datepos]
+                if len(dtstr) == 8 and dtstr.isdigit() and dtstr < archday:
+                    archive.setdefault(dtstr[:6], []).append(item)
+                else:
+                    keep.append(item)
+            for yyyymm in archive:
+                getShard(yyyymm).add(section, key, archive[yyyymm])
+                counts[section] += len(archive[yyyymm])
+            keepdb.add(section, key, keep)
+        else:
+            keepdb.add(section, key, value)
 
-    archdb.save()
-    db.save()
-    return 
+    for yyyymm in sorted(shards):
+        shards[yyyymm].close(dict(scalars, db_file_path=shards[yyyymm].db_path))
+    keepdb.close(scalars)
+    os.replace(db_path + '.new', db_path)
+    print(f'archived {counts} into {len(shards)} shards')
+    return counts
 
 
 if __name__ == '__main__':
     db_dir = sys.argv[1]
-    database_path = os.path.join(db_dir, JSON_DB_NAME)
-    db = DatabaseJSON(database_path)
-    soonest = jd2Date(min(min(list(db.trajectories.keys())), min(list(db.failed_trajectories.keys()))), dt_obj=True)
-
-    nowdt = datetime.datetime.now()
-    mthsback = int((nowdt - soonest).days/30)
-    for i in range(mthsback, 2, -1):
-        print(f'archiving {i} months back')
-        archiveOldRecords(db, db_dir, i)
+    archiveOldRecords(db_dir)
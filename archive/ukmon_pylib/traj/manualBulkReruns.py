@@ -15,6 +15,7 @@ import argparse
 import json
 import os
 import glob
+import hashlib
 from datetime import timezone
 import boto3
 import shutil
@@ -36,6 +37,13 @@ class localPlateparDummy:
         self.__dict__.update(entries)
 
 
+# Heights checked for FOV overlap, ordered by overlap probability for faster execution
+FOV_HEIGHTS = [95000, 70000, 115000, 50000]
+
+# Clanfield cameras that the historic reruns are matched against
+CLANFIELD_STATIONS = ['UK9988','UK9989','UK9990']
+
+
 # loads a platepars_all file from disk
 def loadPlatepar(ppdir, statid):
     # Load a platepar into the dummy structure
@@ -78,39 +86,41 @@ class EventChecker(object):
     def __init__(self, traj_constraints):
         self.traj_constraints = traj_constraints
 
-    def checkFOVOverlap(self, rp, tp):
+    def fovGeometry(self, pp, ref_jd):
         #
-        # Check if fields of view overlap
+        # Compute a station's position, pointing and the middle of its FOV at each of
+        # the checked heights, in ECI coordinates at ref_jd
         #
-        reference_fov = np.radians(np.sqrt(rp.fov_v**2 + rp.fov_h**2))
-        test_fov = np.radians(np.sqrt(tp.fov_v**2 + tp.fov_h**2))
+        lat, lon, elev = np.radians(pp.lat), np.radians(pp.lon), pp.elev
+        azim, alt = raDec2AltAz(np.radians(pp.RA_d), np.radians(pp.dec_d), pp.JD, lat, lon)
+        stat_eci = np.array(geo2Cartesian(lat, lon, elev, ref_jd))
 
-        lat1, lon1, elev1 = np.radians(rp.lat), np.radians(rp.lon), rp.elev
-        lat2, lon2, elev2 = np.radians(tp.lat), np.radians(tp.lon), tp.elev
+        # Compute ECI vectors of the FOV centre
+        ra, dec = altAz2RADec(azim, alt, ref_jd, lat, lon)
+        fov_eci = vectNorm(np.array(raDec2ECI(ra, dec)))
 
-        azim1, alt1 = raDec2AltAz(np.radians(rp.RA_d), np.radians(rp.dec_d), rp.JD, lat1, lon1)
-        azim2, alt2 = raDec2AltAz(np.radians(tp.RA_d), np.radians(tp.dec_d), tp.JD, lat2, lon2)
+        # Compute points in the middle of the FOV at each height
+        fov_points = [stat_eci + fov_eci*(height_above_ground - elev)/np.sin(alt) for height_above_ground in FOV_HEIGHTS]
+        return {'fov': np.radians(np.sqrt(pp.fov_v**2 + pp.fov_h**2)), 'stat_eci': stat_eci, 'fov_eci': fov_eci, 
+            'fov_points': fov_points}
 
+    def checkFOVOverlap(self, rp, tp):
+        #
+        # Check if fields of view overlap
+        #
         ref_jd = datetime2JD(datetime.datetime.utcnow())
+        return self.checkGeometryOverlap(self.fovGeometry(rp, ref_jd), self.fovGeometry(tp, ref_jd))
 
-        reference_stat_eci = np.array(geo2Cartesian(lat1, lon1, elev1, ref_jd))
-        test_stat_eci = np.array(geo2Cartesian(lat2, lon2, elev2, ref_jd))
-
-        # Compute ECI vectors of the FOV centre
-        ra1, dec1 = altAz2RADec(azim1, alt1, ref_jd, lat1, lon1)
-        reference_fov_eci = vectNorm(np.array(raDec2ECI(ra1, dec1)))
-        ra2, dec2 = altAz2RADec(azim2, alt2, ref_jd, lat2, lon2)
-        test_fov_eci = vectNorm(np.array(raDec2ECI(ra2, dec2)))
-
-        # Compute ECI coordinates at different heights along the FOV line and check for FOV overlap
-        # The checked heights are 50, 70, 95, and 115 km (ordered by overlap probability for faster 
-        # execution)
-        for height_above_ground in [95000, 70000, 115000, 50000]:
-            # Compute points in the middle of FOVs of both stations at given heights
-            reference_fov_point = reference_stat_eci + reference_fov_eci*(height_above_ground 
-                - elev1)/np.sin(alt1)
-            test_fov_point = test_stat_eci + test_fov_eci*(height_above_ground - elev2)/np.sin(alt2)
+    def checkGeometryOverlap(self, rg, tg):
+        #
+        # Check if fields of view overlap, given the geometry of both stations from fovGeometry
+        #
+        reference_fov, test_fov = rg['fov'], tg['fov']
+        reference_stat_eci, test_stat_eci = rg['stat_eci'], tg['stat_eci']
+        reference_fov_eci, test_fov_eci = rg['fov_eci'], tg['fov_eci']
 
+        # Check the points along the FOV line at each height for FOV overlap
+        for reference_fov_point, test_fov_point in zip(rg['fov_points'], tg['fov_points']):
             # Check if the middles of the FOV are in the other camera's FOV
             if (angleBetweenVectors(reference_fov_eci, test_fov_point - reference_stat_eci) <= reference_fov/2) \
                     or (angleBetweenVectors(test_fov_eci, reference_fov_point - test_stat_eci) <= test_fov/2):
@@ -170,23 +180,146 @@ def checkTwoStations(datadir, stat1, stat2):
     return True
 
 
+class OverlapMatrix(object):
+    """ Which pairs of stations have overlapping fields of view and are a suitable distance apart.
+
+    Every platepar is loaded and its FOV geometry computed once. Candidate pairs are found by sweeping
+    a bounding box of the maximum station distance across the stations sorted by latitude, and only
+    those are checked in full. The matrix is saved along with a hash of each platepar, and when it's
+    reloaded only the pairs involving changed platepars are recomputed.
+
+    Arguments:
+        ppdir: [str] folder containing the platepars, one statid.json per station.
+
+    Keyword arguments:
+        cachefile: [str] where to save the matrix. Default fovoverlaps.json alongside ppdir.
+        traj_constraints: [object] constraints to use, default localTrajectoryConstraints.
+    """
+    def __init__(self, ppdir, cachefile=None, traj_constraints=None):
+        self.ppdir = ppdir
+        if cachefile is None:
+            cachefile = os.path.join(os.path.dirname(os.path.abspath(ppdir)), 'fovoverlaps.json')
+        self.cachefile = cachefile
+        if traj_constraints is None:
+            traj_constraints = localTrajectoryConstraints()
+        self.checker = EventChecker(traj_constraints=traj_constraints)
+        self.settings = {'heights': FOV_HEIGHTS, 'min_station_dist': traj_constraints.min_station_dist,
+            'max_station_dist': traj_constraints.max_station_dist}
+        self.hashes = {}
+        self.overlaps = {}
+        self.refresh()
+
+    def _hashPlatepars(self):
+        hashes = {}
+        for ppf in sorted(glob.glob1(self.ppdir, '*.json')):
+            with open(os.path.join(self.ppdir, ppf), 'rb') as inf:
+                hashes[os.path.splitext(ppf)[0]] = hashlib.sha1(inf.read()).hexdigest()
+        return hashes
+
+    def _loadCache(self):
+        if not os.path.isfile(self.cachefile):
+            return {}, {}
+        try:
+            with open(self.cachefile) as inf:
+                cache = json.load(inf)
+        except Exception:
+            print(f'unable to read {self.cachefile}, rebuilding it')
+            return {}, {}
+        if cache.get('settings') != self.settings:
+            return {}, {}
+        return cache['hashes'], {statid: set(ovl) for statid, ovl in cache['overlaps'].items()}
+
+    def _saveCache(self):
+        cache = {'settings': self.settings, 'hashes': self.hashes,
+            'overlaps': {statid: sorted(ovl) for statid, ovl in self.overlaps.items()}}
+        with open(self.cachefile + '.tmp', 'w') as outf:
+            json.dump(cache, outf, indent=2)
+        os.replace(self.cachefile + '.tmp', self.cachefile)
+
+    def refresh(self):
+        """ Bring the matrix up to date with the platepars, recomputing the pairs involving any that changed. """
+        hashes = self._hashPlatepars()
+        oldhashes, overlaps = self._loadCache()
+        changed = set(statid for statid in hashes if oldhashes.get(statid) != hashes[statid])
+        if len(changed) == 0 and set(oldhashes) == set(hashes):
+            self.hashes, self.overlaps = hashes, overlaps
+            return
+        print(f'computing FOV overlaps for {len(changed)} changed platepars')
+
+        # the geometry is all in ECI coordinates at the same moment, so it doesn't matter which
+        ref_jd = datetime2JD(datetime.datetime.utcnow())
+        platepars = {}
+        geoms = {}
+        for statid in hashes:
+            try:
+                pp = loadPlatepar(self.ppdir, statid)
+                geoms[statid] = self.checker.fovGeometry(pp, ref_jd)
+                platepars[statid] = pp
+            except Exception:
+                print(f'unable to use platepar for {statid}')
+
+        # keep the results for pairs that are unaffected
+        unchanged = set(platepars) - changed
+        overlaps = {statid: set(ovl) & unchanged for statid, ovl in overlaps.items() if statid in unchanged}
+        for statid in platepars:
+            overlaps.setdefault(statid, set())
+
+        for stat1, stat2 in self._candidatePairs(platepars):
+            if stat1 not in changed and stat2 not in changed:
+                continue
+            rp, tp = platepars[stat1], platepars[stat2]
+            if self.checker.stationRangeCheck(rp, tp) and self.checker.checkGeometryOverlap(geoms[stat1], geoms[stat2]):
+                overlaps[stat1].add(stat2)
+                overlaps[stat2].add(stat1)
+        self.hashes, self.overlaps = hashes, overlaps
+        self._saveCache()
+
+    def _candidatePairs(self, platepars):
+        # pairs of stations within a lat/lon box of the maximum station distance of each other
+        statids = sorted(platepars, key=lambda s: platepars[s].lat)
+        lats = np.array([platepars[s].lat for s in statids])
+        lons = np.array([platepars[s].lon for s in statids])
+        # a little slack so that the box never excludes a pair that the range check would pass
+        dlat = np.degrees(self.settings['max_station_dist'] / 6371.0) * 1.01 + 0.01
+        for i, stat1 in enumerate(statids):
+            maxlat = min(abs(lats[i]) + dlat, 89.0)
+            dlon = min(dlat / np.cos(np.radians(maxlat)), 180.0)
+            for j in range(i + 1, np.searchsorted(lats, lats[i] + dlat, side='right')):
+                if abs((lons[j] - lons[i] + 180.0) % 360.0 - 180.0) <= dlon:
+                    yield stat1, statids[j]
+
+    def overlapping(self, statid):
+        """ Return a sorted list of the stations that overlap statid. """
+        return sorted(self.overlaps.get(statid, []))
+
+    def checkPair(self, stat1, stat2):
+        """ Return True if stat1 and stat2 overlap. """
+        return stat2 in self.overlaps.get(stat1, set())
+
+
+_overlapMatrices = {}
+
+
+def getOverlapMatrix(datadir):
+    #
+    # Return the overlap matrix for the platepars in datadir, loading or building it once per process
+    #
+    ppdir = os.path.join(datadir, 'consolidated','platepars')
+    if ppdir not in _overlapMatrices:
+        _overlapMatrices[ppdir] = OverlapMatrix(ppdir)
+    return _overlapMatrices[ppdir]
+
+
 def checkClanfieldOverlaps(datadir, stat2):
     # 
     # Check all clanfield station overlas with stat2
     #
-    trajcons = localTrajectoryConstraints() # default set of constraints
-    checker = EventChecker(traj_constraints=trajcons)
-    ppdir = os.path.join(datadir, 'consolidated','platepars')
-    try:
-        p2 = loadPlatepar(ppdir, stat2)
-    except:
+    matrix = getOverlapMatrix(datadir)
+    if stat2 not in matrix.overlaps:
         return False
     print('testing', stat2)
-    for stat1 in ['UK9988','UK9989','UK9990']:
-        p1 = loadPlatepar(ppdir, stat1)
-        fovcheck = checker.checkFOVOverlap(p1, p2)
-        rangecheck = checker.stationRangeCheck(p1, p2)
-        if fovcheck is True and rangecheck is True:
+    for stat1 in CLANFIELD_STATIONS:
+        if matrix.checkPair(stat1, stat2):
             return True
     return False
 
@@ -195,22 +328,7 @@ def getOverlappingStations(datadir, stationid):
     #
     # Check all overlaps for all stations
     #
-    trajcons = localTrajectoryConstraints() # default set of constraints
-    checker = EventChecker(traj_constraints=trajcons)
-    ppdir = os.path.join(datadir, 'consolidated','platepars')
-    rp = loadPlatepar(ppdir, stationid)
-    ppfs = glob.glob1(ppdir, '*.json')
-    overlaps=[]
-    for ppf in ppfs: 
-        ppfname, _ = os.path.splitext(ppf)
-        if ppfname == stationid:
-            continue
-        tp = loadPlatepar(ppdir, ppfname)
-        fovcheck = checker.checkFOVOverlap(rp, tp)
-        distcheck = checker.stationRangeCheck(rp, tp)    
-        if fovcheck is True and distcheck is True:
-            overlaps.append(ppfname)
-    return overlaps
+    return getOverlapMatrix(datadir).overlapping(stationid)
 
 
 def loadUFOdata(datadir, startdt, enddt, loc_cam):
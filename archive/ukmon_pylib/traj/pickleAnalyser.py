@@ -17,37 +17,98 @@ import json
 from wmpl.Utils.TrajConversions import jd2Date
 try:
     from meteortools.utils import sollon2jd
-    from traj.ShowerAssociation import associateShower
+    from traj.ShowerAssociation import associateShower, getShowerCatalogue
 except:
     pass
 from wmpl.Utils.Math import mergeClosePoints, angleBetweenSphericalCoords
 from wmpl.Utils.Physics import calcMass
 from wmpl.Utils.Pickling import loadPickle
-from wmpl.Config import config
 from wmpl.Utils.Earth import greatCircleDistance
 from wmpl.Trajectory.AggregateAndPlot import loadTrajectoryPickles
+from traj.trajSummaryStore import getSummaryStore, localVersion
+
+
+def summariseTraj(traj):
+    """ Extract the per-observation values the reports need from a trajectory. """
+    _, stations, vmags = loadMagData(traj)
+    ffnames = []
+    for obs in traj.observations:
+        ffname = None
+        if obs.comment is not None:
+            try:
+                ffname = json.loads(obs.comment)['ff_name']
+            except Exception:
+                pass
+        ffnames.append(ffname)
+    return {'stations': [str(s) for s in stations], 'vmags': [float(v) for v in vmags], 'ffnames': ffnames}
+
+
+def addCalculatedValues(summ, amag, bestvmag, mass, id, cod, shwrname):
+    summ.update({'amag': amag, 'bestvmag': bestvmag, 'mass': mass, 'shwrid': id, 'shwrcode': cod, 'shwrname': shwrname})
+    return summ
+
+
+def getTrajSummary(picklename, calculated=False, key=None, version=None):
+    """ Get the summary of a trajectory from the summary store, only unpickling it if it's not there.
+
+    Arguments:
+        picklename: [str] Full path to the trajectory pickle.
+
+    Keyword arguments:
+        calculated: [bool] Include the magnitudes, mass and shower from calcAdditionalValues. Default False.
+        key: [str] Key the summary is stored under, eg the pickle's S3 key. Default is the absolute path of picklename.
+        version: [str] Version of the pickle, eg its S3 ETag. Default is the file's mtime and size.
+
+    Return:
+        [dict] The summary. Raises an exception if it's not stored and the pickle can't be loaded.
+    """
+    if key is None:
+        key = os.path.abspath(picklename)
+    if version is None:
+        version = localVersion(picklename)
+    # the store is only a cache, so if it can't be used the pickle is read instead
+    store = None
+    summ = None
+    if version is not None:
+        try:
+            store = getSummaryStore()
+            summ = store.get(key, version)
+        except Exception as e:
+            print(f'summary store unavailable for {key}: {e}')
+        if summ is not None and (calculated is False or 'shwrcode' in summ):
+            return summ
+    traj = loadPickle(*os.path.split(picklename))
+    if summ is None:
+        summ = summariseTraj(traj)
+    if calculated:
+        amag, bestvmag, mass, id, cod, shwrname, _, _, _, _, _, _ = calcAdditionalValues(traj)
+        addCalculatedValues(summ, amag, bestvmag, mass, id, cod, shwrname)
+    if store is not None:
+        try:
+            store.put(key, version, summ)
+        except Exception as e:
+            print(f'unable to store summary for {key}: {e}')
+    return summ
 
 
 def getVMagCodeAndStations(picklename):
     try:
-        traj = loadPickle(*os.path.split(picklename))
+        summ = getTrajSummary(picklename, calculated=True)
     except Exception:
         print('no picklefile', picklename)
         return ''
+    return summ['bestvmag'], summ['shwrcode'], summ['stations']
 
-    _, bestvmag, _, _, cod, _, _, _, _, _, _, stations = calcAdditionalValues(traj)
-    return bestvmag, cod, stations
 
-
-def getAllMp4s(picklename):
+def getAllMp4s(picklename, key=None, version=None):
+    outdir, _ = os.path.split(picklename)
     try:
-        outdir, _ = os.path.split(picklename)
-        traj = loadPickle(*os.path.split(picklename))
+        summ = getTrajSummary(picklename, key=key, version=version)
     except Exception:
         print('no picklefile in ', outdir)
         return ''
     else:
-        _, statids, vmags = loadMagData(traj)
+        statids, vmags = summ['stations'], summ['vmags']
         with open(os.path.join(outdir, 'mpgs.lst')) as inf:
             lis = inf.readlines()
         maglist = []
@@ -63,23 +124,20 @@ def getAllMp4s(picklename):
         return pd.DataFrame(zip(mp4list, maglist), columns=['mp4', 'mag'])
 
 
-def getBestView(picklename):
+def getBestView(picklename, key=None, version=None):
+    outdir, _ = os.path.split(picklename)
     try:
-        outdir, _ = os.path.split(picklename)
-        traj = loadPickle(*os.path.split(picklename))
+        summ = getTrajSummary(picklename, key=key, version=version)
     except Exception:
         print('no picklefile', picklename)
         return ''
     else:
-        _, statids, vmags = loadMagData(traj)
+        statids, vmags = summ['stations'], summ['vmags']
         bestvmag = min(vmags)
-        if traj.observations[vmags.index(bestvmag)].comment is not None:
-            try:
-                com = json.loads(traj.observations[vmags.index(bestvmag)].comment)
-                bestimg = com['ff_name'].replace('FR_','FF_').replace('.bin','.jpg').replace('.fits','.jpg')
-                return bestimg
-            except Exception: 
-                pass
+        ffname = summ['ffnames'][vmags.index(bestvmag)]
+        if ffname is not None:
+            bestimg = ffname.replace('FR_','FF_').replace('.bin','.jpg').replace('.fits','.jpg')
+            return bestimg
         beststatid = statids[vmags.index(bestvmag)]
         imgfn = glob.glob1(outdir, '*{}*.jpg'.format(beststatid))
         if len(imgfn) > 0:
@@ -104,15 +162,12 @@ def getBestView(picklename):
 
 
 def getShowerDets(shwr):
-    sfd = np.load(config.iau_shower_table_npy)
-    sfdfltr = sfd[sfd[:,3] == shwr]
-    mtch = [sh for sh in sfdfltr if int(sh[6]) > -1]
-    if len(mtch) == 0:
+    # the IAU table is loaded once per process by the shower catalogue
+    dets = getShowerCatalogue().showerDetails(shwr)
+    if dets is None:
         return 0, 'Unknown', 0, 'Unknown'
 
-    id = int(mtch[-1][1])
-    nam = mtch[-1][4].strip()
-    pksollong = float(mtch[-1][7])
+    id, nam, pksollong = dets
     dt = datetime.datetime.now()
     yr = dt.year
     mth = dt.month
@@ -418,7 +473,13 @@ def loadMagData(traj):
     return magdata, stations, vmags
 
 
-def calcAdditionalValues(traj):
+def calcAdditionalValues(traj, shower_obj=None, associated=False):
+    """ Calculate the magnitudes, mass and shower of a trajectory.
+
+    Keyword arguments:
+        shower_obj: [MeteorShower] Shower already associated with the trajectory, eg by associateShowerTrajs.
+        associated: [bool] True if shower_obj has already been worked out, even if it is None. Default False.
+    """
     # # Compute  mangitudes
     magdata, stations, vmags = loadMagData(traj)
     computeAbsoluteMagnitudes(traj, magdata)
@@ -463,14 +524,16 @@ def calcAdditionalValues(traj):
     # # Compute the mass
     mass = calcMass(time_data_all, abs_mag_data_all, traj.v_avg, P_0m=1210)
 
-    shower_obj = None  # initialise this
+    if not associated:
+        shower_obj = None  # initialise this
     try:
         orb = traj.orbit
         if orb.L_g is not None:
             lg = np.degrees(orb.L_g)
             bg = np.degrees(orb.B_g)
             vg = orb.v_g
-            shower_obj = associateShower(orb.la_sun, orb.L_g, orb.B_g, orb.v_g)
+            if not associated:
+                shower_obj = associateShower(orb.la_sun, orb.L_g, orb.B_g, orb.v_g)
             if shower_obj is None:
                 id = -1
                 cod = 'spo'
@@ -492,9 +555,20 @@ def calcAdditionalValues(traj):
     return amag, bestvmag, mass, id, cod, shwrname, orb, shower_obj, lg, bg, vg, stations
 
 
-def createAdditionalOutput(traj, outdir):
-    # calculate the values
-    amag, vmag, mass, id, cod, shwrname, orb, shower_obj, lg, bg, vg, _ = calcAdditionalValues(traj)
+def createAdditionalOutput(traj, outdir, shower_obj=None, associated=False):
+    # calculate the values. The shower may have been found already, see calcAdditionalValues
+    amag, vmag, mass, id, cod, shwrname, orb, shower_obj, lg, bg, vg, _ = calcAdditionalValues(traj, 
+        shower_obj=shower_obj, associated=associated)
+
+    # we have everything the summary store needs, so save the reports unpickling this later
+    picklename = os.path.join(outdir, f'{getattr(traj, "file_name", None)}_trajectory.pickle')
+    version = localVersion(picklename)
+    if version is not None:
+        try:
+            summ = addCalculatedValues(summariseTraj(traj), amag, vmag, mass, id, cod, shwrname)
+            getSummaryStore().put(os.path.abspath(picklename), version, summ)
+        except Exception as e:
+            print(f'unable to update summary store: {e}')
 
     if id != -1:
         iau_link= f'https://www.ta3.sk/IAUC22DB/MDC2007/Roje/pojedynczy_obiekt.php?kodstrumienia={id:05d}'
@@ -565,19 +639,11 @@ def createAdditionalOutput(traj, outdir):
 
 def getListOfImages(picklename):
     try:
-        traj = loadPickle(*os.path.split(picklename))
+        summ = getTrajSummary(picklename)
     except Exception:
         print('no picklefile', picklename)
         return []
-    imglist = []
-    for obs in traj.observations:
-        if obs.comment is not None:
-            try:
-                com = json.loads(obs.comment)
-                imglist.append(com['ff_name'])
-            except Exception: 
-                pass
-    return imglist
+    return [ffname for ffname in summ['ffnames'] if ffname is not None]
 
 
 class TrajQualityParams(object):
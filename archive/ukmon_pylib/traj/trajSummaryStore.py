@@ -0,0 +1,64 @@
+# Copyright (C) 2018-2023 Mark McIntyre
+
+""" A store of the values the reports need from each trajectory pickle, so that they don't
+    have to unpickle multi-MB WMPL objects to get at a handful of numbers.
+
+    Each summary is keyed on the pickle's path, or S3 key, and is only returned if the version
+    matches - the file's mtime and size for local files, or the ETag for S3 objects.
+"""
+
+import os
+import json
+import sqlite3
+
+
+class TrajSummaryStore(object):
+    """ SQLite-backed store of trajectory summaries.
+
+    Arguments:
+        dbname: [str] Full path to the database file, created if necessary.
+    """
+    def __init__(self, dbname):
+        os.makedirs(os.path.dirname(os.path.abspath(dbname)), exist_ok=True)
+        self.dbname = dbname
+        # several report jobs may share the store, so wait for the lock rather than failing
+        self.conn = sqlite3.connect(dbname, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS summaries (pickle TEXT PRIMARY KEY, version TEXT, summary TEXT)')
+        self.conn.commit()
+
+    def get(self, key, version):
+        """ Return the summary for key as a dict, or None if there isn't one for this version. """
+        row = self.conn.execute('SELECT version, summary FROM summaries WHERE pickle=?', (key,)).fetchone()
+        if row is None or row[0] != version:
+            return None
+        return json.loads(row[1])
+
+    def put(self, key, version, summary):
+        self.conn.execute('INSERT OR REPLACE INTO summaries (pickle, version, summary) VALUES (?,?,?)',
+            (key, version, json.dumps(summary, default=lambda x: x.item())))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+_store = None
+
+
+def getSummaryStore():
+    """ Return the store for this process, in $TRAJSUMMARYDB or $DATADIR/trajsummaries/summaries.db """
+    global _store
+    if _store is None:
+        datadir = os.getenv('DATADIR', default='/home/ec2-user/prod/data')
+        dbname = os.getenv('TRAJSUMMARYDB', default=os.path.join(datadir, 'trajsummaries', 'summaries.db'))
+        _store = TrajSummaryStore(dbname)
+    return _store
+
+
+def localVersion(picklename):
+    """ Version string for a local pickle, or None if it doesn't exist. """
+    try:
+        st = os.stat(picklename)
+    except OSError:
+        return None
+    return f'{st.st_mtime_ns}-{st.st_size}'